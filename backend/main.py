@@ -1,20 +1,16 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, request, jsonify, send_from_directory, Response
 from flask_cors import CORS
 import os
 from dotenv import load_dotenv
 import requests
-import PyPDF2
-try:
-    from docx import Document
-    HAS_DOCX = True
-except ImportError:
-    HAS_DOCX = False
-    print("Warning: python-docx not installed. DOCX support disabled.")
 from io import BytesIO
 import time
 import uuid
 from werkzeug.utils import secure_filename
 import concurrent.futures
+import threading
+import queue
+import contextvars
 import hmac
 import hashlib
 import base64
@@ -31,10 +27,46 @@ except ImportError as e:
     print(f"Warning: Image service not available: {e}")
     HAS_IMAGE_SERVICE = False
 
+from services.http_client import get_http_client
+from services.hedging import get_provider_racer
+from services.circuit_breaker import get_circuit_breakers
+from services.rate_limiter import get_rate_limiter, parse_retry_after, RateLimitExceeded
+from services.retry import get_retry_policy, ProviderError
+from services.response_cache import get_response_cache, make_cache_key
+from services.health_monitor import get_health_monitor
+from services.provider_pool import get_provider_pool, PoolSaturated
+from services.single_flight import get_single_flight
+from services.ollama_runtime import get_ollama_runtime, OLLAMA_NUM_CTX
+from services.supersession import get_supersession, Superseded
+from services.session_store import get_session_store
+from services.tokens import estimate_tokens, count_tokens
+from services.token_accounting import get_token_ledger, set_usage_labels
+from services.document_store import (
+    new_document, add_document, find_document, build_document_context, documents_size, select_documents,
+    pending_documents
+)
+from services.retrieval import chunk_document, get_session_indexes
+from services.summarizer import get_summarizer
+from services.extraction import get_extraction_engine, is_extractable
+from services.ingestion import get_ingestion_queue, process_owner, owner_alive
+from services.prompt_layout import (
+    LayeredPrompt, chat_messages, gemini_payload, prompt_usage, usage_scope, usage_summary,
+    get_prompt_cache_stats, get_gemini_context_cache
+)
+from services.streaming import (
+    iter_chat_completion_deltas, iter_gemini_text, clean_model_output, StreamCleaner,
+    coalesce_chunks, NDJSONWriter, get_stream_stats
+)
+
 app = Flask(__name__)
 # Enable CORS manually to handle all cases robustly
 # CORS(app) # Disable Flask-CORS to avoid conflicts
 
+@app.before_request
+def bind_usage_labels():
+    # Provider calls made while serving this request count towards its session and endpoint
+    set_usage_labels(request.headers.get('X-Session-ID'), request.path.rstrip('/').rsplit('/', 1)[-1] or None)
+
 @app.after_request
 def add_cors_headers(response):
     origin = request.headers.get('Origin')
@@ -61,19 +93,26 @@ UPLOAD_FOLDER = os.path.join(os.getcwd(), 'uploads')
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
-# Global simple session store (InMemory for now)
-sessions = {}
+# The debug reloader also imports this module in a watcher process that never
+# serves requests, and spawned multiprocessing children import it as __mp_main__;
+# only the serving process (WERKZEUG_RUN_MAIN under the reloader) does startup work
+SERVING_PROCESS = __name__ != "__mp_main__" and (
+    __name__ != "__main__" or os.environ.get("WERKZEUG_RUN_MAIN") == "true"
+)
+
+# Session store: SQLite (persistent, shared by workers) or memory, see SESSION_STORE
+session_store = get_session_store()
 
 def get_session(session_id):
     """Retrieve or create a session object."""
-    if session_id not in sessions:
-        sessions[session_id] = {
-            "context": "",
-            "images": [],
-            "docs": [],
-            "created_at": time.time()
-        }
-    return sessions[session_id]
+    return session_store.get(session_id)
+
+def update_session(session_id, mutate):
+    """
+    Apply mutate(session) and persist it without losing concurrent updates
+    from other requests or workers (mutate may be re-run on a fresh copy).
+    """
+    return session_store.update(session_id, mutate)
 
 # Removed premature app.run
 
@@ -81,6 +120,8 @@ def get_session(session_id):
 # Using verifiable available model
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 GEMINI_API_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash-lite:generateContent"
+GEMINI_STREAM_URL = GEMINI_API_URL.replace(":generateContent", ":streamGenerateContent")
+GEMINI_CACHE_URL = GEMINI_API_URL.split("/models/")[0] + "/cachedContents"
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 # openai_client removed - using requests directly
@@ -100,9 +141,191 @@ MANUS_API_URL = "https://api.manus.ai/v1/tasks"
 OLLAMA_API_URL = "http://localhost:11434/api/chat"
 ZHIPU_API_URL = "https://open.bigmodel.cn/api/paas/v4/chat/completions"
 
+# Model used by each provider adapter
+PROVIDER_MODELS = {
+    "gemini": GEMINI_API_URL.split("/models/")[1].split(":")[0],
+    "openai": "gpt-4o-mini",
+    "grok": "grok-beta",
+    "manus": "speed",
+    "deepseek": "deepseek-chat",
+    "llama": "llama3-70b-8192",
+    # Deep model for detailed, comprehensive responses; set a local model to keep it warm
+    "ollama": os.getenv("OLLAMA_MODEL", "deepseek-v3.1:671b-cloud"),
+    "zhipu": "glm-4-flash"  # Often free/unlimited
+}
+
+# Context window (tokens) of each provider's model, used to budget document context
+PROVIDER_CONTEXT_TOKENS = {
+    "gemini": 1000000,
+    "openai": 128000,
+    "grok": 131072,
+    "manus": 32000,
+    "deepseek": 64000,
+    "llama": 8192,
+    "ollama": OLLAMA_NUM_CTX,
+    "zhipu": 128000
+}
+# Share of the window documents may use (the rest is instructions + the answer), and a hard cap
+CONTEXT_DOC_SHARE = float(os.getenv("CONTEXT_DOC_SHARE", "0.5"))
+CONTEXT_MAX_TOKENS = int(os.getenv("CONTEXT_MAX_TOKENS", "100000"))
+
+def context_budget(provider):
+    """Tokens of document context to send to `provider`."""
+    window = PROVIDER_CONTEXT_TOKENS.get(provider, PROVIDER_CONTEXT_TOKENS["gemini"])
+    return min(CONTEXT_MAX_TOKENS, int(window * CONTEXT_DOC_SHARE))
+
+# BM25 retrieval over document chunks: (top_k chunks, max tokens) per endpoint
+session_indexes = get_session_indexes()
+RETRIEVAL_SETTINGS = {
+    "chat": (int(os.getenv("RETRIEVAL_TOP_K", "8")), int(os.getenv("RETRIEVAL_MAX_TOKENS", "4000"))),
+    "generate": (int(os.getenv("RETRIEVAL_TOP_K_GENERATE", "16")), int(os.getenv("RETRIEVAL_MAX_TOKENS_GENERATE", "12000")))
+}
+
+def document_context(session_id, session, provider, data, query, endpoint):
+    """
+    Document context for a prompt. When the selected documents are larger
+    than the endpoint's retrieval budget, only the chunks that best match
+    `query` are sent; otherwise (or if nothing matches, or the request sets
+    "retrieval": false) whole documents are budgeted per build_document_context.
+    """
+    budget = context_budget(provider)
+    doc_ids = data.get("documentIds")
+    context, report = None, None
+    if data.get("retrieval", True) and query:
+        top_k, max_tokens = RETRIEVAL_SETTINGS[endpoint]
+        documents = select_documents(session, doc_ids)
+        if sum(estimate_tokens(doc["text"]) for doc in documents) > min(budget, max_tokens):
+            context, report = session_indexes.retrieve(session_id, documents, query, min(budget, max_tokens), top_k)
+    if not context:
+        context, report = build_document_context(session, budget, doc_ids)
+    # Documents still being extracted are left out until their ingestion job finishes
+    pending = pending_documents(session)
+    if pending:
+        report["pending"] = pending
+        resume_stale_ingestion(session_id, session)
+    return context, report
+
+def context_is_stable(report):
+    """True if the context is whole documents (repeats across requests), not query-picked excerpts."""
+    return not report or report.get("mode") != "retrieval"
+
+# Shared keep-alive connection pools, one per provider host
+http_client = get_http_client()
+http_client.register("gemini", GEMINI_API_URL)
+http_client.register("openai", OPENAI_API_URL)
+http_client.register("grok", GROK_API_URL)
+http_client.register("deepseek", DEEPSEEK_API_URL)
+http_client.register("llama", LLAMA_API_URL)
+http_client.register("manus", MANUS_API_URL)
+http_client.register("ollama", OLLAMA_API_URL)
+http_client.register("zhipu", ZHIPU_API_URL)
+
+# One bounded worker pool for provider I/O, with per-provider concurrency caps
+provider_pool = get_provider_pool()
+
+# Hedged (raced) requests across providers, opt-in per request
+provider_racer = get_provider_racer()
+
+# Per-provider circuit breakers and the fallback order used when a provider fails
+circuit_breakers = get_circuit_breakers()
+AI_FALLBACK_CHAIN = [p.strip() for p in os.getenv("AI_FALLBACK_CHAIN", "gemini,openai,ollama").split(",") if p.strip()]
+
+# Client-side request/token budgets, tuned from provider rate-limit headers
+rate_limiter = get_rate_limiter()
+http_client.add_response_listener(rate_limiter.observe_response)
+
+# Two-tier (memory LRU + SQLite) cache of full responses for opted-in endpoints
+response_cache = get_response_cache()
+AI_CACHE_ENDPOINTS = set(p.strip() for p in os.getenv("AI_CACHE_ENDPOINTS", "refine,summarize").split(",") if p.strip())
+
+# Local Ollama: keep the model resident and size its context per request
+ollama_runtime = get_ollama_runtime(OLLAMA_API_URL.split("/api/")[0], PROVIDER_MODELS["ollama"])
+
+# Frame/byte counters for the NDJSON streams we serve
+stream_stats = get_stream_stats()
+
+# Identical concurrent requests (double tabs, frontend retries) share one upstream call
+single_flight = get_single_flight()
+
+# A newer generate/stream_chat request from the same session cancels the older one
+supersession = get_supersession()
+
+# Long documents are summarized map-reduce instead of truncated
+summarizer = get_summarizer()
+
+# Input tokens per provider call, and how many the provider served from its prompt cache
+prompt_cache_stats = get_prompt_cache_stats()
+
+# Tokens and approximate cost per provider, endpoint and session, plus prompt-size alerts
+token_ledger = get_token_ledger()
+
+# Uploads return immediately; text extraction runs on background workers
+ingestion_queue = get_ingestion_queue()
+# PDF/DOCX parsing runs on a warm process pool, across files and page ranges of large PDFs.
+# Its workers are forked here, at import, before this process starts any threads
+extraction_engine = get_extraction_engine()
+if SERVING_PROCESS:
+    extraction_engine.warm_up()
+UPLOAD_YEAR = "2024"
+
+def cache_scope(endpoint, data):
+    """Endpoint name to cache under, or None if caching is off for this request."""
+    if endpoint not in AI_CACHE_ENDPOINTS or data.get("cache") is False:
+        return None
+    return endpoint
+
+def provider_http_error(provider, message, response, retryable=None):
+    """Build a ProviderError from a non-200 response, keeping any Retry-After hint."""
+    return ProviderError(
+        provider,
+        response.status_code,
+        message,
+        retry_after=parse_retry_after(response.headers.get("Retry-After")),
+        retryable=retryable
+    )
+
+def ai_error_response(e):
+    """JSON error response for a failed generation, mapped to an HTTP status."""
+    error_msg = str(e)
+    status_code = 500
+    retry_after = None
+    body = {"error": error_msg}
+    if isinstance(e, Superseded):
+        status_code = 409
+        body["status"] = "superseded"
+    elif isinstance(e, PoolSaturated):
+        # Overloaded here, not upstream: tell the client when to come back
+        status_code = 503
+        retry_after = e.retry_after
+    elif "429" in error_msg or "Quota" in error_msg:
+        status_code = 429
+        retry_after = getattr(e, "retry_after", None)
+    elif "403" in error_msg:
+        status_code = 403
+
+    response = jsonify(body)
+    response.status_code = status_code
+    if retry_after:
+        response.headers["Retry-After"] = str(max(1, int(round(retry_after))))
+    return response
+
+def warm_up_provider_pools():
+    """Pre-connect to every provider we hold credentials for (plus local Ollama)."""
+    if os.getenv("HTTP_WARMUP", "1") == "0":
+        return
+    configured = {
+        "gemini": GOOGLE_API_KEY,
+        "openai": OPENAI_API_KEY,
+        "grok": GROK_API_KEY,
+        "deepseek": DEEPSEEK_API_KEY,
+        "llama": LLAMA_API_KEY,
+        "zhipu": ZHIPU_API_KEY,
+        "ollama": True
+    }
+    http_client.warm_up_async([name for name, key in configured.items() if key])
 
 
-def call_gemini(prompt):
+def call_gemini(prompt, timeout=30, use_cache=True):
     if not GOOGLE_API_KEY:
         print("CRITICAL ERROR: GOOGLE_API_KEY is missing from environment variables.")
         raise Exception("GOOGLE_API_KEY not set. Please check your .env file.")
@@ -111,81 +334,127 @@ def call_gemini(prompt):
         "Content-Type": "application/json"
     }
     
-    payload = {
-        "contents": [{
-            "parts": [{"text": prompt}]
-        }]
-    }
+    # Instructions + documents come from a context cache when the prompt is large enough
+    cached_content = gemini_context_cache.lookup(prompt) if use_cache else None
+    payload = gemini_payload(prompt, cached_content)
     
-    # Retry configuration
-    max_retries = 3
-    retry_delay = 2 
-
-    for attempt in range(max_retries):
-        try:
-            print(f"Sending request to Gemini (Attempt {attempt+1})...")
-            response = requests.post(
-                f"{GEMINI_API_URL}?key={GOOGLE_API_KEY}",
-                headers=headers,
-                json=payload,
-                timeout=30
-            )
-            
-            if response.status_code == 200:
-                print("Gemini API request successful.")
-                break
-                
-            elif response.status_code == 429:
-                # Check for hard quota limit vs temporary rate limit
-                error_body = response.text.lower()
-                if "resource_exhausted" in error_body or "quota" in error_body:
-                    print("CRITICAL: Gemini API Quota Exceeded.")
-                    raise Exception("Quota Exceeded: Your Google Gemini API key has reached its usage limit. Please check your billing or wait 24 hours.")
-                
-                print(f"Rate Limit (429). Waiting {retry_delay}s...")
-                time.sleep(retry_delay)
-                retry_delay *= 2
-                        
-            elif response.status_code >= 500:
-                 print(f"Server Error {response.status_code}. Retrying...")
-                 time.sleep(retry_delay)
-            else:
-                print(f"Gemini API Error: {response.status_code} - {response.text}")
-                # Don't retry client errors
-                raise Exception(f"API Error {response.status_code}: {response.text}")
-                
-        except requests.exceptions.RequestException as e:
-            print(f"Network error communicating with Gemini: {e}")
-            time.sleep(retry_delay)
-
-    else:
-         print("All retries failed.")
-         raise Exception("Service unavailable after retries (Rate Limit or Network).")
+    try:
+        print("Sending request to Gemini...")
+        response = http_client.post(
+            "gemini",
+            f"{GEMINI_API_URL}?key={GOOGLE_API_KEY}",
+            headers=headers,
+            json=payload,
+            timeout=timeout
+        )
+    except requests.exceptions.RequestException as e:
+        print(f"Network error communicating with Gemini: {e}")
+        raise ProviderError("gemini", None, f"Gemini Network Error: {str(e)}")
+
+    if response.status_code != 200:
+        if cached_content and response.status_code in GEMINI_CACHE_MISS_STATUSES:
+            # The cache expired or was removed early: forget it and send the prompt inline
+            gemini_context_cache.invalidate(prompt)
+            return call_gemini(prompt, timeout=timeout, use_cache=False)
+        raise gemini_http_error(response)
+    print("Gemini API request successful.")
         
     data = response.json()
+    prompt_cache_stats.record("gemini", prompt_usage("gemini", data))
     try:
         content = data["candidates"][0]["content"]["parts"][0]["text"]
-        
-        # 1. Strip Markdown Code Blocks
-        import re
-        content = re.sub(r'^```[a-zA-Z]*\n', '', content.strip()) 
-        content = re.sub(r'\n```$', '', content.strip())
-        
-        # 2. Strip HTML/Body wrappers
-        if "<body>" in content:
-            content = content.split("<body>")[1]
-            if "</body>" in content:
-                content = content.split("</body>")[0]
-        
-        # Fallback cleanup
-        content = content.replace("<html>", "").replace("</html>", "")
-        content = content.replace("<!DOCTYPE html>", "")
-            
-        return content.strip()
+        # Strip Markdown code blocks and HTML/Body wrappers
+        return clean_model_output(content)
     except (KeyError, IndexError):
         raise Exception("Invalid response format from Gemini API")
 
-def call_openai(prompt, model="gpt-4o-mini"):
+# Statuses Gemini returns for a cachedContent that no longer exists
+GEMINI_CACHE_MISS_STATUSES = (400, 403, 404)
+
+def create_gemini_cache(body):
+    """Create a cachedContents entry (used by the Gemini context cache); returns its name."""
+    response = http_client.post(
+        "gemini",
+        f"{GEMINI_CACHE_URL}?key={GOOGLE_API_KEY}",
+        headers={"Content-Type": "application/json"},
+        json=body,
+        timeout=15
+    )
+    if response.status_code != 200:
+        raise provider_http_error("gemini", f"Gemini cache Error {response.status_code}: {response.text}", response)
+    return response.json()["name"]
+
+# Explicit context caches for large, repeated Gemini prompt prefixes
+gemini_context_cache = get_gemini_context_cache(PROVIDER_MODELS["gemini"], create_gemini_cache)
+
+def gemini_http_error(response):
+    """Map a failed Gemini response to a ProviderError (quota exhaustion is not retryable)."""
+    if response.status_code == 429:
+        # Check for hard quota limit vs temporary rate limit
+        error_body = response.text.lower()
+        if "resource_exhausted" in error_body or "quota" in error_body:
+            print("CRITICAL: Gemini API Quota Exceeded.")
+            return provider_http_error("gemini", "Quota Exceeded: Your Google Gemini API key has reached its usage limit. Please check your billing or wait 24 hours.", response, retryable=False)
+    print(f"Gemini API Error: {response.status_code} - {response.text}")
+    return provider_http_error("gemini", f"API Error {response.status_code}: {response.text}", response)
+
+def stream_gemini(prompt, timeout=30, use_cache=True):
+    """
+    Generator yielding Gemini output as it is produced (streamGenerateContent SSE).
+    Fence/wrapper cleanup runs incrementally so first tokens are not delayed.
+    """
+    if not GOOGLE_API_KEY:
+        print("CRITICAL ERROR: GOOGLE_API_KEY is missing from environment variables.")
+        raise Exception("GOOGLE_API_KEY not set. Please check your .env file.")
+
+    headers = {
+        "Content-Type": "application/json"
+    }
+    
+    cached_content = gemini_context_cache.lookup(prompt) if use_cache else None
+    payload = gemini_payload(prompt, cached_content)
+    
+    try:
+        print("Sending request to Gemini [Stream=True]...")
+        response = http_client.post(
+            "gemini",
+            f"{GEMINI_STREAM_URL}?alt=sse&key={GOOGLE_API_KEY}",
+            headers=headers,
+            json=payload,
+            timeout=timeout,
+            stream=True
+        )
+    except requests.exceptions.RequestException as e:
+        print(f"Network error communicating with Gemini: {e}")
+        raise ProviderError("gemini", None, f"Gemini Network Error: {str(e)}")
+
+    if cached_content and response.status_code in GEMINI_CACHE_MISS_STATUSES:
+        # The cache expired or was removed early: forget it and stream the prompt inline
+        response.close()
+        gemini_context_cache.invalidate(prompt)
+        yield from stream_gemini(prompt, timeout=timeout, use_cache=False)
+        return
+
+    with response:
+        if response.status_code != 200:
+            raise gemini_http_error(response)
+
+        cleaner = StreamCleaner()
+        on_usage = lambda event: prompt_cache_stats.record("gemini", prompt_usage("gemini", event))
+        try:
+            for text in iter_gemini_text(response, on_usage=on_usage):
+                cleaned = cleaner.feed(text)
+                if cleaned:
+                    yield cleaned
+        except requests.exceptions.RequestException as e:
+            print(f"Stream interrupted from Gemini: {e}")
+            raise ProviderError("gemini", None, f"Gemini Network Error: {str(e)}")
+
+        tail = cleaner.flush()
+        if tail:
+            yield tail
+
+def call_openai(prompt, model=PROVIDER_MODELS["openai"], timeout=30):
     if not OPENAI_API_KEY:
         raise Exception("OpenAI API Key not configured.")
 
@@ -196,31 +465,33 @@ def call_openai(prompt, model="gpt-4o-mini"):
     
     payload = {
         "model": model,
-        "messages": [{"role": "user", "content": prompt}],
+        "messages": chat_messages(prompt),
         "temperature": 0.7
     }
     
     try:
         print(f"Sending request to OpenAI ({model})...")
-        response = requests.post(
+        response = http_client.post(
+            "openai",
             OPENAI_API_URL,
             headers=headers,
             json=payload,
-            timeout=30
+            timeout=timeout
         )
         
         if response.status_code == 200:
             data = response.json()
+            prompt_cache_stats.record("openai", prompt_usage("openai", data))
             return data["choices"][0]["message"]["content"]
         else:
-            raise Exception(f"OpenAI Error {response.status_code}: {response.text}")
+            raise provider_http_error("openai", f"OpenAI Error {response.status_code}: {response.text}", response)
             
             
     except requests.exceptions.RequestException as e:
         print(f"Network error communicating with OpenAI: {e}")
-        raise Exception(f"OpenAI Network Error: {str(e)}")
+        raise ProviderError("openai", None, f"OpenAI Network Error: {str(e)}")
 
-def call_grok(prompt):
+def call_grok(prompt, timeout=30):
     if not GROK_API_KEY:
         raise Exception("Grok API Key not configured.")
 
@@ -230,32 +501,34 @@ def call_grok(prompt):
     }
     
     payload = {
-        "model": "grok-beta", 
-        "messages": [{"role": "user", "content": prompt}],
+        "model": PROVIDER_MODELS["grok"],
+        "messages": chat_messages(prompt),
         "stream": False,
         "temperature": 0.7
     }
     
     try:
         print(f"Sending request to Grok...")
-        response = requests.post(
+        response = http_client.post(
+            "grok",
             GROK_API_URL,
             headers=headers,
             json=payload,
-            timeout=30
+            timeout=timeout
         )
         
         if response.status_code == 200:
             data = response.json()
+            prompt_cache_stats.record("grok", prompt_usage("grok", data))
             return data["choices"][0]["message"]["content"]
         else:
-            raise Exception(f"Grok Error {response.status_code}: {response.text}")
+            raise provider_http_error("grok", f"Grok Error {response.status_code}: {response.text}", response)
             
     except requests.exceptions.RequestException as e:
         print(f"Network error communicating with Grok: {e}")
-        raise Exception(f"Grok Network Error: {str(e)}")
+        raise ProviderError("grok", None, f"Grok Network Error: {str(e)}")
 
-def call_manus(prompt):
+def call_manus(prompt, timeout=30):
     MANUS_API_KEY = os.getenv("MANUS_API_KEY")
     if not MANUS_API_KEY:
          raise Exception("Manus API Key not found in environment.")
@@ -273,11 +546,12 @@ def call_manus(prompt):
     
     try:
         print(f"Sending request to Manus...")
-        response = requests.post(
+        response = http_client.post(
+            "manus",
             MANUS_API_URL,
             headers=headers,
             json=payload,
-            timeout=30
+            timeout=timeout
         )
         
         if response.status_code == 200:
@@ -286,17 +560,17 @@ def call_manus(prompt):
             task_id = data.get('id') or data.get('taskId') or data.get('task_id') or 'Unknown'
             return f"Manus Task Started (ID: {task_id}). Check dashboard for results."
         else:
-            raise Exception(f"Manus Error {response.status_code}: {response.text}")
+            raise provider_http_error("manus", f"Manus Error {response.status_code}: {response.text}", response)
             
     except requests.exceptions.RequestException as e:
         print(f"Network error communicating with Manus: {e}")
-        raise Exception(f"Manus Network Error: {str(e)}")
+        raise ProviderError("manus", None, f"Manus Network Error: {str(e)}")
 
     except requests.exceptions.RequestException as e:
         print(f"Network error communicating with Manus: {e}")
-        raise Exception(f"Manus Network Error: {str(e)}")
+        raise ProviderError("manus", None, f"Manus Network Error: {str(e)}")
 
-def call_deepseek(prompt):
+def call_deepseek(prompt, timeout=30):
     if not DEEPSEEK_API_KEY:
         raise Exception("DeepSeek API Key not configured.")
     
@@ -306,32 +580,34 @@ def call_deepseek(prompt):
     }
     
     payload = {
-        "model": "deepseek-chat", 
-        "messages": [{"role": "user", "content": prompt}],
+        "model": PROVIDER_MODELS["deepseek"],
+        "messages": chat_messages(prompt),
         "stream": False,
         "temperature": 0.7
     }
     
     try:
         print(f"Sending request to DeepSeek...")
-        response = requests.post(
+        response = http_client.post(
+            "deepseek",
             DEEPSEEK_API_URL,
             headers=headers,
             json=payload,
-            timeout=30
+            timeout=timeout
         )
         
         if response.status_code == 200:
             data = response.json()
+            prompt_cache_stats.record("deepseek", prompt_usage("deepseek", data))
             return data["choices"][0]["message"]["content"]
         else:
-            raise Exception(f"DeepSeek Error {response.status_code}: {response.text}")
+            raise provider_http_error("deepseek", f"DeepSeek Error {response.status_code}: {response.text}", response)
             
     except requests.exceptions.RequestException as e:
         print(f"Network error communicating with DeepSeek: {e}")
-        raise Exception(f"DeepSeek Network Error: {str(e)}")
+        raise ProviderError("deepseek", None, f"DeepSeek Network Error: {str(e)}")
 
-def call_llama(prompt):
+def call_llama(prompt, timeout=30):
     # Llama 3 via Groq is a common interface. Assuming Groq style or similar. 
     # Placeholder implementation if key is missing.
     if not LLAMA_API_KEY:
@@ -343,29 +619,31 @@ def call_llama(prompt):
     }
     
     payload = {
-        "model": "llama3-70b-8192", 
-        "messages": [{"role": "user", "content": prompt}],
+        "model": PROVIDER_MODELS["llama"],
+        "messages": chat_messages(prompt),
         "temperature": 0.7
     }
     
     try:
         print(f"Sending request to Llama (Groq)...")
-        response = requests.post(
+        response = http_client.post(
+            "llama",
             LLAMA_API_URL,
             headers=headers,
             json=payload,
-            timeout=30
+            timeout=timeout
         )
         
         if response.status_code == 200:
             data = response.json()
+            prompt_cache_stats.record("llama", prompt_usage("llama", data))
             return data["choices"][0]["message"]["content"]
         else:
-            raise Exception(f"Llama Error {response.status_code}: {response.text}")
+            raise provider_http_error("llama", f"Llama Error {response.status_code}: {response.text}", response)
             
     except requests.exceptions.RequestException as e:
         print(f"Network error communicating with Llama: {e}")
-        raise Exception(f"Llama Network Error: {str(e)}")
+        raise ProviderError("llama", None, f"Llama Network Error: {str(e)}")
 
 def generate_zhipu_token(apikey: str, exp_seconds: int = 600):
     try:
@@ -397,7 +675,7 @@ def generate_zhipu_token(apikey: str, exp_seconds: int = 600):
     segments.append(b64url(signature))
     return b'.'.join(segments).decode('utf-8')
 
-def call_zhipu(prompt):
+def call_zhipu(prompt, timeout=30):
     if not ZHIPU_API_KEY:
         raise Exception("Zhipu API Key not configured.")
     
@@ -409,85 +687,209 @@ def call_zhipu(prompt):
     }
     
     payload = {
-        "model": "glm-4-flash", # Often free/unlimited
-        "messages": [{"role": "user", "content": prompt}],
+        "model": PROVIDER_MODELS["zhipu"],
+        "messages": chat_messages(prompt),
         "stream": False
     }
     
     try:
         print(f"Sending request to Zhipu...")
-        response = requests.post(
+        response = http_client.post(
+            "zhipu",
             ZHIPU_API_URL,
             headers=headers,
             json=payload,
-            timeout=30
+            timeout=timeout
         )
         
         if response.status_code == 200:
             data = response.json()
+            prompt_cache_stats.record("zhipu", prompt_usage("zhipu", data))
             return data["choices"][0]["message"]["content"]
         else:
-            raise Exception(f"Zhipu Error {response.status_code}: {response.text}")
+            raise provider_http_error("zhipu", f"Zhipu Error {response.status_code}: {response.text}", response)
             
     except requests.exceptions.RequestException as e:
         print(f"Network error communicating with Zhipu: {e}")
-        raise Exception(f"Zhipu Network Error: {str(e)}")
+        raise ProviderError("zhipu", None, f"Zhipu Network Error: {str(e)}")
 
-def call_ollama(prompt, stream=False):
+def call_ollama(prompt, timeout=120, endpoint=None):
     # No Auth required normally for localhost
     headers = {
         "Content-Type": "application/json"
     }
     
+    tuning = ollama_runtime.options(estimate_tokens(prompt), endpoint)
     payload = {
-        "model": "deepseek-v3.1:671b-cloud",  # Deep model for detailed, comprehensive responses
-        "messages": [{"role": "user", "content": prompt}],
-        "stream": stream
+        "model": PROVIDER_MODELS["ollama"],
+        "messages": chat_messages(prompt),
+        "stream": False,
+        **tuning
     }
     
     try:
-        print(f"Sending request to Ollama (Local) [Stream={stream}]...")
+        print(f"Sending request to Ollama (Local)...")
         # Ensure timeout is sufficient for local generation (models take time to load/gen)
-        # For streaming, we use stream=True in requests
-        response = requests.post(
+        response = http_client.post(
+            "ollama",
             OLLAMA_API_URL,
             headers=headers,
             json=payload,
-            timeout=120,
-            stream=stream
+            timeout=timeout
         )
         
         if response.status_code == 200:
-            if stream:
-                 # Generator for streaming
-                 for line in response.iter_lines():
-                    if line:
-                        decoded_line = line.decode('utf-8')
-                        try:
-                            json_obj = json.loads(decoded_line)
-                            if 'message' in json_obj and 'content' in json_obj['message']:
-                                yield json_obj['message']['content']
-                            if json_obj.get('done', False):
-                                break
-                        except json.JSONDecodeError:
-                            continue
-            else:
-                data = response.json()
-                return data["message"]["content"]
+            data = response.json()
+            ollama_runtime.observe(data, tuning)
+            prompt_cache_stats.record("ollama", prompt_usage("ollama", data))
+            return data["message"]["content"]
         else:
-            raise Exception(f"Ollama Error {response.status_code}: {response.text}")
+            raise provider_http_error("ollama", f"Ollama Error {response.status_code}: {response.text}", response)
             
     except requests.exceptions.RequestException as e:
         print(f"Network error communicating with Ollama: {e}")
-        raise Exception(f"Ollama Unreachable (Is it running?): {str(e)}")
+        raise ProviderError("ollama", None, f"Ollama Unreachable (Is it running?): {str(e)}")
+
+def stream_ollama(prompt, timeout=120, endpoint="stream_chat"):
+    """Generator yielding content chunks from Ollama's NDJSON stream."""
+    headers = {
+        "Content-Type": "application/json"
+    }
+    
+    tuning = ollama_runtime.options(estimate_tokens(prompt), endpoint)
+    payload = {
+        "model": PROVIDER_MODELS["ollama"],
+        "messages": chat_messages(prompt),
+        "stream": True,
+        **tuning
+    }
+    
+    try:
+        print(f"Sending request to Ollama (Local) [Stream=True]...")
+        response = http_client.post(
+            "ollama",
+            OLLAMA_API_URL,
+            headers=headers,
+            json=payload,
+            timeout=timeout,
+            stream=True
+        )
+    except requests.exceptions.RequestException as e:
+        print(f"Network error communicating with Ollama: {e}")
+        raise ProviderError("ollama", None, f"Ollama Unreachable (Is it running?): {str(e)}")
+
+    with response:
+        if response.status_code != 200:
+            raise provider_http_error("ollama", f"Ollama Error {response.status_code}: {response.text}", response)
+
+        for line in response.iter_lines():
+            if line:
+                decoded_line = line.decode('utf-8')
+                try:
+                    json_obj = json.loads(decoded_line)
+                    if 'message' in json_obj and 'content' in json_obj['message']:
+                        yield json_obj['message']['content']
+                    if json_obj.get('done', False):
+                        # The final line carries load/eval timings and token counts
+                        ollama_runtime.observe(json_obj, tuning)
+                        prompt_cache_stats.record("ollama", prompt_usage("ollama", json_obj))
+                        break
+                except json.JSONDecodeError:
+                    continue
+
+def stream_chat_completions(provider, label, url, token, model, prompt, timeout=30, **extra):
+    """
+    Generator yielding content deltas from an OpenAI-compatible chat API
+    (OpenAI, Grok, DeepSeek, Groq, Zhipu) using `stream: true` SSE responses.
+    """
+    headers = {
+        "Content-Type": "application/json",
+        "Accept": "text/event-stream",
+        "Authorization": f"Bearer {token}"
+    }
+    
+    payload = {
+        "model": model,
+        "messages": chat_messages(prompt),
+        "stream": True,
+        **extra
+    }
+    
+    try:
+        print(f"Sending request to {label} [Stream=True]...")
+        response = http_client.post(
+            provider,
+            url,
+            headers=headers,
+            json=payload,
+            timeout=timeout,
+            stream=True
+        )
+    except requests.exceptions.RequestException as e:
+        print(f"Network error communicating with {label}: {e}")
+        raise ProviderError(provider, None, f"{label} Network Error: {str(e)}")
+
+    with response:
+        if response.status_code != 200:
+            raise provider_http_error(provider, f"{label} Error {response.status_code}: {response.text}", response)
+
+        try:
+            on_usage = lambda event: prompt_cache_stats.record(provider, prompt_usage(provider, event))
+            for content in iter_chat_completion_deltas(response, on_usage=on_usage):
+                yield content
+        except requests.exceptions.RequestException as e:
+            print(f"Stream interrupted from {label}: {e}")
+            raise ProviderError(provider, None, f"{label} Network Error: {str(e)}")
+
+# Final SSE event with token usage (OpenAI-compatible APIs that accept stream_options)
+STREAM_USAGE_OPTIONS = {"include_usage": True}
+
+def stream_openai(prompt, model=PROVIDER_MODELS["openai"], timeout=30):
+    if not OPENAI_API_KEY:
+        raise Exception("OpenAI API Key not configured.")
+    return stream_chat_completions("openai", "OpenAI", OPENAI_API_URL, OPENAI_API_KEY, model, prompt, timeout=timeout, temperature=0.7, stream_options=STREAM_USAGE_OPTIONS)
+
+def stream_grok(prompt, timeout=30):
+    if not GROK_API_KEY:
+        raise Exception("Grok API Key not configured.")
+    return stream_chat_completions("grok", "Grok", GROK_API_URL, GROK_API_KEY, PROVIDER_MODELS["grok"], prompt, timeout=timeout, temperature=0.7, stream_options=STREAM_USAGE_OPTIONS)
+
+def stream_deepseek(prompt, timeout=30):
+    if not DEEPSEEK_API_KEY:
+        raise Exception("DeepSeek API Key not configured.")
+    return stream_chat_completions("deepseek", "DeepSeek", DEEPSEEK_API_URL, DEEPSEEK_API_KEY, PROVIDER_MODELS["deepseek"], prompt, timeout=timeout, temperature=0.7, stream_options=STREAM_USAGE_OPTIONS)
+
+def stream_llama(prompt, timeout=30):
+    if not LLAMA_API_KEY:
+        raise Exception("Llama/Groq API Key not found in environment (LLAMA_API_KEY).")
+    return stream_chat_completions("llama", "Llama", LLAMA_API_URL, LLAMA_API_KEY, PROVIDER_MODELS["llama"], prompt, timeout=timeout, temperature=0.7)
+
+def stream_zhipu(prompt, timeout=30):
+    if not ZHIPU_API_KEY:
+        raise Exception("Zhipu API Key not configured.")
+    token = generate_zhipu_token(ZHIPU_API_KEY)
+    return stream_chat_completions("zhipu", "Zhipu", ZHIPU_API_URL, token, PROVIDER_MODELS["zhipu"], prompt, timeout=timeout)
+
+# Providers with native token streaming
+STREAM_PROVIDERS = {
+    "gemini": stream_gemini,
+    "openai": stream_openai,
+    "grok": stream_grok,
+    "deepseek": stream_deepseek,
+    "llama": stream_llama,
+    "zhipu": stream_zhipu,
+    "ollama": stream_ollama
+}
 
 def generate_ai_response_stream(prompt, provider="gemini"):
     """
     Generator function that streams response text chunks.
-    Currently only implemented for Ollama/DeepSeek.
+    Providers without native streaming fall back to a single chunk.
     """
-    if provider == "ollama" or provider == "deepseek":
-         return call_ollama(prompt, stream=True)
+    if provider in STREAM_PROVIDERS:
+         # Late joiners replay the chunks streamed so far, then follow live
+         flight_key = make_cache_key(provider, PROVIDER_MODELS[provider], prompt)
+         return single_flight.stream(flight_key, lambda: pooled_stream(provider, prompt))
     elif provider == "mock":
          # Mock stream for testing
          def mock_generator():
@@ -504,96 +906,454 @@ def generate_ai_response_stream(prompt, provider="gemini"):
             yield full_text
         return one_shot_gen()
 
+PROVIDER_CALLS = {
+    "gemini": call_gemini,
+    "openai": call_openai,
+    "grok": call_grok,
+    "manus": call_manus,
+    "deepseek": call_deepseek,
+    "llama": call_llama,
+    "ollama": call_ollama,
+    "zhipu": call_zhipu
+}
+
+def is_provider_configured(provider):
+    """True if we hold credentials for the provider (Ollama is local and needs none)."""
+    keys = {
+        "gemini": GOOGLE_API_KEY,
+        "openai": OPENAI_API_KEY,
+        "grok": GROK_API_KEY,
+        "manus": os.getenv("MANUS_API_KEY"),
+        "deepseek": DEEPSEEK_API_KEY,
+        "llama": LLAMA_API_KEY,
+        "zhipu": ZHIPU_API_KEY,
+        "ollama": True
+    }
+    return bool(keys.get(provider))
+
+def provider_attempt_timeout(provider):
+    """Per-attempt timeout: local Ollama generation needs far longer than hosted APIs."""
+    return 120 if provider == "ollama" else 30
+
+def acquire_rate_budget(provider, prompt_tokens, timeout):
+    """
+    Wait for rate-limit budget (at most RATE_LIMIT_MAX_WAIT, and never longer
+    than the attempt's timeout). Returns the time left for the request itself,
+    so queueing and the call together stay within one attempt's budget.
+    """
+    waited = rate_limiter.acquire(provider, prompt_tokens, max_wait=min(rate_limiter.max_queue_wait, timeout))
+    return max(timeout - waited, 1.0)
+
+def call_provider(prompt, provider, endpoint=None):
+    """
+    Blocking call to a single provider (unknown names fall back to Gemini),
+    guarded by that provider's circuit breaker and retried per its retry policy.
+    `endpoint` lets Ollama size its output budget for the calling endpoint.
+    """
+    if provider not in PROVIDER_CALLS:
+        provider = "gemini"
+    breaker = circuit_breakers.get(provider)
+    breaker.before_call()
+    prompt_tokens = count_tokens(prompt)
+    token_ledger.check_prompt(provider, prompt_tokens, PROVIDER_CONTEXT_TOKENS.get(provider))
+
+    def attempt(timeout):
+        timeout = acquire_rate_budget(provider, prompt_tokens, timeout)
+        if provider == "ollama":
+            return call_ollama(prompt, timeout=timeout, endpoint=endpoint)
+        return PROVIDER_CALLS[provider](prompt, timeout=timeout)
+
+    try:
+        with usage_scope() as calls:
+            text = get_retry_policy(provider).run(attempt, provider, attempt_timeout=provider_attempt_timeout(provider))
+    except RateLimitExceeded:
+        # Shed locally before reaching the provider: says nothing about its health
+        breaker.release()
+        raise
+    except Exception as e:
+        breaker.record_failure(e)
+        raise
+    breaker.record_success()
+    token_ledger.record(provider, prompt_tokens, calls[-1] if calls else None, len(text or ""))
+    return text
+
+def pooled_stream(provider, prompt):
+    """
+    guarded_stream() for a request thread: holds one of the provider's pool
+    slots for the life of the stream, so streams count against the same
+    concurrency cap as blocking calls.
+    """
+    with provider_pool.slot(provider):
+        yield from guarded_stream(provider, prompt)
+
+def guarded_stream(provider, prompt, endpoint="stream_chat"):
+    """
+    Stream from a native streaming provider. Opening the stream (up to the
+    first chunk) is retried per the provider's retry policy; once text has
+    been sent, failures are not retried. Outcomes feed the circuit breaker,
+    and the call is accounted for once the stream ends (or is abandoned).
+    `endpoint` lets Ollama size its output budget for the calling endpoint.
+    """
+    breaker = circuit_breakers.get(provider)
+    breaker.before_call()
+    prompt_tokens = count_tokens(prompt)
+    token_ledger.check_prompt(provider, prompt_tokens, PROVIDER_CONTEXT_TOKENS.get(provider))
+    # Subscribers of a shared stream may pull from different threads, so usage
+    # is collected around each pull rather than across yields
+    calls = []
+
+    def open_stream(timeout):
+        timeout = acquire_rate_budget(provider, prompt_tokens, timeout)
+        if provider == "ollama":
+            stream = STREAM_PROVIDERS[provider](prompt, timeout=timeout, endpoint=endpoint)
+        else:
+            stream = STREAM_PROVIDERS[provider](prompt, timeout=timeout)
+        try:
+            return stream, next(stream)
+        except StopIteration:
+            return stream, None
+        except Exception:
+            stream.close()
+            raise
+
+    try:
+        with usage_scope(calls):
+            stream, first = get_retry_policy(provider).run(open_stream, provider, attempt_timeout=provider_attempt_timeout(provider))
+    except RateLimitExceeded:
+        breaker.release()
+        raise
+    except Exception as e:
+        breaker.record_failure(e)
+        raise
+
+    output_chars = 0
+    try:
+        if first is not None:
+            output_chars += len(first)
+            yield first
+        while True:
+            with usage_scope(calls):
+                chunk = next(stream, None)
+            if chunk is None:
+                break
+            output_chars += len(chunk)
+            yield chunk
+    except GeneratorExit:
+        # Consumer stopped early (race loser / client went away): not a provider failure
+        stream.close()
+        breaker.record_success()
+        raise
+    except Exception as e:
+        breaker.record_failure(e)
+        raise
+    finally:
+        token_ledger.record(provider, prompt_tokens, calls[-1] if calls else None, output_chars)
+    breaker.record_success()
+
+def run_provider_cancellable(provider, prompt, cancelled, endpoint=None):
+    """
+    Run a provider for a hedged race. Streaming providers are consumed chunk
+    by chunk so a losing request can be aborted (closing its HTTP response)
+    as soon as `cancelled` is set.
+    """
+    # Cancelled while it waited for a pool slot: don't open a request at all
+    if cancelled.is_set():
+        return None
+    if provider not in STREAM_PROVIDERS:
+        return call_provider(prompt, provider, endpoint)
+
+    stream = guarded_stream(provider, prompt, endpoint)
+    chunks = []
+    try:
+        for chunk in stream:
+            if cancelled.is_set():
+                return None
+            chunks.append(chunk)
+    finally:
+        stream.close()
+    return "".join(chunks)
+
+def call_provider_pooled(prompt, provider, endpoint=None, aborted=None):
+    """
+    Run call_provider on the shared provider pool. With `aborted`, streaming
+    providers are read chunk by chunk so the upstream request can be dropped,
+    freeing its pool slot, as soon as aborted() turns True.
+    """
+    if aborted is None:
+        return provider_pool.call(provider, call_provider, prompt, provider, endpoint)
+
+    stop = threading.Event()
+    future = provider_pool.submit(provider, run_provider_cancellable, provider, prompt, stop, endpoint)
+    while True:
+        try:
+            return future.result(timeout=0.2)
+        except concurrent.futures.TimeoutError:
+            if aborted():
+                stop.set()
+                # Still queued for a slot: it never starts
+                future.cancel()
+                raise concurrent.futures.CancelledError()
+
+def fallback_chain(provider, fallback=None):
+    """Providers to try in order: the requested one, then the configured chain."""
+    chain = [provider]
+    for candidate in (AI_FALLBACK_CHAIN if fallback is None else fallback):
+        if candidate not in chain and is_provider_configured(candidate):
+            chain.append(candidate)
+    return chain
+
+def race_options(data):
+    """
+    Read opt-in race mode from a request body.
+    Accepts `"race": {"secondary": "openai", "hedgeDelayMs": 800}` or
+    `"race": true` (uses AI_RACE_SECONDARY / AI_HEDGE_DELAY from the environment).
+    """
+    race = data.get("race")
+    if not race:
+        return None
+    if not isinstance(race, dict):
+        race = {}
+
+    secondary = race.get("secondary") or os.getenv("AI_RACE_SECONDARY")
+    if not secondary:
+        return None
+
+    hedge_delay = None
+    if race.get("hedgeDelayMs") is not None:
+        hedge_delay = float(race["hedgeDelayMs"]) / 1000.0
+    return {"secondary": secondary, "hedge_delay": hedge_delay}
+
 # Unified generator
-def generate_ai_response(prompt, provider="gemini"):
-    if provider == "openai":
-        return call_openai(prompt)
-    elif provider == "grok":
-        return call_grok(prompt)
-    elif provider == "manus":
-        return call_manus(prompt)
-    elif provider == "deepseek":
-        return call_deepseek(prompt)
-    elif provider == "llama":
-        return call_llama(prompt)
-    elif provider == "ollama":
-        return call_ollama(prompt)
-    elif provider == "zhipu":
-        return call_zhipu(prompt)
-    else:
-        return call_gemini(prompt)
+def generate_ai_response(prompt, provider="gemini", race=None, meta=None, fallback=None, cache=None,
+                         endpoint=None, cancel=None):
+    """
+    Generate a full response from `provider`, falling back along the
+    configured chain (AI_FALLBACK_CHAIN) if it fails or its circuit is open.
+    Concurrent calls with the same provider, model and prompt share one
+    upstream request.
+
+    Args:
+        race: Optional {"secondary": str, "hedge_delay": float|None}; fires the
+              prompt at the secondary provider too and returns the first success.
+        meta: Optional dict filled with details about how the response was produced
+              (provider used, cache hit, race winner, latency, fallbacks taken).
+        fallback: Override the fallback chain for this call ([] disables it).
+        cache: Endpoint name to serve/store this response from the response
+               cache (see cache_scope); None bypasses the cache.
+        endpoint: Calling endpoint, used to size the output budget (Ollama).
+        cancel: Optional threading.Event; once set (and no coalesced caller
+                still wants the answer) the provider request is dropped and
+                concurrent.futures.CancelledError is raised.
+    """
+    if meta is None:
+        meta = {}
+
+    if provider not in PROVIDER_CALLS:
+        provider = "gemini"
+
+    cache_key = make_cache_key(provider, PROVIDER_MODELS[provider], prompt)
+    # Manus starts a new task per call, so its replies are never reused
+    use_cache = cache and provider != "manus"
+    if use_cache:
+        cached, tier = response_cache.get(cache_key)
+        meta["cached"] = cached is not None
+        if cached is not None:
+            meta["provider"] = provider
+            meta["cache_tier"] = tier
+            print(f"Response cache hit ({tier}) for {cache} [{provider}]")
+            return cached
+
+    def leader(aborted):
+        leader_meta = {}
+        text = generate_uncached_response(prompt, provider, race, leader_meta, fallback, endpoint,
+                                          aborted if cancel is not None else None)
+        return text, leader_meta
+
+    with usage_scope() as calls:
+        (text, leader_meta), shared = single_flight.do(cache_key, leader, cancel=cancel)
+    meta.update(leader_meta)
+    if calls:
+        # Input tokens sent, how many of them hit the provider's prompt cache, and what it cost
+        meta["usage"] = usage_summary(calls)
+        meta["usage"]["cost_usd"] = round(sum(token_ledger.cost(c["provider"], c) for c in calls), 6)
+    if shared:
+        meta["coalesced"] = True
+        print(f"Coalesced with in-flight request [{provider}]")
+    # Only cache answers that really came from the requested provider
+    elif use_cache and meta.get("provider") == provider:
+        response_cache.set(cache_key, text)
+    return text
+
+def generate_uncached_response(prompt, provider, race, meta, fallback, endpoint=None, aborted=None):
+    """Call the provider (raced if requested), walking the fallback chain on failure."""
+    errors = {}
+    for candidate in fallback_chain(provider, fallback):
+        try:
+            if candidate == provider and race and race.get("secondary") and race["secondary"] != provider:
+                text = generate_raced_response(prompt, provider, race, meta, endpoint)
+            else:
+                text = call_provider_pooled(prompt, candidate, endpoint, aborted)
+                meta["provider"] = candidate
+        except concurrent.futures.CancelledError:
+            # Nobody wants the answer any more: don't fall back to another provider
+            raise
+        except Exception as e:
+            print(f"Provider {candidate} failed: {e}")
+            errors[candidate] = e
+            continue
+
+        if errors:
+            meta["fallback_from"] = provider
+            meta["fallback_errors"] = {name: str(error) for name, error in errors.items()}
+        return text
+
+    # Every provider in the chain failed: surface the requested provider's error
+    raise errors.get(provider) or next(iter(errors.values()))
+
+def generate_raced_response(prompt, provider, race, meta, endpoint=None):
+    def run(candidate, text, cancelled):
+        return run_provider_cancellable(candidate, text, cancelled, endpoint)
+
+    result = provider_racer.race(
+        prompt, provider, race["secondary"], run,
+        hedge_delay=race.get("hedge_delay")
+    )
+    meta.update({
+        "provider": result["winner"],
+        "race": {
+            "winner": result["winner"],
+            "hedged": result["hedged"],
+            "latency_ms": result["latency_ms"],
+            "latency_saved_ms": result["latency_saved_ms"]
+        }
+    })
+    print(f"Race won by {result['winner']} in {result['latency_ms']}ms (saved ~{result['latency_saved_ms']}ms)")
+    return result["text"]
+
+PROBE_TIMEOUT = 5
+GEMINI_MODELS_URL = GEMINI_API_URL.split("/models/")[0] + "/models"
+
+def status_from_probe(response):
+    """Map a probe response to the status vocabulary used by the sidebar."""
+    if response.status_code == 200:
+        return "ok"
+    elif response.status_code == 429:
+        return "quota_exceeded"
+    elif response.status_code == 402:
+        return "usage_limit"
+    elif response.status_code in (401, 403):
+        return "no_credits"
+    return "error"
 
 def check_provider_status(provider_name):
-    """Test a provider with a minimal prompt to check for auth/quota errors."""
+    """
+    Cheap probe of a provider's availability and credentials.
+    Uses model-list/metadata endpoints (Ollama: /api/tags) instead of a paid generation.
+    """
     try:
         if provider_name == "gemini":
-             # Use a very short timeout for check
-             # Gemini doesn't have a cheap 'check' endpoint easily without valid payload, 
-             # but we can try a dry run or minimal gen.
-             # Actually, best to just return 'ok' if we don't assume state, 
-             # but user specifically wants to know about Credit Limits.
-             # We must try a generation.
-             call_gemini("Hi")
+             if not GOOGLE_API_KEY: return "missing_key"
+             response = http_client.get("gemini", f"{GEMINI_MODELS_URL}/{PROVIDER_MODELS['gemini']}?key={GOOGLE_API_KEY}", timeout=PROBE_TIMEOUT)
         elif provider_name == "openai":
-             call_openai("Hi")
+             if not OPENAI_API_KEY: return "missing_key"
+             response = http_client.get("openai", f"https://api.openai.com/v1/models/{PROVIDER_MODELS['openai']}",
+                                        headers={"Authorization": f"Bearer {OPENAI_API_KEY}"}, timeout=PROBE_TIMEOUT)
         elif provider_name == "grok":
-             call_grok("Hi")
+             if not GROK_API_KEY: return "missing_key"
+             response = http_client.get("grok", "https://api.x.ai/v1/models",
+                                        headers={"Authorization": f"Bearer {GROK_API_KEY}"}, timeout=PROBE_TIMEOUT)
         elif provider_name == "manus":
-             # Manus requires task, might be expensive/slow. 
-             # Maybe skip or just check if Key is present?
-             if not os.getenv("MANUS_API_KEY"): raise Exception("No Key")
+             # Manus only has task creation, which is slow and billed: check the key only
+             return "ok" if os.getenv("MANUS_API_KEY") else "missing_key"
         elif provider_name == "deepseek":
-             call_deepseek("Hi")
+             if not DEEPSEEK_API_KEY: return "missing_key"
+             response = http_client.get("deepseek", "https://api.deepseek.com/user/balance",
+                                        headers={"Authorization": f"Bearer {DEEPSEEK_API_KEY}"}, timeout=PROBE_TIMEOUT)
+             if response.status_code == 200 and not response.json().get("is_available", True):
+                  return "usage_limit"
         elif provider_name == "llama":
-             call_llama("Hi")
+             if not LLAMA_API_KEY: return "missing_key"
+             response = http_client.get("llama", "https://api.groq.com/openai/v1/models",
+                                        headers={"Authorization": f"Bearer {LLAMA_API_KEY}"}, timeout=PROBE_TIMEOUT)
         elif provider_name == "ollama":
-             # Basic check if running
-             requests.get("http://localhost:11434", timeout=2)
+             response = http_client.get("ollama", "http://localhost:11434/api/tags", timeout=PROBE_TIMEOUT)
         elif provider_name == "zhipu":
-             call_zhipu("Hi")
-             
-        return "ok"
-    except Exception as e:
-        msg = str(e)
-        if "429" in msg or "Quota" in msg or "Exhausted" in msg:
-             return "quota_exceeded"
-        elif "402" in msg or "Insufficient Balance" in msg:
-             return "usage_limit" 
-        elif "403" in msg or "Permission" in msg:
-             return "no_credits" 
-        elif "Key" in msg and "missing" in msg:
-             return "missing_key"
-        elif "Connection" in msg or "refused" in msg or "Failed to establish" in msg:
-             return "offline"
+             if not ZHIPU_API_KEY: return "missing_key"
+             # No model-list endpoint: validate the key locally and check the host is reachable
+             generate_zhipu_token(ZHIPU_API_KEY)
+             http_client.get("zhipu", "https://open.bigmodel.cn", timeout=PROBE_TIMEOUT)
+             return "ok"
+        else:
+             return "error"
+
+        return status_from_probe(response)
+    except requests.exceptions.RequestException:
+        return "offline"
+    except Exception:
         return "error"
 
+MONITORED_PROVIDERS = ["gemini", "openai", "grok", "deepseek", "llama", "ollama", "zhipu", "manus"]
+health_monitor = get_health_monitor(MONITORED_PROVIDERS, check_provider_status)
+
 @app.route("/api/models/status", methods=["GET"])
 def get_models_status():
-    providers = ["gemini", "openai", "grok", "deepseek", "llama", "ollama", "zhipu", "manus"] 
-    
-    
-    # Run checks in parallel
-    results = {}
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        future_to_provider = {executor.submit(check_provider_status, p): p for p in providers}
-        for future in concurrent.futures.as_completed(future_to_provider):
-            p = future_to_provider[future]
-            try:
-                status = future.result()
-                results[p] = status
-            except Exception:
-                results[p] = "error"
-                
-    return jsonify(results)
+    """
+    Latest cached provider statuses from the background health monitor.
+    `?detail=1` adds last-checked timestamps and probe latency per provider.
+    """
+    health_monitor.start()
+    # Until the first round lands the snapshot is empty and the sidebar (which
+    # fetches once on mount) would stay grey, so wait for it (probes time out)
+    health_monitor.wait_for_first_round(PROBE_TIMEOUT + 1)
+    body, etag, last_modified = health_monitor.snapshot(detail=request.args.get("detail") == "1")
+
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype="application/json")
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    if last_modified:
+        response.headers["Last-Modified"] = last_modified
+    return response
 
 @app.route("/api/health", methods=["GET"])
 def health_check():
     return jsonify({
         "status": "ok", 
         "service": "AI Word Assistant Backend (Flask + REST)",
-        "active_sessions": len(sessions)
+        "active_sessions": session_store.count(),
+        "http_pools": http_client.get_stats(),
+        "races": provider_racer.get_stats(),
+        "circuit_breakers": circuit_breakers.get_stats(),
+        "rate_limits": rate_limiter.get_stats(),
+        "response_cache": response_cache.get_stats(),
+        "provider_pool": provider_pool.get_stats(),
+        "single_flight": single_flight.get_stats(),
+        "ollama": ollama_runtime.get_stats(),
+        "streams": stream_stats.get_stats(),
+        "supersession": supersession.get_stats(),
+        "session_store": session_store.get_stats(),
+        "summarizer": summarizer.get_stats(),
+        "token_usage": token_ledger.get_stats()["total"],
+        "ingestion": ingestion_queue.get_stats(),
+        "extraction": extraction_engine.get_stats(),
+        "prompt_cache": {
+            "providers": prompt_cache_stats.get_stats(),
+            "gemini_context_cache": gemini_context_cache.get_stats()
+        }
     })
 
+@app.route("/api/usage", methods=["GET"])
+def usage_report():
+    """Token and cost totals: the caller's session, plus per provider and endpoint."""
+    session_id = request.headers.get('X-Session-ID')
+    report = token_ledger.get_stats()
+    report["session"] = token_ledger.session_usage(session_id) if session_id else None
+    report["top_sessions"] = token_ledger.top_sessions()
+    report["prompt_cache"] = prompt_cache_stats.get_stats()
+    return jsonify(report)
+
 @app.route("/api/generate_card_image", methods=["POST"])
 def generate_card_image():
     """Generate AI image for card design"""
@@ -613,6 +1373,8 @@ def generate_card_image():
         result = image_service.generate_image(user_prompt, style)
         
         if result.get('success'):
+            if result['cost']:
+                token_ledger.record_spend("image", result['cost'])
             return jsonify({
                 'image_base64': result['image_base64'],
                 'cached': result['cached'],
@@ -643,8 +1405,9 @@ def upload_files():
         return jsonify({"error": "No files provided"}), 400
 
     files = request.files.getlist('files')
-    new_text_content = ""
+    new_documents = []
     new_images = []
+    extractions = []
 
     # New: Collect metadata for frontend references list
     uploaded_docs_metadata = []
@@ -657,93 +1420,35 @@ def upload_files():
         save_path = os.path.join(UPLOAD_FOLDER, unique_name)
         file.save(save_path)
 
-        # File processing logic
-        file_text = ""
-        abstract_summary = "No abstract content detected."
-
         # Create URL (assuming localhost for now - in prod use actual domain)
         # Use request.host_url to be more dynamic
         base_url = request.host_url.rstrip('/')
         file_url = f"{base_url}/uploads/{unique_name}"
 
-        # Metadata extraction
-        year = "2024"
-        author = "Unknown Author"
-        title = filename
-
-        if filename.lower().endswith('.pdf'):
-            try:
-                reader = PyPDF2.PdfReader(save_path)
-                if reader.metadata:
-                    if reader.metadata.get('/Author'):
-                        author = reader.metadata.get('/Author')
-                    if reader.metadata.get('/Title'):
-                        title = reader.metadata.get('/Title')
-                
-                # extracting text from all pages
-                for page in reader.pages:
-                    extracted = page.extract_text()
-                    if extracted:
-                        file_text += extracted + "\n"
-
-                # Heuristic for abstract
-                text_start = file_text[:2000]
-                if "Abstract" in text_start:
-                    parts = text_start.split("Abstract")
-                    if len(parts) > 1:
-                        abstract_summary = parts[1][:500].strip() + "..."
-                else:
-                    abstract_summary = file_text[:300].strip() + "..."
-
-            except Exception as e:
-                print(f"Error reading PDF {filename}: {e}")
-
-        elif filename.lower().endswith('.txt'):
-            try:
-                with open(save_path, 'r', encoding='utf-8') as f:
-                    file_text = f.read()
-                    abstract_summary = file_text[:300].strip() + "..."
-            except Exception as e:
-                print(f"Error reading TXT {filename}: {e}")
-        
-        elif filename.lower().endswith('.docx'):
-            if HAS_DOCX:
-                try:
-                    doc = Document(save_path)
-                    # Extract Core Properties
-                    if doc.core_properties.author:
-                        author = doc.core_properties.author
-                    if doc.core_properties.title:
-                        title = doc.core_properties.title
-                    
-                    file_text = "\n".join([para.text for para in doc.paragraphs])
-                    abstract_summary = file_text[:300].strip() + "..."
-                except Exception as e:
-                    print(f"Error reading DOCX {filename}: {e}")
-                    file_text += f"[Error processing DOCX: {e}]\n"
-                    abstract_summary = "Error processing DOCX."
-            else:
-                 file_text += "[DOCX support disabled on server]\n"
-                 abstract_summary = "DOCX processing disabled."
-
-        # Construct a real citation string to help Gemini
-        citation = f"{author} ({year}). *{title}*."
-
+        # Text and metadata are extracted in the background (see ingest_document)
+        extractable = is_extractable(filename)
         doc_metadata = {
             "name": original_filename,
-            "author": author,
-            "title": title,
-            "citation": citation,
-            "summary": abstract_summary,
+            "author": "Unknown Author",
+            "title": filename,
+            "citation": f"Unknown Author ({UPLOAD_YEAR}). *{filename}*.",
+            "summary": "Extracting text..." if extractable else "No abstract content detected.",
             "size": os.path.getsize(save_path),
-            "url": file_url 
+            "url": file_url,
+            "status": "processing" if extractable else "ready"
         }
+        document = new_document(original_filename, "", doc_metadata)
+        document["chunks"] = []
+        doc_metadata["id"] = document["id"]
+        if extractable:
+            # Stored with the record so a restarted server can resume the job
+            document["ingest"] = {"jobId": uuid.uuid4().hex, "path": save_path, "file": filename,
+                                  "owner": process_owner()}
+            doc_metadata["jobId"] = document["ingest"]["jobId"]
+            extractions.append(document)
+        new_documents.append(document)
         uploaded_docs_metadata.append(doc_metadata)
 
-        if file_text:
-            # Inject metadata into the text stream so Gemini sees it right next to the content
-            new_text_content += f"\n--- Start of Document ---\nMetadata: Filename='{original_filename}', Title='{title}', Author='{author}'\nContent:\n{file_text}\n--- End of Document ---\n"
-
         # Image handling
         if filename.lower().endswith(('.png', '.jpg', '.jpeg', '.webp')):
              new_images.append({
@@ -751,26 +1456,218 @@ def upload_files():
                 "url": file_url
             })
 
-    # Update Session
-    session['context'] += new_text_content
-    session['images'].extend(new_images)
-    session['docs'].extend(uploaded_docs_metadata) # Store metadata in session too
+    # Update Session (concurrent uploads to one session must not lose documents)
+    def add_uploads(session):
+        for document in new_documents:
+            add_document(session, document)
+        session['images'].extend(new_images)
+        session['docs'].extend(uploaded_docs_metadata) # Store metadata in session too
+    update_session(session_id, add_uploads)
+
+    # Records exist now, so a job can never finish before its document is stored
+    jobs = [submit_ingestion(session_id, document).snapshot() for document in extractions]
 
-    # Trim context if too large (simple optimized limit)
-    # Reduced from 100k to 50k for speed
-    MAX_CONTEXT_CHARS = 50000
-    if len(session["context"]) > MAX_CONTEXT_CHARS:
-        session["context"] = session["context"][-MAX_CONTEXT_CHARS:]
-        
     return jsonify({
         "status": "success", 
-        "message": f"Processed {len(files)} files",
-        "context_length": len(session["context"]),
+        "message": f"Received {len(files)} files" + (f", extracting {len(jobs)} in the background" if jobs else ""),
+        "context_length": documents_size(session),
         "images": new_images,
         "documents": uploaded_docs_metadata,
+        "jobs": jobs,
         "session_id": session_id
     })
 
+def submit_ingestion(session_id, document, resumed=False):
+    """Queue extraction of a stored document record under its ingest job id."""
+    ingest = document["ingest"]
+    return ingestion_queue.submit(
+        session_id, document["id"], document["name"], document["size"],
+        lambda job, doc_id=document["id"]: ingest_document(job, session_id, doc_id, ingest["path"], ingest["file"]),
+        job_id=ingest["jobId"] if resumed else None
+    )
+
+def set_document_fields(session, doc_id, updates):
+    """Apply updates to a document record and its entry in the session's display metadata."""
+    document = find_document(session, doc_id)
+    if document is not None:
+        document.update(updates)
+    for meta in session['docs']:
+        if meta.get("id") == doc_id:
+            meta.update(updates)
+    return document
+
+def resume_stale_ingestion(session_id, session):
+    """
+    Documents left "processing" by a server process that has since exited
+    (restart, crashed worker) would otherwise wait forever: re-queue their
+    extraction under the same job id, or mark them failed if the uploaded
+    file is gone. Returns how many stale documents were found.
+    """
+    stale = [doc["id"] for doc in session.get("documents", {}).values()
+             if doc.get("status") == "processing" and not owner_alive(doc.get("ingest", {}).get("owner"))]
+    if not stale:
+        return 0
+
+    resumed = []
+    def claim(session):
+        resumed.clear()
+        for doc_id in stale:
+            document = find_document(session, doc_id)
+            if document is None or document.get("status") != "processing":
+                continue
+            ingest = document.get("ingest") or {}
+            # Another worker may have claimed it since we looked
+            if owner_alive(ingest.get("owner")):
+                continue
+            if ingest.get("path") and os.path.exists(ingest["path"]):
+                ingest["owner"] = process_owner()
+                resumed.append(dict(document))
+            else:
+                set_document_fields(session, doc_id, {
+                    "summary": "Error processing document: extraction was interrupted. Please re-upload it.",
+                    "status": "failed"
+                })
+    update_session(session_id, claim)
+
+    for document in resumed:
+        submit_ingestion(session_id, document, resumed=True)
+        print(f"Resumed ingestion of {document['name']} (job {document['ingest']['jobId']})")
+    return len(stale)
+
+def ingest_document(job, session_id, doc_id, save_path, filename):
+    """
+    Ingestion worker: extract one uploaded file and fill in its document
+    record (text, page offsets, chunks, metadata). Returns the updated
+    display metadata for the job status.
+    """
+    try:
+        result = extraction_engine.extract(save_path, filename, progress=job.progress)
+        text = result["text"]
+        updates = {
+            "author": result["author"],
+            "title": result["title"],
+            # Construct a real citation string to help Gemini
+            "citation": f"{result['author']} ({UPLOAD_YEAR}). *{result['title']}*.",
+            "summary": result["summary"],
+            "status": "ready"
+        }
+        # Chunk once at ingest; chat/generate retrieve from these chunks
+        chunks = chunk_document(text, result["page_offsets"]) if text else []
+    except Exception:
+        updates = {"summary": "Error processing document.", "status": "failed"}
+        text, result, chunks = "", None, []
+        raise
+    finally:
+        def store_extraction(session):
+            document = set_document_fields(session, doc_id, updates)
+            if document is not None and result is not None:
+                document.update(text=text, page_offsets=result["page_offsets"], chunks=chunks)
+        update_session(session_id, store_extraction)
+
+    print(f"Ingested {filename}: {result['pages']} pages, {len(text)} chars")
+    return {"id": doc_id, "name": job.name, **updates}
+
+@app.route("/api/upload/jobs", methods=["GET"])
+def list_upload_jobs():
+    session_id = request.headers.get('X-Session-ID')
+    if not session_id:
+        return jsonify({"error": "Missing X-Session-ID header"}), 400
+    return jsonify({"jobs": ingestion_queue.for_session(session_id)})
+
+def persisted_job(session_id, job_id):
+    """
+    Status of a job this process does not track (expired, run by another
+    worker, or lost in a restart), rebuilt from the session's document
+    record. None if no document of the session has that job id.
+    """
+    session = get_session(session_id)
+    document = next((doc for doc in session.get("documents", {}).values()
+                     if doc.get("ingest", {}).get("jobId") == job_id), None)
+    if document is None:
+        return None
+    if document.get("status") == "processing" and resume_stale_ingestion(session_id, session):
+        # Either re-queued here or marked failed
+        job = ingestion_queue.get(job_id)
+        if job is not None:
+            return job
+        session = get_session(session_id)
+        document = find_document(session, document["id"]) or document
+
+    status = document.get("status")
+    meta = next((meta for meta in session['docs'] if meta.get("id") == document["id"]), {})
+    return {
+        "jobId": job_id,
+        "docId": document["id"],
+        "name": document["name"],
+        "status": "extracting" if status == "processing" else status,
+        "pagesDone": 0,
+        "pagesTotal": None,
+        "bytesTotal": document.get("size"),
+        "bytesDone": document.get("size") if status == "ready" else 0,
+        "etaSeconds": None,
+        "elapsedSeconds": None,
+        "error": document.get("summary") if status == "failed" else None,
+        "document": {"id": document["id"], "name": document["name"], **{
+            key: meta.get(key, document.get(key)) for key in ("author", "title", "citation", "summary", "status")
+        }} if status == "ready" else None
+    }
+
+def session_job(session_id, job_id):
+    """A job's status if it belongs to the session: live from the queue, else from the document record."""
+    owner = ingestion_queue.owner(job_id)
+    if owner is not None:
+        return ingestion_queue.get(job_id) if owner == session_id else None
+    return persisted_job(session_id, job_id)
+
+@app.route("/api/upload/jobs/<job_id>", methods=["GET"])
+def get_upload_job(job_id):
+    session_id = request.headers.get('X-Session-ID')
+    if not session_id:
+        return jsonify({"error": "Missing X-Session-ID header"}), 400
+    job = session_job(session_id, job_id)
+    if job is None:
+        return jsonify({"error": "Unknown or expired job"}), 404
+    return jsonify(job)
+
+@app.route("/api/upload/jobs/<job_id>/events", methods=["GET"])
+def stream_upload_job(job_id):
+    """Server-sent events with the job's progress until it is ready or failed."""
+    session_id = request.headers.get('X-Session-ID')
+    if not session_id:
+        return jsonify({"error": "Missing X-Session-ID header"}), 400
+    job = session_job(session_id, job_id)
+    if job is None:
+        return jsonify({"error": "Unknown or expired job"}), 404
+    if ingestion_queue.owner(job_id) is None:
+        # Not running here: report the persisted status once
+        return Response(f"data: {json.dumps(job)}\n\n", mimetype='text/event-stream', headers={"Cache-Control": "no-cache"})
+
+    def events():
+        version = -1
+        while True:
+            change = ingestion_queue.wait_for_change(job_id, version)
+            if change is None:
+                return
+            version, snapshot = change
+            yield f"data: {json.dumps(snapshot)}\n\n"
+            if snapshot["status"] in ("ready", "failed"):
+                return
+
+    return Response(events(), mimetype='text/event-stream', headers={"Cache-Control": "no-cache"})
+
+CHAT_INSTRUCTIONS = """
+Instructions:
+- **Role**: Expert Research Assistant.
+- **Tone**: Professional, clear, and high-quality.
+- **Formatting**: Use detailed HTML.
+  - `<h1>`, `<h2>` for structure.
+  - `<p>` for paragraphs.
+  - `<ul>/<li>` for lists.
+  - `<table border="1" style="border-collapse: collapse; width: 100%;">` for data comparisons.
+- **Images**: If applicable, embed images using `<img src="URL" style="max-width:100%; height:auto;" />`.
+- **Accuracy**: Base answers strictly on the provided context if possible.
+""".strip()
+
 @app.route("/api/chat", methods=["POST"])
 def chat_endpoint():
     session_id = request.headers.get('X-Session-ID')
@@ -781,54 +1678,59 @@ def chat_endpoint():
     data = request.json
     message = data.get("message")
     
-    # Use session context
-    context = session.get("context", "")
-    images = session.get("images", [])
-    
     provider = data.get("modelProvider", "gemini")
+
+    # Use session context (optionally only the documents the client selected), sized for the model
+    context, context_report = document_context(session_id, session, provider, data, message or "", "chat")
+    images = session.get("images", [])
     
     try:
         # Construct a prompt that knows about images
         image_context = "\n".join([f"Image '{img['name']}' available at: {img['url']}" for img in images])
         
         if context or image_context:
-            prompt = f"""
-            Context from uploaded documents:
-            {context}
-            
-            Available Images:
-            {image_context}
-            
-            User Question: {message}
-            
-            Instructions:
-            - **Role**: Expert Research Assistant.
-            - **Tone**: Professional, clear, and high-quality.
-            - **Formatting**: Use detailed HTML.
-              - `<h1>`, `<h2>` for structure.
-              - `<p>` for paragraphs.
-              - `<ul>/<li>` for lists.
-              - `<table border="1" style="border-collapse: collapse; width: 100%;">` for data comparisons.
-            - **Images**: If applicable, embed images using `<img src="URL" style="max-width:100%; height:auto;" />`.
-            - **Accuracy**: Base answers strictly on the provided context if possible.
-            """
+            # Fixed instructions first, then documents, then the question, so
+            # questions about the same documents share a cacheable prefix
+            prompt = LayeredPrompt(
+                CHAT_INSTRUCTIONS,
+                f"User Question: {message}",
+                context=f"Context from uploaded documents:\n{context}\n\nAvailable Images:\n{image_context}",
+                cacheable=context_is_stable(context_report)
+            )
         else:
             prompt = message
             
-        response_text = generate_ai_response(prompt, provider)
-        return jsonify({"reply": response_text})
+        meta = {"context": context_report}
+        response_text = generate_ai_response(prompt, provider, race=race_options(data), meta=meta,
+                                             cache=cache_scope("chat", data), endpoint="chat")
+        return jsonify({"reply": response_text, "meta": meta})
     except Exception as e:
-        error_msg = str(e)
-        status_code = 500
-        if "429" in error_msg or "Quota" in error_msg:
-            status_code = 429
-        elif "403" in error_msg:
-            status_code = 403
-            
-        response = jsonify({"error": error_msg})
-        response.status_code = status_code
-        response.headers.add('Access-Control-Allow-Origin', '*')
-        return response
+        return ai_error_response(e)
+
+REPORT_INSTRUCTIONS = """
+You write comprehensive professional research reports to the specification given by the user.
+
+**STRUCTURE & FORMATTING:**
+Generate a research report following this structure. 
+**Use Standard Markdown Formatting.**
+
+STRICT RESPONSE FORMATTING RULES (CRITICAL):
+1. **Output ONLY the report content.** Do not include "Here is your report" or similar.
+2. Start with `# Title`.
+3. Use `## Section` and `### Subsection`.
+4. Use `**bold**` for key terms.
+5. Use `- ` for bullet points.
+6. Use ` ```language ` for code blocks.
+7. **CRITICAL**: Insert **DOUBLE NEWLINES** between every section, paragraph, and header.
+
+Report Structure:
+1. **# Report Title**
+2. **## Executive Summary**
+3. **## Introduction**
+4. **## Findings & Analysis**
+5. **## Recommendations**
+6. **## Conclusion**
+""".strip()
 
 @app.route("/api/generate", methods=["POST"])
 def generate_report():
@@ -853,11 +1755,15 @@ def generate_report():
     # Construct the Prompt
     image_context = "\n".join([f"Image '{img['name']}' available at: {img['url']}" for img in session['images']])
     
+    provider = data.get("modelProvider", "gemini")
+    query = " ".join(str(part) for part in [topic, purpose, *key_points] if part)
+    context, context_report = document_context(session_id, session, provider, data, query, "generate")
     context_str = ""
-    if session['context'] or image_context:
-        context_str = f"\nUse these uploaded documents as context/source material:\n{session['context']}\n\nAvailable Images:\n{image_context}\n"
+    if context or image_context:
+        context_str = f"Use these uploaded documents as context/source material:\n{context}\n\nAvailable Images:\n{image_context}"
     
-    prompt = f"""
+    # Report-independent rules first, then documents, then this report's specification
+    request_text = f"""
     Act as an expert {data.get('role', 'Senior Data Analyst/Researcher')}. You are preparing a comprehensive professional report for {data.get('audience', 'Executive Stakeholders')}.
 
     **REPORT SPECIFICATIONS:**
@@ -866,29 +1772,6 @@ def generate_report():
     - **Key Data/Content Requirements:** 
     {chr(10).join([f"  * {point}" for point in key_points]) if key_points else "  * Detailed analysis of key metrics\n  * Strategic insights\n  * Data-driven recommendations"}
 
-    {context_str}
-
-    **STRUCTURE & FORMATTING:**
-    Generate a research report following this structure. 
-    **Use Standard Markdown Formatting.**
-    
-    STRICT RESPONSE FORMATTING RULES (CRITICAL):
-    1. **Output ONLY the report content.** Do not include "Here is your report" or similar.
-    2. Start with `# Title`.
-    3. Use `## Section` and `### Subsection`.
-    4. Use `**bold**` for key terms.
-    5. Use `- ` for bullet points.
-    6. Use ` ```language ` for code blocks.
-    7. **CRITICAL**: Insert **DOUBLE NEWLINES** between every section, paragraph, and header.
-
-    Report Structure:
-    1. **# Report Title**
-    2. **## Executive Summary**
-    3. **## Introduction**
-    4. **## Findings & Analysis**
-    5. **## Recommendations**
-    6. **## Conclusion**
-
     **Content Requirements**:
     - Tone: {tone}
     - Perspective: Third-person professional.
@@ -897,25 +1780,25 @@ def generate_report():
     { " - Include a Markdown Table for data comparison." if include_table else "" }
     { " - If asked to visualize, describe the diagram textually." if include_mermaid else "" }
     """
+    prompt = LayeredPrompt(REPORT_INSTRUCTIONS, request_text, context=context_str,
+                           cacheable=context_is_stable(context_report))
 
-    provider = data.get("modelProvider", "gemini")
-
+    # Latest wins: a newer report request from this session cancels this one
+    ticket = supersession.begin(session_id, "generate")
     try:
-        response_text = generate_ai_response(prompt, provider)
+        meta = {"context": context_report}
+        response_text = generate_ai_response(prompt, provider, race=race_options(data), meta=meta,
+                                             cache=cache_scope("generate", data), endpoint="generate",
+                                             cancel=ticket.cancelled)
+        ticket.check()
         html_response = markdown_to_html(response_text)
-        return jsonify({"content": html_response})
+        return jsonify({"content": html_response, "meta": meta})
+    except concurrent.futures.CancelledError:
+        return ai_error_response(Superseded("generate"))
     except Exception as e:
-        error_msg = str(e)
-        status_code = 500
-        if "429" in error_msg or "Quota" in error_msg:
-            status_code = 429
-        elif "403" in error_msg:
-            status_code = 403
-            
-        response = jsonify({"error": error_msg})
-        response.status_code = status_code
-        response.headers.add('Access-Control-Allow-Origin', '*')
-        return response
+        return ai_error_response(e)
+    finally:
+        supersession.finish(ticket)
 
 @app.route("/api/summarize", methods=["POST"])
 def summarize_document():
@@ -926,32 +1809,29 @@ def summarize_document():
     session = get_session(session_id)
     data = request.json
     filename = data.get("filename")
+    doc_id = data.get("docId")
     
-    if not filename:
+    if not filename and not doc_id:
          return jsonify({"error": "Filename required"}), 400
 
-    target_content = ""
-    # Parse context to find specific document
-    try:
-        if session['context']:
-            doc_blocks = session['context'].split("--- Start of Document ---")
-            for block in doc_blocks:
-                # robust check for the specific file
-                if f"Filename='{filename}'" in block:
-                    parts = block.split("Content:")
-                    if len(parts) > 1:
-                         target_content = parts[1].split("--- End of Document ---")[0]
-                         break
-    except Exception:
-        pass
+    # docId picks one exact upload; a filename resolves to its latest upload
+    document = find_document(session, doc_id, filename)
+    target_content = document["text"] if document else ""
+
+    if document and document.get("status") == "processing":
+        resume_stale_ingestion(session_id, session)
+        return jsonify({"error": "This document is still being processed. Try again when its upload finishes."}), 409
 
     if not target_content:
             return jsonify({"error": "Document content not found. Server may have restarted. Please re-upload your files."}), 404
             
-    # Limit content for summary
-    target_content = target_content[:30000] 
-    
-    prompt = f"""
+    provider = data.get("modelProvider", "gemini")
+    race = race_options(data)
+    cache = cache_scope("summarize", data)
+    doc_id = document["id"]
+
+    def final_prompt(content):
+        return f"""
     Task: Summarize the following academic/technical document.
     
     Instructions:
@@ -963,24 +1843,73 @@ def summarize_document():
     3. Keep it professional and concise.
     
     Document Content:
-    {target_content}
+    {content}
     """
-    
-    provider = data.get("modelProvider", "gemini")
-    
-    try:
-        summary = generate_ai_response(prompt, provider)
-        return jsonify({"summary": summary})
-    except Exception as e:
-        print(f"Summarization error: {e}")
-        error_msg = str(e)
-        status_code = 500
-        if "429" in error_msg or "Quota" in error_msg:
-            status_code = 429
-        elif "403" in error_msg:
-            status_code = 403
-            
-        return jsonify({"error": error_msg}), status_code
+
+    def run(progress=None):
+        """Summarize (map-reduce when the document is long) and keep the result on the record."""
+        meta = {}
+        calls = []
+
+        def generate(prompt):
+            call_meta = {}
+            text = generate_ai_response(prompt, provider, race=race, meta=call_meta,
+                                        cache=cache, endpoint="summarize")
+            calls.append(call_meta)
+            return text
+
+        result = summarizer.summarize(target_content, generate, final_prompt, progress)
+        # Provider/cache details of the final call, plus how the summary was built
+        meta.update(calls[-1] if calls else {})
+        meta["summary"] = {
+            "mode": result["mode"], "sections": result["sections"], "rounds": result["rounds"],
+            "calls": len(calls), "cached_calls": sum(1 for c in calls if c.get("cached"))
+        }
+
+        # Later prompts can stand in this summary for the full text (see build_document_context)
+        def store_summary(current):
+            doc = find_document(current, doc_id)
+            if doc is not None:
+                doc["ai_summary"] = result["summary"]
+        update_session(session_id, store_summary)
+        return result["summary"], meta
+
+    if not data.get("stream"):
+        try:
+            summary, meta = run()
+            return jsonify({"summary": summary, "meta": meta})
+        except Exception as e:
+            print(f"Summarization error: {e}")
+            return ai_error_response(e)
+
+    # NDJSON progress: {"type": "progress", "phase": "map"|"reduce"|"final", "done", "total"}
+    # events while sections are summarized, then one "summary" (or "error") event
+    events = queue.Queue()
+
+    def worker():
+        try:
+            summary, meta = run(lambda event: events.put({"type": "progress", **event}))
+            events.put({"type": "summary", "summary": summary, "meta": meta})
+        except Exception as e:
+            print(f"Summarization error: {e}")
+            error = {"type": "error", "error": str(e)}
+            if isinstance(e, PoolSaturated):
+                error["retryAfter"] = e.retry_after
+            events.put(error)
+
+    # The worker keeps this request's context so its calls are attributed to the session
+    threading.Thread(target=contextvars.copy_context().run, args=(worker,), daemon=True,
+                     name="summarize-stream").start()
+
+    def stream():
+        writer = NDJSONWriter()
+        while True:
+            event = events.get()
+            yield writer.write(event)
+            if event["type"] != "progress":
+                return
+
+    return Response(stream(), mimetype='application/x-ndjson')
 
 @app.route("/api/refine", methods=["POST"])
 def refine_text():
@@ -1012,20 +1941,62 @@ def refine_text():
     provider = data.get("modelProvider", "gemini")
 
     try:
-        rewritten = generate_ai_response(prompt, provider)
-        return jsonify({"content": rewritten})
+        meta = {}
+        rewritten = generate_ai_response(prompt, provider, race=race_options(data), meta=meta,
+                                         cache=cache_scope("refine", data), endpoint="refine")
+        return jsonify({"content": rewritten, "meta": meta})
     except Exception as e:
         print(f"Refine error: {e}")
-        error_msg = str(e)
-        status_code = 500
-        if "429" in error_msg or "Quota" in error_msg:
-            status_code = 429
-        elif "403" in error_msg:
-            status_code = 403
-            
-        return jsonify({"error": error_msg}), status_code
-
-        return jsonify({"error": error_msg}), status_code
+        return ai_error_response(e)
+
+STREAM_CHAT_INSTRUCTIONS = """
+SYSTEM INSTRUCTION: You are an expert professional writer and technical communicator.
+Your task is to create COMPREHENSIVE, DETAILED content that thoroughly addresses the user's request.
+
+CONTENT QUALITY REQUIREMENTS:
+- Be THOROUGH and DETAILED - provide in-depth explanations
+- Include relevant context, background, and examples
+- Use clear, professional language
+- Organize information logically with good flow
+- NO FILLER phrases like "Here is your report" - start directly with content
+
+FORMATTING RULES:
+1. **Markdown Structure**: Use `# Title`, `## Sections`, `### Subsections`
+2. **Lists**: Use `- Item` for unordered, `1.` for ordered
+3. **Tables**: Use markdown tables `| Col | Col |` for comparisons and data
+4. **Emphasis**: Use **bold** for key terms, *italic* for emphasis
+5. **Code**: Use `inline code` for technical terms
+
+DIAGRAMS - MULTIPLE DIAGRAMS ENCOURAGED:
+When the topic benefits from visual explanation, create MULTIPLE diagrams to show:
+- Overall architecture/system view
+- Component details
+- Process flows
+- Relationships between concepts
+
+Each diagram MUST:
+1. Output ONLY raw Excalidraw JSON - NO markdown wrappers, NO explanations
+2. Have CLEAR labels on every shape (centered inside)
+3. Use professional spacing (50px+ between elements)
+4. Use color coding: Blues (#a5d8ff) for primary, Green (#51cf66) for success/data, Yellow (#ffd43b) for warnings/highlights, Gray (#e9ecef) for secondary
+5. Be positioned separately (start each new diagram at y: 0 or y: 600+ to avoid overlap)
+
+DIAGRAM FORMAT:
+{"type": "excalidraw", "version": 2, "source": "AI", "elements": [rectangles, ellipses, diamonds, arrows, text_labels]}
+
+REQUIRED SHAPE PROPERTIES:
+{"id": "shape_id", "type": "rectangle|ellipse|diamond", "x": 100, "y": 100, "width": 180, "height": 100, "angle": 0, "strokeColor": "#1e1e1e", "backgroundColor": "#a5d8ff", "fillStyle": "solid", "strokeWidth": 2, "roughness": 1, "opacity": 100, "seed": 12345, "version": 1, "versionNonce": 12345, "isDeleted": false, "boundElements": null, "updated": 1, "link": null, "locked": false}
+
+REQUIRED TEXT LABEL PROPERTIES (for all shapes):
+{"id": "text_id", "type": "text", "x": 140, "y": 130, "width": 100, "height": 25, "angle": 0, "strokeColor": "#1e1e1e", "backgroundColor": "transparent", "fillStyle": "solid", "strokeWidth": 1, "roughness": 0, "opacity": 100, "seed": 67890, "fontSize": 16, "fontFamily": 1, "text": "Component Name", "textAlign": "center", "verticalAlign": "middle", "baseline": 14, "version": 1, "versionNonce": 67890, "isDeleted": false, "containerId": null, "originalText": "Component Name", "lineHeight": 1.25}
+
+CONTENT + DIAGRAMS FLOW:
+- Start with text introduction
+- Insert first diagram (overview)
+- Continue with detailed text
+- Insert additional diagrams as needed (components, flows, etc.)
+- End with summary text
+""".strip()
 
 @app.route("/api/stream_chat", methods=["POST"])
 def stream_chat():
@@ -1037,73 +2008,70 @@ def stream_chat():
     if not prompt:
         return jsonify({"error": "Prompt is required"}), 400
 
-    # Enhanced formatting prompt for detailed, comprehensive responses with diagrams
-    formatted_prompt = f"""
-    SYSTEM INSTRUCTION: You are an expert professional writer and technical communicator.
-    Your task is to create COMPREHENSIVE, DETAILED content that thoroughly addresses the user's request.
-    
-    CONTENT QUALITY REQUIREMENTS:
-    - Be THOROUGH and DETAILED - provide in-depth explanations
-    - Include relevant context, background, and examples
-    - Use clear, professional language
-    - Organize information logically with good flow
-    - NO FILLER phrases like "Here is your report" - start directly with content
-    
-    FORMATTING RULES:
-    1. **Markdown Structure**: Use `# Title`, `## Sections`, `### Subsections`
-    2. **Lists**: Use `- Item` for unordered, `1.` for ordered
-    3. **Tables**: Use markdown tables `| Col | Col |` for comparisons and data
-    4. **Emphasis**: Use **bold** for key terms, *italic* for emphasis
-    5. **Code**: Use `inline code` for technical terms
-    
-    DIAGRAMS - MULTIPLE DIAGRAMS ENCOURAGED:
-    When the topic benefits from visual explanation, create MULTIPLE diagrams to show:
-    - Overall architecture/system view
-    - Component details
-    - Process flows
-    - Relationships between concepts
-    
-    Each diagram MUST:
-    1. Output ONLY raw Excalidraw JSON - NO markdown wrappers, NO explanations
-    2. Have CLEAR labels on every shape (centered inside)
-    3. Use professional spacing (50px+ between elements)
-    4. Use color coding: Blues (#a5d8ff) for primary, Green (#51cf66) for success/data, Yellow (#ffd43b) for warnings/highlights, Gray (#e9ecef) for secondary
-    5. Be positioned separately (start each new diagram at y: 0 or y: 600+ to avoid overlap)
-    
-    DIAGRAM FORMAT:
-    {{"type": "excalidraw", "version": 2, "source": "AI", "elements": [rectangles, ellipses, diamonds, arrows, text_labels]}}
-    
-    REQUIRED SHAPE PROPERTIES:
-    {{"id": "shape_id", "type": "rectangle|ellipse|diamond", "x": 100, "y": 100, "width": 180, "height": 100, "angle": 0, "strokeColor": "#1e1e1e", "backgroundColor": "#a5d8ff", "fillStyle": "solid", "strokeWidth": 2, "roughness": 1, "opacity": 100, "seed": 12345, "version": 1, "versionNonce": 12345, "isDeleted": false, "boundElements": null, "updated": 1, "link": null, "locked": false}}
-    
-    REQUIRED TEXT LABEL PROPERTIES (for all shapes):
-    {{"id": "text_id", "type": "text", "x": 140, "y": 130, "width": 100, "height": 25, "angle": 0, "strokeColor": "#1e1e1e", "backgroundColor": "transparent", "fillStyle": "solid", "strokeWidth": 1, "roughness": 0, "opacity": 100, "seed": 67890, "fontSize": 16, "fontFamily": 1, "text": "Component Name", "textAlign": "center", "verticalAlign": "middle", "baseline": 14, "version": 1, "versionNonce": 67890, "isDeleted": false, "containerId": null, "originalText": "Component Name", "lineHeight": 1.25}}
-    
-    CONTENT + DIAGRAMS FLOW:
-    - Start with text introduction
-    - Insert first diagram (overview)
-    - Continue with detailed text
-    - Insert additional diagrams as needed (components, flows, etc.)
-    - End with summary text
-    
-    USER REQUEST: {prompt}
-    """
+    # Latest wins: cancels the stream this session already has running
+    ticket = supersession.begin(request.headers.get('X-Session-ID'), "stream_chat")
+
+    # Fixed formatting/diagram instructions first so every request shares the prefix
+    formatted_prompt = LayeredPrompt(STREAM_CHAT_INSTRUCTIONS, f"USER REQUEST: {prompt}")
 
     def generate():
+        writer = NDJSONWriter()
+        frames = None
+        outcome = "error"
         try:
             # First yield a "starting" signal
-            yield json.dumps({"type": "start"}) + "\n"
+            yield writer.write({"type": "start"})
             
-            # Stream content
-            for chunk in generate_ai_response_stream(formatted_prompt, provider):
-                yield json.dumps({"type": "chunk", "content": chunk}) + "\n"
+            # Stream content, batching small provider deltas into fewer frames
+            chunks = writer.count(generate_ai_response_stream(formatted_prompt, provider))
+            # Ends as soon as a newer request supersedes this one, even mid-stall
+            frames = coalesce_chunks(chunks, stop=ticket.cancelled)
+            for content in frames:
+                yield writer.write({"type": "chunk", "content": content})
+
+            if ticket.superseded:
+                outcome = "superseded"
+                yield writer.write({"type": "superseded", "error": str(Superseded("stream_chat"))})
+                return
                 
             # Final signal
-            yield json.dumps({"type": "done"}) + "\n"
+            outcome = "completed"
+            yield writer.write({"type": "done", "stats": writer.stats()})
+        except GeneratorExit:
+            # The server closes us when a write to the client fails (tab closed,
+            # sidebar dismissed): stop the provider instead of reading to the end
+            if outcome != "completed":
+                outcome = "cancelled"
+            raise
         except Exception as e:
-            yield json.dumps({"type": "error", "error": str(e)}) + "\n"
+            error = {"type": "error", "error": str(e)}
+            if isinstance(e, PoolSaturated):
+                error["retryAfter"] = e.retry_after
+            yield writer.write(error)
+        finally:
+            if frames is not None:
+                # Closes the chain down to the provider's HTTP response
+                frames.close()
+            supersession.finish(ticket)
+            tokens = stream_stats.record(writer, provider, outcome)
+            print(f"stream_chat [{provider}] {outcome}: {writer.chunks} chunks in {writer.frames} frames, "
+                  f"{writer.bytes} bytes, ~{tokens} tokens")
 
     return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
 
+def resume_interrupted_ingestion():
+    """Startup: recover uploads whose extraction died with a previous server process."""
+    found = sum(resume_stale_ingestion(session_id, session)
+                for session_id, session in session_store.scan() if pending_documents(session))
+    if found:
+        print(f"Recovered {found} interrupted document extraction(s)")
+
+if SERVING_PROCESS:
+    resume_interrupted_ingestion()
+
 if __name__ == "__main__":
+    if SERVING_PROCESS:
+        warm_up_provider_pools()
+        health_monitor.start()
+        ollama_runtime.start_keepwarm()
     app.run(host='0.0.0.0', port=8000, debug=True)
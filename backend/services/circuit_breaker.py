@@ -0,0 +1,162 @@
+"""
+Per-Provider Circuit Breakers
+Stops sending prompts to a provider that keeps failing: after enough
+consecutive failures (or a single quota error) the circuit opens and calls
+fail immediately until a cool-down passes, then one probe call is let
+through (half-open) to test recovery.
+"""
+
+import os
+import re
+import threading
+import time
+from typing import Dict
+
+
+FAILURE_THRESHOLD = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', '3'))
+RECOVERY_TIMEOUT = float(os.getenv('CIRCUIT_RECOVERY_TIMEOUT', '30'))
+QUOTA_RECOVERY_TIMEOUT = float(os.getenv('CIRCUIT_QUOTA_RECOVERY_TIMEOUT', '300'))
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# Errors caused by the request itself, not by provider health
+_CLIENT_ERROR_RE = re.compile(r'Error (?:400|404|413|422)\b')
+_QUOTA_ERROR_RE = re.compile(r'Quota|RESOURCE_EXHAUSTED|Insufficient Balance|\b402\b', re.IGNORECASE)
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a provider whose circuit is open."""
+
+    def __init__(self, provider: str, retry_in: float):
+        self.provider = provider
+        self.retry_in = retry_in
+        super().__init__(f"{provider} is temporarily unavailable (circuit open, retry in {retry_in:.0f}s)")
+
+
+def is_quota_error(error: Exception) -> bool:
+    return bool(_QUOTA_ERROR_RE.search(str(error)))
+
+
+def counts_as_failure(error: Exception) -> bool:
+    """Only provider-side problems (network, 5xx, 429, auth, quota) trip the breaker."""
+    return not _CLIENT_ERROR_RE.search(str(error))
+
+
+class CircuitBreaker:
+    def __init__(self, name: str,
+                 failure_threshold: int = FAILURE_THRESHOLD,
+                 recovery_timeout: float = RECOVERY_TIMEOUT,
+                 quota_recovery_timeout: float = QUOTA_RECOVERY_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.quota_recovery_timeout = quota_recovery_timeout
+
+        self._lock = threading.Lock()
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.open_for = 0.0
+        self.probe_in_flight = False
+        self.last_error = None
+
+        self.times_opened = 0
+        self.rejected_calls = 0
+
+    def before_call(self):
+        """Raise CircuitOpenError if the call must not be attempted."""
+        with self._lock:
+            if self.state == CLOSED:
+                return
+
+            remaining = self.opened_at + self.open_for - time.monotonic()
+            if self.state == OPEN and remaining <= 0:
+                self.state = HALF_OPEN
+                self.probe_in_flight = False
+
+            if self.state == HALF_OPEN and not self.probe_in_flight:
+                # Let exactly one probe through to test recovery
+                self.probe_in_flight = True
+                print(f"Circuit for {self.name} half-open: sending probe request")
+                return
+
+            self.rejected_calls += 1
+            raise CircuitOpenError(self.name, max(0.0, remaining))
+
+    def record_success(self):
+        with self._lock:
+            if self.state != CLOSED:
+                print(f"Circuit for {self.name} closed: provider recovered")
+            self.state = CLOSED
+            self.consecutive_failures = 0
+            self.probe_in_flight = False
+
+    def release(self):
+        """Give back a half-open probe slot without judging the provider."""
+        with self._lock:
+            self.probe_in_flight = False
+
+    def record_failure(self, error: Exception):
+        if not counts_as_failure(error):
+            # The provider answered; the request was bad
+            self.release()
+            return
+
+        with self._lock:
+            self.consecutive_failures += 1
+            self.last_error = str(error)[:200]
+            quota = is_quota_error(error)
+
+            if self.state == HALF_OPEN or quota or self.consecutive_failures >= self.failure_threshold:
+                self._trip(self.quota_recovery_timeout if quota else self.recovery_timeout)
+
+    def _trip(self, open_for: float):
+        if self.state != OPEN:
+            self.times_opened += 1
+            print(f"Circuit for {self.name} OPEN for {open_for:.0f}s after: {self.last_error}")
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+        self.open_for = open_for
+        self.probe_in_flight = False
+
+    def stats(self) -> Dict:
+        with self._lock:
+            retry_in = 0.0
+            if self.state == OPEN:
+                retry_in = max(0.0, self.opened_at + self.open_for - time.monotonic())
+            return {
+                'state': self.state,
+                'consecutive_failures': self.consecutive_failures,
+                'times_opened': self.times_opened,
+                'rejected_calls': self.rejected_calls,
+                'retry_in_s': round(retry_in, 1),
+                'last_error': self.last_error
+            }
+
+
+class CircuitBreakerRegistry:
+    def __init__(self):
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._lock = threading.Lock()
+
+    def get(self, provider: str) -> CircuitBreaker:
+        with self._lock:
+            if provider not in self._breakers:
+                self._breakers[provider] = CircuitBreaker(provider)
+            return self._breakers[provider]
+
+    def get_stats(self) -> Dict[str, Dict]:
+        return {name: breaker.stats() for name, breaker in list(self._breakers.items())}
+
+
+# Singleton instance
+_circuit_breakers = None
+
+def get_circuit_breakers() -> CircuitBreakerRegistry:
+    """Get or create the shared circuit breaker registry"""
+    global _circuit_breakers
+    if _circuit_breakers is None:
+        _circuit_breakers = CircuitBreakerRegistry()
+    return _circuit_breakers
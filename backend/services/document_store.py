@@ -0,0 +1,173 @@
+"""
+Per-Document Session Records
+Each uploaded document is kept as its own record in the session
+(session['documents'][doc_id]) with its metadata, extracted text and page
+offsets, plus a filename index, so a document is found in O(1) and prompts
+are assembled from the documents a request actually selects.
+
+Prompt context is budgeted in tokens: every selected document gets a fair
+share of the budget, and a document that does not fit is represented by
+its summary (or abstract) instead of being cut off mid-text.
+"""
+
+import time
+import uuid
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from services.tokens import estimate_tokens, CHARS_PER_TOKEN
+
+
+# Abstract texts the upload handler stores when it found nothing usable
+_PLACEHOLDER_SUMMARIES = ("No abstract", "Error processing", "DOCX processing")
+
+
+def new_document(name: str, text: str, metadata: Dict, page_offsets: Optional[List[int]] = None) -> Dict:
+    """
+    Build a document record.
+
+    Args:
+        name: Original filename
+        text: Extracted text ('' for images or unreadable files)
+        metadata: Display metadata (title, author, citation, summary, size, url)
+        page_offsets: Character offset in `text` where each page starts
+    """
+    return {
+        "id": uuid.uuid4().hex[:12],
+        "name": name,
+        "text": text,
+        "page_offsets": page_offsets or [0],
+        "uploaded_at": time.time(),
+        **metadata
+    }
+
+
+def add_document(session: Dict, doc: Dict):
+    """Store a record and index it by filename (newest upload first). Hold the session lock."""
+    session.setdefault("documents", {})[doc["id"]] = doc
+    ids = session.setdefault("doc_index", {}).setdefault(doc["name"], [])
+    ids.insert(0, doc["id"])
+
+
+def find_document(session: Dict, doc_id: Optional[str] = None, name: Optional[str] = None) -> Optional[Dict]:
+    """Look up a document by id, or by filename (newest upload of that name)."""
+    documents = session.get("documents", {})
+    if doc_id:
+        return documents.get(doc_id)
+    if name:
+        ids = session.get("doc_index", {}).get(name)
+        if ids:
+            return documents.get(ids[0])
+    return None
+
+
+def document_block(doc: Dict) -> str:
+    """A document as it is shown to the model: metadata header, then content."""
+    return (
+        f"\n--- Start of Document ---\n"
+        f"Metadata: Filename='{doc['name']}', Title='{doc.get('title', doc['name'])}', "
+        f"Author='{doc.get('author', 'Unknown Author')}'\n"
+        f"Content:\n{doc['text']}\n--- End of Document ---\n"
+    )
+
+
+def select_documents(session: Dict, doc_ids: Optional[Iterable[str]] = None) -> List[Dict]:
+    """The requested documents (in the given order), or every text document, oldest first."""
+    documents = session.get("documents", {})
+    if doc_ids:
+        selected = [documents[i] for i in doc_ids if i in documents]
+    else:
+        selected = sorted(documents.values(), key=lambda d: d["uploaded_at"])
+    return [doc for doc in selected if doc.get("text")]
+
+
+def document_summary(doc: Dict) -> str:
+    """Best short stand-in for a document: a generated summary, else the upload abstract."""
+    summary = doc.get("ai_summary") or doc.get("summary") or ""
+    return "" if summary.startswith(_PLACEHOLDER_SUMMARIES) else summary
+
+
+def summary_block(doc: Dict, summary: str) -> str:
+    return (
+        f"\n--- Start of Document (summary only) ---\n"
+        f"Metadata: Filename='{doc['name']}', Title='{doc.get('title', doc['name'])}', "
+        f"Author='{doc.get('author', 'Unknown Author')}'\n"
+        f"Summary:\n{summary}\n--- End of Document ---\n"
+    )
+
+
+def _trim_to_sentence(text: str, max_tokens: int) -> str:
+    """Shorten a summary to max_tokens, ending at a sentence boundary where possible."""
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return text
+    cut = text[:max_chars]
+    end = max(cut.rfind(". "), cut.rfind(".\n"))
+    return cut[:end + 1] if end > max_chars // 2 else cut.rstrip() + "..."
+
+
+def build_document_context(session: Dict, budget_tokens: int,
+                           doc_ids: Optional[Iterable[str]] = None) -> Tuple[str, Dict]:
+    """
+    Prompt context from the selected documents within budget_tokens.
+
+    Documents are visited smallest first and each may use an equal share of
+    what is left, so small documents always fit in full and their unused
+    share goes to the larger ones. A document larger than its share is
+    replaced by its summary; if there is none that fits, only its metadata
+    is listed. Blocks appear in upload order.
+
+    Returns:
+        (context, report) where report lists what was included per document.
+    """
+    # Sessions saved before documents were kept separately
+    if not session.get("documents"):
+        legacy = session.get("context", "")[-budget_tokens * CHARS_PER_TOKEN:]
+        return legacy, {"budget_tokens": budget_tokens, "used_tokens": estimate_tokens(legacy) if legacy else 0,
+                        "documents": []}
+
+    selected = select_documents(session, doc_ids)
+    costs = {doc["id"]: estimate_tokens(document_block(doc)) for doc in selected}
+
+    blocks = {}
+    included = {}
+    remaining = budget_tokens
+    by_size = sorted(selected, key=lambda d: costs[d["id"]])
+    for position, doc in enumerate(by_size):
+        share = remaining // (len(by_size) - position)
+        cost = costs[doc["id"]]
+        if cost <= share:
+            blocks[doc["id"]] = document_block(doc)
+            included[doc["id"]] = {"mode": "full", "tokens": cost}
+        else:
+            summary = document_summary(doc)
+            block = summary_block(doc, _trim_to_sentence(summary, max(0, share - 64))) if summary else ""
+            if block and estimate_tokens(block) <= share:
+                blocks[doc["id"]] = block
+                included[doc["id"]] = {"mode": "summary", "tokens": estimate_tokens(block), "full_tokens": cost}
+            else:
+                included[doc["id"]] = {"mode": "omitted", "tokens": 0, "full_tokens": cost}
+        remaining -= included[doc["id"]]["tokens"]
+
+    context = "".join(blocks[doc["id"]] for doc in selected if doc["id"] in blocks)
+    omitted = [doc["name"] for doc in selected if included[doc["id"]]["mode"] == "omitted"]
+    if omitted:
+        context += "\nOther uploaded documents (not included, too large): " + ", ".join(omitted) + "\n"
+
+    report = {
+        "budget_tokens": budget_tokens,
+        "used_tokens": budget_tokens - remaining,
+        "documents": [
+            {"id": doc["id"], "name": doc["name"], **included[doc["id"]]} for doc in selected
+        ]
+    }
+    return context, report
+
+
+def pending_documents(session: Dict) -> List[str]:
+    """Names of documents whose text is still being extracted."""
+    return [doc["name"] for doc in session.get("documents", {}).values() if doc.get("status") == "processing"]
+
+
+def documents_size(session: Dict) -> int:
+    """Characters of extracted text held by a session."""
+    return sum(len(doc.get("text", "")) for doc in session.get("documents", {}).values())
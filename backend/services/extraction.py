@@ -0,0 +1,307 @@
+"""
+Document Text Extraction
+Pulls the text, page offsets and display metadata (author, title, abstract)
+out of uploaded PDF, TXT and DOCX files. Used by the ingestion workers, so
+it never runs on a request thread.
+
+Parsing is pure-Python CPU work, so it runs on a warm process pool: each
+file is its own task, and large PDFs are split into page ranges that are
+extracted in parallel and merged back in page order. The pool is created
+by warm_up() at startup, before the app starts any threads; until then
+(or if it breaks) extraction runs in-process.
+"""
+
+import concurrent.futures
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Dict, List, Optional, Tuple
+
+import PyPDF2
+
+try:
+    from docx import Document
+    HAS_DOCX = True
+except ImportError:
+    HAS_DOCX = False
+    print("Warning: python-docx not installed. DOCX support disabled.")
+
+
+EXTRACTABLE_EXTENSIONS = ('.pdf', '.txt', '.docx')
+
+EXTRACT_PROCESSES = int(os.getenv('EXTRACT_PROCESSES', str(min(4, os.cpu_count() or 1))))
+EXTRACT_PAGES_PER_TASK = int(os.getenv('EXTRACT_PAGES_PER_TASK', '16'))
+# Smaller PDFs go to one worker whole: splitting them costs more than it saves
+EXTRACT_PARALLEL_MIN_PAGES = int(os.getenv('EXTRACT_PARALLEL_MIN_PAGES', '32'))
+# Workers are forked where possible (a spawned worker would re-import main.py); warm_up()
+# forks them before the app has started any threads
+EXTRACT_START_METHOD = os.getenv(
+    'EXTRACT_START_METHOD', 'fork' if 'fork' in multiprocessing.get_all_start_methods() else 'spawn'
+)
+
+
+def is_extractable(filename: str) -> bool:
+    return filename.lower().endswith(EXTRACTABLE_EXTENSIONS)
+
+
+def _abstract(text: str) -> str:
+    """Heuristic abstract: the text after 'Abstract' near the start, else the opening lines."""
+    text_start = text[:2000]
+    if "Abstract" in text_start:
+        parts = text_start.split("Abstract")
+        if len(parts) > 1:
+            return parts[1][:500].strip() + "..."
+    return text[:300].strip() + "..."
+
+
+def _pdf_metadata(reader, filename: str) -> Dict:
+    metadata = {"author": "Unknown Author", "title": filename}
+    if reader.metadata:
+        if reader.metadata.get('/Author'):
+            metadata["author"] = reader.metadata.get('/Author')
+        if reader.metadata.get('/Title'):
+            metadata["title"] = reader.metadata.get('/Title')
+    return metadata
+
+
+def _join_pages(page_texts: List[str]) -> Tuple[str, List[int]]:
+    """Concatenate page texts in order; returns (text, offset where each page starts)."""
+    parts = []
+    offsets = []
+    length = 0
+    for extracted in page_texts:
+        offsets.append(length)
+        if extracted:
+            parts.append(extracted + "\n")
+            length += len(extracted) + 1
+    return "".join(parts), offsets or [0]
+
+
+def extract_document(path: str, filename: str,
+                     progress: Optional[Callable[[int, int], None]] = None) -> Dict:
+    """
+    Extract an uploaded file.
+
+    Args:
+        progress: Optional callback(pages_done, pages_total), called per PDF page
+
+    Returns:
+        {"text", "page_offsets", "pages", "author", "title", "summary"}
+    """
+    result = {
+        "text": "",
+        "page_offsets": [0],
+        "pages": 1,
+        "author": "Unknown Author",
+        "title": filename,
+        "summary": "No abstract content detected."
+    }
+    lower = filename.lower()
+
+    if lower.endswith('.pdf'):
+        try:
+            reader = PyPDF2.PdfReader(path)
+            result.update(_pdf_metadata(reader, filename))
+
+            # extracting text from all pages, remembering where each starts
+            total = len(reader.pages)
+            result["pages"] = total
+            page_texts = []
+            for number, page in enumerate(reader.pages, 1):
+                page_texts.append(page.extract_text() or "")
+                if progress:
+                    progress(number, total)
+            result["text"], result["page_offsets"] = _join_pages(page_texts)
+            result["summary"] = _abstract(result["text"])
+        except Exception as e:
+            print(f"Error reading PDF {filename}: {e}")
+
+    elif lower.endswith('.txt'):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                result["text"] = f.read()
+                result["summary"] = result["text"][:300].strip() + "..."
+        except Exception as e:
+            print(f"Error reading TXT {filename}: {e}")
+
+    elif lower.endswith('.docx'):
+        if HAS_DOCX:
+            try:
+                doc = Document(path)
+                # Extract Core Properties
+                if doc.core_properties.author:
+                    result["author"] = doc.core_properties.author
+                if doc.core_properties.title:
+                    result["title"] = doc.core_properties.title
+
+                result["text"] = "\n".join([para.text for para in doc.paragraphs])
+                result["summary"] = result["text"][:300].strip() + "..."
+            except Exception as e:
+                print(f"Error reading DOCX {filename}: {e}")
+                result["text"] += f"[Error processing DOCX: {e}]\n"
+                result["summary"] = "Error processing DOCX."
+        else:
+            result["text"] += "[DOCX support disabled on server]\n"
+            result["summary"] = "DOCX processing disabled."
+
+    if progress and not lower.endswith('.pdf'):
+        progress(1, 1)
+    return result
+
+
+def _warm_worker():
+    """Process-pool initializer (and warm-up task): have the parsers imported before real work."""
+    import PyPDF2  # noqa: F401
+    if HAS_DOCX:
+        import docx  # noqa: F401
+
+
+def _pdf_page_texts(path: str, start: int, end: int) -> List[str]:
+    """Text of pages [start, end) of a PDF; runs in a worker process."""
+    reader = PyPDF2.PdfReader(path)
+    return [reader.pages[number].extract_text() or "" for number in range(start, end)]
+
+
+class ExtractionEngine:
+    def __init__(self, processes: int = EXTRACT_PROCESSES, pages_per_task: int = EXTRACT_PAGES_PER_TASK,
+                 parallel_min_pages: int = EXTRACT_PARALLEL_MIN_PAGES, start_method: str = EXTRACT_START_METHOD):
+        self.processes = processes
+        self.pages_per_task = pages_per_task
+        self.parallel_min_pages = parallel_min_pages
+        self.start_method = start_method
+        self._executor: Optional[concurrent.futures.ProcessPoolExecutor] = None
+        self._broken = False
+        self._lock = threading.Lock()
+        self._stats = {'files': 0, 'split_files': 0, 'tasks': 0, 'pages': 0, 'seconds': 0.0, 'fallbacks': 0}
+
+    def _pool(self) -> Optional[concurrent.futures.ProcessPoolExecutor]:
+        """The worker pool, or None when extraction runs in-process (no warm_up(), EXTRACT_PROCESSES <= 1, or after a break)."""
+        with self._lock:
+            return self._executor
+
+    def _disable(self, broken):
+        """
+        Drop a broken pool for good. A replacement would be forked from a
+        process that by now runs many threads (deadlock-prone), and any other
+        start method re-imports main.py, so extraction stays in-process.
+        """
+        with self._lock:
+            if self._executor is broken:
+                self._executor = None
+                self._broken = True
+                self._stats['fallbacks'] += 1
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    def warm_up(self):
+        """
+        Create the pool and start every worker process. Call it once at
+        startup, while the process is still single-threaded: forked workers
+        copy the parent, and forking while other threads hold locks can
+        deadlock them. The pool is never created lazily from a worker thread.
+        """
+        with self._lock:
+            if self._executor is not None or self.processes <= 1 or self._broken:
+                return
+            pool = self._executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.processes,
+                mp_context=multiprocessing.get_context(self.start_method),
+                initializer=_warm_worker
+            )
+        try:
+            # With fork, the first submit starts all the workers at once
+            for future in [pool.submit(_warm_worker) for _ in range(self.processes)]:
+                future.result()
+        except BrokenProcessPool:
+            self._disable(pool)
+
+    def extract(self, path: str, filename: str,
+                progress: Optional[Callable[[int, int], None]] = None) -> Dict:
+        """extract_document() on the process pool; same result, falls back to in-process."""
+        started = time.perf_counter()
+        pool = self._pool()
+        tasks = 0
+        result = None
+        if pool is not None and filename.lower().endswith(('.pdf', '.docx')):
+            try:
+                result, tasks = self._extract_on_pool(pool, path, filename, progress)
+            except BrokenProcessPool as e:
+                print(f"Extraction pool failed ({e}); extracting in-process from now on")
+                self._disable(pool)
+        if result is None:
+            result = extract_document(path, filename, progress)
+
+        with self._lock:
+            self._stats['files'] += 1
+            self._stats['split_files'] += int(tasks > 1)
+            self._stats['tasks'] += tasks
+            self._stats['pages'] += result["pages"]
+            self._stats['seconds'] += time.perf_counter() - started
+        return result
+
+    def _extract_on_pool(self, pool, path: str, filename: str, progress) -> Tuple[Dict, int]:
+        if filename.lower().endswith('.pdf'):
+            try:
+                # Page count and metadata only; the pages themselves are parsed by the workers
+                reader = PyPDF2.PdfReader(path)
+                total = len(reader.pages)
+                metadata = _pdf_metadata(reader, filename)
+            except Exception as e:
+                print(f"Error reading PDF {filename}: {e}")
+                return extract_document(path, filename), 0
+
+            if total >= self.parallel_min_pages:
+                try:
+                    return self._extract_pdf_ranges(pool, path, total, metadata, progress), -(-total // self.pages_per_task)
+                except BrokenProcessPool:
+                    raise
+                except Exception as e:
+                    # Let the whole-file path degrade exactly as the serial loop does
+                    print(f"Error extracting page ranges of {filename}: {e}; retrying as one task")
+
+        result = pool.submit(extract_document, path, filename).result()
+        if progress:
+            progress(result["pages"], result["pages"])
+        return result, 1
+
+    def _extract_pdf_ranges(self, pool, path: str, total: int, metadata: Dict, progress) -> Dict:
+        ranges = [(start, min(start + self.pages_per_task, total)) for start in range(0, total, self.pages_per_task)]
+        futures = {pool.submit(_pdf_page_texts, path, start, end): index for index, (start, end) in enumerate(ranges)}
+        parts: List[Optional[List[str]]] = [None] * len(ranges)
+        done = 0
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                index = futures[future]
+                parts[index] = future.result()
+                done += len(parts[index])
+                if progress:
+                    progress(done, total)
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+        # Ranges finish in any order; the text is rebuilt in page order
+        text, page_offsets = _join_pages([page for part in parts for page in part])
+        return {"text": text, "page_offsets": page_offsets, "pages": total, "summary": _abstract(text), **metadata}
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['seconds'] = round(stats['seconds'], 2)
+            stats['pages_per_second'] = round(stats['pages'] / stats['seconds'], 1) if stats['seconds'] else None
+            stats['processes'] = self.processes if self._executor is not None else 0
+            stats['broken'] = self._broken
+        return stats
+
+
+# Singleton instance
+_extraction_engine = None
+
+def get_extraction_engine() -> ExtractionEngine:
+    """Get or create the shared extraction process pool"""
+    global _extraction_engine
+    if _extraction_engine is None:
+        _extraction_engine = ExtractionEngine()
+    return _extraction_engine
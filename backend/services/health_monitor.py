@@ -0,0 +1,131 @@
+"""
+Background Provider Health Monitor
+Probes every provider on a schedule with cheap requests (model lists,
+Ollama tags) and keeps a pre-serialized snapshot, so the status endpoint
+answers from memory with an ETag instead of running live generations.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+import concurrent.futures
+from email.utils import formatdate
+from typing import Callable, Dict, List, Optional, Tuple
+
+
+PROBE_INTERVAL = float(os.getenv('HEALTH_PROBE_INTERVAL', '60'))
+
+
+class ProviderHealthMonitor:
+    def __init__(self, providers: List[str], check: Callable[[str], str],
+                 interval: float = PROBE_INTERVAL):
+        """
+        Args:
+            providers: Provider names to probe
+            check: Callable(provider) -> status string ('ok', 'offline', ...)
+            interval: Seconds between probe rounds
+        """
+        self.providers = providers
+        self.check = check
+        self.interval = interval
+
+        self._results: Dict[str, Dict] = {
+            p: {'status': 'unknown', 'checked_at': None, 'latency_ms': None} for p in providers
+        }
+        self._snapshots: Dict[bool, Tuple[bytes, str]] = {}
+        self._last_checked: Optional[float] = None
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=len(providers) or 1, thread_name_prefix='health'
+        )
+        self._thread = None
+        self._stop = threading.Event()
+        self._probed = threading.Event()
+        self._rebuild_snapshots()
+
+    def start(self):
+        """Start the probe loop once (safe to call on every request)."""
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, daemon=True, name='health-monitor')
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"Health monitor round failed: {e}")
+            self._stop.wait(self.interval)
+
+    def _probe(self, provider: str) -> Dict:
+        start = time.monotonic()
+        try:
+            status = self.check(provider)
+        except Exception:
+            status = 'error'
+        return {
+            'status': status,
+            'checked_at': time.time(),
+            'latency_ms': round((time.monotonic() - start) * 1000, 1)
+        }
+
+    def refresh(self):
+        """Probe all providers in parallel and publish a new snapshot."""
+        with self._refresh_lock:
+            futures = {self._executor.submit(self._probe, p): p for p in self.providers}
+            results = {}
+            for future in concurrent.futures.as_completed(futures):
+                results[futures[future]] = future.result()
+
+            with self._lock:
+                self._results.update(results)
+                self._last_checked = time.time()
+                self._rebuild_snapshots()
+            self._probed.set()
+
+    def wait_for_first_round(self, timeout: float) -> bool:
+        """Block until the first probe round is published (or timeout); instant afterwards."""
+        return self._probed.wait(timeout)
+
+    def _rebuild_snapshots(self):
+        """Serialize both views once per round so requests only copy bytes."""
+        # Unprobed providers are left out so clients show "no status" rather than down
+        summary = {p: r['status'] for p, r in self._results.items() if r['checked_at'] is not None}
+        detail = {
+            'providers': self._results,
+            'last_checked': self._last_checked,
+            'interval_s': self.interval
+        }
+        for is_detail, payload in ((False, summary), (True, detail)):
+            body = json.dumps(payload, sort_keys=True).encode('utf-8')
+            etag = hashlib.sha1(body).hexdigest()
+            self._snapshots[is_detail] = (body, etag)
+
+    def snapshot(self, detail: bool = False) -> Tuple[bytes, str, Optional[str]]:
+        """Return (json_body, etag, last_modified_http_date) of the latest probe round."""
+        with self._lock:
+            body, etag = self._snapshots[detail]
+            last_checked = self._last_checked
+        last_modified = formatdate(last_checked, usegmt=True) if last_checked else None
+        return body, etag, last_modified
+
+
+# Singleton instance
+_health_monitor = None
+
+def get_health_monitor(providers: List[str], check: Callable[[str], str]) -> ProviderHealthMonitor:
+    """Get or create the shared provider health monitor"""
+    global _health_monitor
+    if _health_monitor is None:
+        _health_monitor = ProviderHealthMonitor(providers, check)
+    return _health_monitor
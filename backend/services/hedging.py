@@ -0,0 +1,178 @@
+"""
+Hedged Provider Requests
+Races the same prompt against a primary and a secondary provider to cut
+tail latency: the secondary is fired after a hedge delay (or immediately),
+the first successful answer wins and the loser is told to stop.
+Both sides run on the shared provider pool, under its concurrency caps.
+"""
+
+import os
+import threading
+import time
+import concurrent.futures
+from typing import Callable, Dict, Optional
+
+from services.provider_pool import get_provider_pool, PoolSaturated
+
+
+DEFAULT_HEDGE_DELAY = float(os.getenv('AI_HEDGE_DELAY', '2.0'))
+EWMA_ALPHA = 0.2
+
+
+class RaceCancelled(Exception):
+    """Raised inside a racer that was told to stop because the other side won."""
+
+
+class ProviderRacer:
+    def __init__(self):
+        self._pool = get_provider_pool()
+        self._lock = threading.Lock()
+        self._latency_ewma: Dict[str, float] = {}
+        self._stats = {
+            'races': 0,
+            'hedges_fired': 0,
+            'losers_cancelled': 0,
+            'latency_saved_ms': 0.0,
+            'wins': {}
+        }
+
+    def _observe_latency(self, provider: str, seconds: float):
+        with self._lock:
+            previous = self._latency_ewma.get(provider)
+            if previous is None:
+                self._latency_ewma[provider] = seconds
+            else:
+                self._latency_ewma[provider] = EWMA_ALPHA * seconds + (1 - EWMA_ALPHA) * previous
+
+    def race(self, prompt: str, primary: str, secondary: str,
+             run: Callable[[str, str, threading.Event], str],
+             hedge_delay: Optional[float] = None) -> Dict:
+        """
+        Run a hedged request.
+
+        Args:
+            prompt: Prompt sent to both providers
+            primary: Provider tried first
+            secondary: Provider fired after `hedge_delay` seconds (0 = at once),
+                or as soon as the primary fails
+            run: Callable(provider, prompt, cancel_event) returning the full text.
+                It should check cancel_event and stop early when it is set.
+            hedge_delay: Seconds to wait for the primary before hedging
+
+        Returns:
+            {
+                'text': str,
+                'winner': str,
+                'hedged': bool,          # secondary was actually fired
+                'latency_ms': float,     # wall time until the winner answered
+                'latency_saved_ms': float  # vs. waiting for the primary alone
+            }
+        """
+        if hedge_delay is None:
+            hedge_delay = DEFAULT_HEDGE_DELAY
+
+        start = time.monotonic()
+        cancel_events = {primary: threading.Event(), secondary: threading.Event()}
+        futures = {}
+        errors = {}
+
+        def submit(provider):
+            def task():
+                began = time.monotonic()
+                text = run(provider, prompt, cancel_events[provider])
+                if cancel_events[provider].is_set():
+                    raise RaceCancelled(provider)
+                self._observe_latency(provider, time.monotonic() - began)
+                return text
+            futures[self._pool.submit(provider, task)] = provider
+
+        with self._lock:
+            self._stats['races'] += 1
+
+        submit(primary)
+        if hedge_delay > 0:
+            done, _ = concurrent.futures.wait(list(futures), timeout=hedge_delay)
+            for future in done:
+                if future.exception() is None:
+                    return self._finish(primary, future.result(), start, False, primary, cancel_events)
+                errors[primary] = future.exception()
+
+        try:
+            submit(secondary)
+        except PoolSaturated as e:
+            # No capacity to hedge: behave like a plain call to the primary
+            errors[secondary] = e
+            if primary in errors:
+                raise errors[primary]
+            print(f"Hedge skipped: {e}")
+            future = next(iter(futures))
+            return self._finish(primary, future.result(), start, False, primary, cancel_events)
+        with self._lock:
+            self._stats['hedges_fired'] += 1
+
+        pending = {future for future, provider in futures.items() if provider not in errors}
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                provider = futures[future]
+                if future.exception() is None:
+                    return self._finish(provider, future.result(), start, True,
+                                        primary, cancel_events, primary_failed=primary in errors)
+                errors[provider] = future.exception()
+
+        # Both sides failed: surface the primary's error, as a plain call would
+        raise errors.get(primary) or errors[secondary]
+
+    def _finish(self, winner: str, text: str, start: float, hedged: bool,
+                primary: str, cancel_events: Dict[str, threading.Event],
+                primary_failed: bool = False) -> Dict:
+        latency = time.monotonic() - start
+
+        # Stop the loser (only exists if the hedge was actually fired)
+        cancelled = 0
+        if hedged:
+            for provider, event in cancel_events.items():
+                if provider != winner:
+                    event.set()
+                    cancelled += 1
+
+        # The loser is abandoned, so its true latency is unknown: estimate the
+        # saving from the primary's recent average instead. A failed primary
+        # saves nothing relative to a plain call, which would have errored.
+        saved = 0.0
+        if hedged and winner != primary and not primary_failed:
+            expected = self._latency_ewma.get(primary)
+            if expected is not None:
+                saved = max(0.0, expected - latency)
+
+        with self._lock:
+            self._stats['wins'][winner] = self._stats['wins'].get(winner, 0) + 1
+            self._stats['losers_cancelled'] += cancelled
+            self._stats['latency_saved_ms'] += saved * 1000
+
+        return {
+            'text': text,
+            'winner': winner,
+            'hedged': hedged,
+            'latency_ms': round(latency * 1000, 1),
+            'latency_saved_ms': round(saved * 1000, 1)
+        }
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['wins'] = dict(self._stats['wins'])
+            stats['latency_saved_ms'] = round(stats['latency_saved_ms'], 1)
+            stats['latency_ewma_ms'] = {p: round(v * 1000, 1) for p, v in self._latency_ewma.items()}
+        return stats
+
+
+# Singleton instance
+_provider_racer = None
+
+def get_provider_racer() -> ProviderRacer:
+    """Get or create the shared provider racer"""
+    global _provider_racer
+    if _provider_racer is None:
+        _provider_racer = ProviderRacer()
+    return _provider_racer
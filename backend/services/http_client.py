@@ -0,0 +1,172 @@
+"""
+Pooled HTTP Client for AI Provider Calls
+Keeps one keep-alive connection pool per provider host so repeated prompts
+reuse open TCP/TLS connections instead of paying a new handshake each time.
+"""
+
+import os
+import threading
+from typing import Callable, Dict, List, Optional
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+DEFAULT_POOL_MAXSIZE = int(os.getenv('HTTP_POOL_MAXSIZE', '10'))
+WARMUP_TIMEOUT = float(os.getenv('HTTP_WARMUP_TIMEOUT', '5'))
+
+
+class ProviderPool:
+    """A keep-alive session bound to a single provider host."""
+
+    def __init__(self, name: str, base_url: str, pool_maxsize: int):
+        self.name = name
+        parts = urlsplit(base_url)
+        self.origin = f"{parts.scheme}://{parts.netloc}"
+        self.pool_maxsize = pool_maxsize
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+        self.adapter = adapter
+        self.session.mount(f"{parts.scheme}://", adapter)
+
+        self._lock = threading.Lock()
+        self.active = 0
+        self.requests_sent = 0
+        self.errors = 0
+        self.warmed_up = False
+
+    def _connection_pools(self) -> List:
+        """urllib3 pools currently held by this provider's adapter."""
+        pools = self.adapter.poolmanager.pools
+        return [pools[key] for key in list(pools.keys())]
+
+    def stats(self) -> Dict:
+        connections_opened = 0
+        pooled_requests = 0
+        idle = 0
+        for pool in self._connection_pools():
+            connections_opened += pool.num_connections
+            pooled_requests += pool.num_requests
+            # Empty slots in the LIFO queue are None; real entries are idle sockets
+            idle += sum(1 for conn in list(pool.pool.queue) if conn is not None)
+
+        return {
+            'host': self.origin,
+            'pool_maxsize': self.pool_maxsize,
+            'active': self.active,
+            'idle': idle,
+            'requests': self.requests_sent,
+            'errors': self.errors,
+            'connections_opened': connections_opened,
+            'handshakes_avoided': max(0, pooled_requests - connections_opened),
+            'warmed_up': self.warmed_up
+        }
+
+
+class PooledHttpClient:
+    def __init__(self):
+        self._pools: Dict[str, ProviderPool] = {}
+        self._lock = threading.Lock()
+        self._response_listeners: List[Callable[[str, requests.Response], None]] = []
+
+    def add_response_listener(self, listener: Callable[[str, requests.Response], None]):
+        """Call listener(provider_name, response) after every response (headers only for streams)."""
+        self._response_listeners.append(listener)
+
+    def register(self, name: str, base_url: str, pool_maxsize: Optional[int] = None) -> ProviderPool:
+        """
+        Register a provider host and create its connection pool.
+
+        Args:
+            name: Provider name used when issuing requests (e.g. 'openai')
+            base_url: Any URL on the provider host; only scheme and host are kept
+            pool_maxsize: Max connections kept alive for this host. Defaults to
+                HTTP_POOL_SIZE_<NAME> or HTTP_POOL_MAXSIZE from the environment.
+        """
+        if pool_maxsize is None:
+            pool_maxsize = int(os.getenv(f'HTTP_POOL_SIZE_{name.upper()}', DEFAULT_POOL_MAXSIZE))
+
+        with self._lock:
+            if name not in self._pools:
+                self._pools[name] = ProviderPool(name, base_url, pool_maxsize)
+            return self._pools[name]
+
+    def _get_pool(self, name: str) -> ProviderPool:
+        pool = self._pools.get(name)
+        if pool is None:
+            raise KeyError(f"HTTP pool for provider '{name}' is not registered")
+        return pool
+
+    def request(self, method: str, name: str, url: str, **kwargs) -> requests.Response:
+        """Send a request through the provider's pooled session."""
+        pool = self._get_pool(name)
+
+        with pool._lock:
+            pool.active += 1
+            pool.requests_sent += 1
+        try:
+            response = pool.session.request(method, url, **kwargs)
+        except requests.exceptions.RequestException:
+            with pool._lock:
+                pool.errors += 1
+            raise
+        finally:
+            with pool._lock:
+                pool.active -= 1
+
+        for listener in self._response_listeners:
+            try:
+                listener(name, response)
+            except Exception as e:
+                print(f"HTTP response listener error ({name}): {e}")
+        return response
+
+    def post(self, name: str, url: str, **kwargs) -> requests.Response:
+        return self.request('POST', name, url, **kwargs)
+
+    def get(self, name: str, url: str, **kwargs) -> requests.Response:
+        return self.request('GET', name, url, **kwargs)
+
+    def warm_up(self, names: Optional[List[str]] = None) -> Dict[str, bool]:
+        """
+        Pre-connect to provider hosts so the first real prompt skips the handshake.
+
+        Any HTTP status counts as success: we only care that a TCP/TLS
+        connection was opened and returned to the pool.
+        """
+        results = {}
+        for name in (names or list(self._pools.keys())):
+            pool = self._pools.get(name)
+            if pool is None:
+                continue
+            try:
+                response = pool.session.head(pool.origin, timeout=WARMUP_TIMEOUT)
+                response.close()
+                pool.warmed_up = True
+                results[name] = True
+            except requests.exceptions.RequestException as e:
+                print(f"HTTP warm-up failed for {name} ({pool.origin}): {e}")
+                results[name] = False
+        return results
+
+    def warm_up_async(self, names: Optional[List[str]] = None) -> threading.Thread:
+        """Run warm_up on a daemon thread so startup is not delayed."""
+        thread = threading.Thread(target=self.warm_up, args=(names,), daemon=True)
+        thread.start()
+        return thread
+
+    def get_stats(self) -> Dict[str, Dict]:
+        return {name: pool.stats() for name, pool in self._pools.items()}
+
+
+# Singleton instance
+_http_client = None
+
+def get_http_client() -> PooledHttpClient:
+    """Get or create the shared pooled HTTP client"""
+    global _http_client
+    if _http_client is None:
+        _http_client = PooledHttpClient()
+    return _http_client
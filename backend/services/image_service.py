@@ -5,12 +5,13 @@ Handles image generation, caching, and error management
 
 import os
 import base64
-import requests
 import hashlib
 import json
 from typing import Dict, Optional
 from pathlib import Path
 
+from services.http_client import get_http_client
+
 class ImageGenerationService:
     def __init__(self):
         self.api_key = os.getenv('STABILITY_API_KEY')
@@ -21,6 +22,8 @@ class ImageGenerationService:
         self.cache_dir.mkdir(exist_ok=True)
         
         self.api_url = "https://api.stability.ai/v1/generation/stable-diffusion-xl-1024-v1-0/text-to-image"
+        self.http_client = get_http_client()
+        self.http_client.register('stability', self.api_url)
     
     def generate_image(self, prompt: str, style: str = "digital-art") -> Dict:
         """
@@ -110,7 +113,8 @@ class ImageGenerationService:
             "style_preset": style
         }
         
-        response = requests.post(
+        response = self.http_client.post(
+            'stability',
             self.api_url,
             headers=headers,
             json=payload,
@@ -0,0 +1,227 @@
+"""
+Background Document Ingestion
+Uploads return as soon as the files are saved; text extraction runs on a
+small worker pool, one job per file. A job reports pages processed, bytes
+and an ETA, which clients poll or follow as an event stream, and the
+document becomes available to chat/generate once its job finishes.
+
+Jobs live in the process that runs them. Document records note which
+process owns their job (process_owner), so after a restart records left
+"processing" by a process that no longer exists (owner_alive) can be
+re-queued or failed instead of waiting forever.
+"""
+
+import os
+import threading
+import time
+import uuid
+import concurrent.futures
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+
+
+# Jobs mostly wait on the extraction process pool, so a few run at once
+INGEST_WORKERS = int(os.getenv('INGEST_WORKERS', '4'))
+# Finished jobs stay queryable this long (seconds)
+INGEST_JOB_TTL = int(os.getenv('INGEST_JOB_TTL', '3600'))
+
+TERMINAL_STATES = ('ready', 'failed')
+
+# Tells this process apart from an earlier one that had the same pid
+_BOOT_TOKEN = uuid.uuid4().hex[:8]
+
+
+def process_owner() -> str:
+    """Owner tag for jobs queued by this process (pid and boot token)."""
+    return f"{os.getpid()}:{_BOOT_TOKEN}"
+
+
+def owner_alive(owner: Optional[str]) -> bool:
+    """True if the process that tagged a job with `owner` is still running on this host."""
+    if not owner:
+        return False
+    pid, _, token = owner.partition(':')
+    if int(pid) == os.getpid():
+        return token == _BOOT_TOKEN
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class IngestionJob:
+    """Progress of one file's extraction. States: queued, extracting, ready, failed."""
+
+    def __init__(self, session_id: str, doc_id: str, name: str, size: int, changed: threading.Condition,
+                 job_id: Optional[str] = None):
+        self.id = job_id or uuid.uuid4().hex
+        self.session_id = session_id
+        self.doc_id = doc_id
+        self.name = name
+        self.size = size
+        self.status = 'queued'
+        self.pages_done = 0
+        self.pages_total = None
+        self.error = None
+        self.result: Optional[Dict] = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.version = 0
+        self._changed = changed
+
+    def _touch(self):
+        """Record a change and wake event-stream waiters (called with the condition held)."""
+        self.version += 1
+        self._changed.notify_all()
+
+    def progress(self, pages_done: int, pages_total: int):
+        """Extraction callback: pages_done of pages_total processed."""
+        with self._changed:
+            self.pages_done = pages_done
+            self.pages_total = pages_total
+            self._touch()
+
+    def eta_seconds(self) -> Optional[float]:
+        if self.status != 'extracting' or not self.pages_done or not self.pages_total:
+            return None
+        elapsed = time.time() - self.started_at
+        return round(elapsed / self.pages_done * (self.pages_total - self.pages_done), 1)
+
+    def snapshot(self) -> Dict:
+        fraction = self.pages_done / self.pages_total if self.pages_total else 0.0
+        if self.status == 'ready':
+            fraction = 1.0
+        return {
+            "jobId": self.id,
+            "docId": self.doc_id,
+            "name": self.name,
+            "status": self.status,
+            "pagesDone": self.pages_done,
+            "pagesTotal": self.pages_total,
+            "bytesTotal": self.size,
+            # Pages are the unit of work, so bytes are apportioned by page
+            "bytesDone": int(self.size * fraction),
+            "etaSeconds": self.eta_seconds(),
+            "elapsedSeconds": round((self.finished_at or time.time()) - self.started_at, 1) if self.started_at else None,
+            "error": self.error,
+            "document": self.result
+        }
+
+
+class IngestionQueue:
+    def __init__(self, max_workers: int = INGEST_WORKERS, job_ttl: int = INGEST_JOB_TTL):
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='ingest'
+        )
+        self.max_workers = max_workers
+        self.job_ttl = job_ttl
+        self._jobs: "OrderedDict[str, IngestionJob]" = OrderedDict()
+        self._changed = threading.Condition()
+        self._stats = {'submitted': 0, 'resumed': 0, 'ready': 0, 'failed': 0, 'pages': 0, 'extract_seconds': 0.0}
+
+    def submit(self, session_id: str, doc_id: str, name: str, size: int,
+               work: Callable[[IngestionJob], Optional[Dict]], job_id: Optional[str] = None) -> IngestionJob:
+        """
+        Queue work(job) for a document. work reports progress through
+        job.progress() and returns the finished document's metadata.
+        job_id reuses an id already handed to clients (a resumed job).
+        """
+        with self._changed:
+            self._expire()
+            job = IngestionJob(session_id, doc_id, name, size, self._changed, job_id)
+            self._jobs[job.id] = job
+            self._stats['submitted'] += 1
+            if job_id:
+                self._stats['resumed'] += 1
+        self._executor.submit(self._run, job, work)
+        return job
+
+    def _run(self, job: IngestionJob, work: Callable[[IngestionJob], Optional[Dict]]):
+        with self._changed:
+            job.status = 'extracting'
+            job.started_at = time.time()
+            job._touch()
+        try:
+            result = work(job)
+        except Exception as e:
+            print(f"Ingestion failed for {job.name}: {e}")
+            with self._changed:
+                job.status = 'failed'
+                job.error = str(e)
+                job.finished_at = time.time()
+                self._stats['failed'] += 1
+                job._touch()
+            return
+
+        with self._changed:
+            job.status = 'ready'
+            job.result = result
+            job.finished_at = time.time()
+            self._stats['ready'] += 1
+            self._stats['pages'] += job.pages_total or 0
+            self._stats['extract_seconds'] += job.finished_at - job.started_at
+            job._touch()
+
+    def _expire(self):
+        """Drop finished jobs past their TTL (called with the condition held)."""
+        cutoff = time.time() - self.job_ttl
+        for job_id in [j.id for j in self._jobs.values() if j.finished_at and j.finished_at < cutoff]:
+            del self._jobs[job_id]
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        with self._changed:
+            job = self._jobs.get(job_id)
+            return job.snapshot() if job else None
+
+    def for_session(self, session_id: str) -> List[Dict]:
+        with self._changed:
+            self._expire()
+            return [job.snapshot() for job in self._jobs.values() if job.session_id == session_id]
+
+    def owner(self, job_id: str) -> Optional[str]:
+        with self._changed:
+            job = self._jobs.get(job_id)
+            return job.session_id if job else None
+
+    def wait_for_change(self, job_id: str, version: int, timeout: float = 15.0) -> Optional[tuple]:
+        """
+        Block until the job changes past `version` (or timeout).
+
+        Returns:
+            (version, snapshot), or None if the job is unknown.
+        """
+        deadline = time.monotonic() + timeout
+        with self._changed:
+            while True:
+                job = self._jobs.get(job_id)
+                if job is None:
+                    return None
+                remaining = deadline - time.monotonic()
+                if job.version > version or job.status in TERMINAL_STATES or remaining <= 0:
+                    return job.version, job.snapshot()
+                self._changed.wait(remaining)
+
+    def get_stats(self) -> Dict:
+        with self._changed:
+            active = sum(1 for job in self._jobs.values() if job.status not in TERMINAL_STATES)
+            stats = dict(self._stats)
+            stats['extract_seconds'] = round(stats['extract_seconds'], 1)
+            stats['active'] = active
+            stats['tracked'] = len(self._jobs)
+            stats['workers'] = self.max_workers
+        return stats
+
+
+# Singleton instance
+_ingestion_queue = None
+
+def get_ingestion_queue() -> IngestionQueue:
+    """Get or create the shared ingestion queue"""
+    global _ingestion_queue
+    if _ingestion_queue is None:
+        _ingestion_queue = IngestionQueue()
+    return _ingestion_queue
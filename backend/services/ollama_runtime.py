@@ -0,0 +1,197 @@
+"""
+Ollama Runtime Tuning
+Keeps the local model resident (preload at startup, periodic keep-alive
+pings), runs every request at one fixed num_ctx and sizes only
+num_predict per endpoint, and tracks how much of each request went to
+loading the model versus evaluating the prompt and generating tokens.
+"""
+
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+import requests
+
+from services.http_client import get_http_client
+from services.rate_limiter import parse_duration
+
+
+OLLAMA_KEEP_ALIVE = os.getenv('OLLAMA_KEEP_ALIVE', '30m')
+OLLAMA_KEEPWARM_INTERVAL = float(os.getenv('OLLAMA_KEEPWARM_INTERVAL', '600'))
+# Ollama reloads the model whenever num_ctx changes, so every request and
+# keep-alive ping uses this one value
+OLLAMA_NUM_CTX = int(os.getenv('OLLAMA_NUM_CTX', '16384'))
+OLLAMA_PRELOAD_TIMEOUT = float(os.getenv('OLLAMA_PRELOAD_TIMEOUT', '300'))
+
+# Output budget per endpoint; refine/summarize answers are short, reports long
+ENDPOINT_NUM_PREDICT = {
+    'chat': 2048,
+    'generate': 4096,
+    'stream_chat': 4096,
+    'summarize': 1024,
+    'refine': 1024,
+}
+DEFAULT_NUM_PREDICT = 2048
+CTX_HEADROOM = 256  # template/system tokens Ollama adds around the prompt
+COLD_LOAD_MS = 1000  # a load_duration above this means the model was not resident
+
+
+def ollama_options(prompt_tokens: int, endpoint: Optional[str] = None) -> Dict[str, int]:
+    """
+    Options for a request: the fixed num_ctx (so the loaded runner is reused)
+    and the endpoint's num_predict, which does not trigger a reload.
+    """
+    num_predict = ENDPOINT_NUM_PREDICT.get(endpoint, DEFAULT_NUM_PREDICT)
+    # A prompt near the context limit leaves less room for the answer
+    num_predict = max(256, min(num_predict, OLLAMA_NUM_CTX - prompt_tokens - CTX_HEADROOM))
+    return {'num_ctx': OLLAMA_NUM_CTX, 'num_predict': num_predict}
+
+
+def is_cloud_model(model: str) -> bool:
+    """Ollama cloud models run remotely; there is nothing to keep resident."""
+    return model.endswith('-cloud') or model.endswith(':cloud')
+
+
+class OllamaRuntime:
+    def __init__(self, base_url: str, model: str, keep_alive: str = OLLAMA_KEEP_ALIVE,
+                 interval: float = OLLAMA_KEEPWARM_INTERVAL):
+        """
+        Args:
+            base_url: Ollama server root, e.g. http://localhost:11434
+            model: Model to keep loaded
+            keep_alive: How long Ollama keeps the model after a request ('30m', '-1' = forever)
+            interval: Seconds between keep-alive pings
+        """
+        self.base_url = base_url.rstrip('/')
+        self.model = model
+        self.keep_alive = keep_alive
+        self.interval = interval
+
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self._stats = {
+            'requests': 0,
+            'cold_loads': 0,
+            'load_ms_total': 0.0,
+            'prompt_eval_ms_total': 0.0,
+            'eval_ms_total': 0.0,
+            'prompt_tokens_total': 0,
+            'eval_tokens_total': 0,
+            'preloads': 0,
+            'preload_failures': 0,
+            'last_preload_ms': None,
+            'last_request': None
+        }
+
+        # Ping well before keep_alive runs out
+        keep_alive_s = parse_duration(keep_alive)
+        if keep_alive_s and keep_alive_s > 0:
+            self.interval = min(self.interval, keep_alive_s * 0.8)
+
+    def preload(self) -> bool:
+        """
+        Load the model (an empty generate request) and reset its keep-alive
+        timer, at the num_ctx requests use so the ping never swaps the runner.
+        """
+        start = time.monotonic()
+        try:
+            response = get_http_client().post(
+                'ollama',
+                f"{self.base_url}/api/generate",
+                json={'model': self.model, 'keep_alive': self.keep_alive, 'options': {'num_ctx': OLLAMA_NUM_CTX}},
+                timeout=OLLAMA_PRELOAD_TIMEOUT
+            )
+            ok = response.status_code == 200
+            if not ok:
+                print(f"Ollama preload of {self.model} failed: {response.status_code} {response.text[:200]}")
+        except requests.exceptions.RequestException as e:
+            ok = False
+            print(f"Ollama preload of {self.model} failed: {e}")
+
+        with self._lock:
+            if ok:
+                self._stats['preloads'] += 1
+                self._stats['last_preload_ms'] = round((time.monotonic() - start) * 1000, 1)
+            else:
+                self._stats['preload_failures'] += 1
+        return ok
+
+    def start_keepwarm(self):
+        """Preload now and keep the model resident in the background (idempotent)."""
+        if is_cloud_model(self.model):
+            print(f"Ollama model {self.model} is a cloud model: keep-warm disabled")
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, daemon=True, name='ollama-keepwarm')
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.preload()
+            self._stop.wait(self.interval)
+
+    def options(self, prompt_tokens: int, endpoint: Optional[str] = None) -> Dict:
+        """Request fields to merge into an /api/chat payload."""
+        return {'keep_alive': self.keep_alive, 'options': ollama_options(prompt_tokens, endpoint)}
+
+    def observe(self, data: Dict, options: Optional[Dict] = None):
+        """Record timings from a final Ollama response (durations are in nanoseconds)."""
+        load_ms = data.get('load_duration', 0) / 1e6
+        prompt_eval_ms = data.get('prompt_eval_duration', 0) / 1e6
+        eval_ms = data.get('eval_duration', 0) / 1e6
+        eval_count = data.get('eval_count', 0)
+
+        last = {
+            'load_ms': round(load_ms, 1),
+            'prompt_eval_ms': round(prompt_eval_ms, 1),
+            'eval_ms': round(eval_ms, 1),
+            'total_ms': round(data.get('total_duration', 0) / 1e6, 1),
+            'prompt_tokens': data.get('prompt_eval_count', 0),
+            'eval_tokens': eval_count,
+            'tokens_per_s': round(eval_count / (eval_ms / 1000), 1) if eval_ms else None,
+            'cold': load_ms > COLD_LOAD_MS
+        }
+        if options:
+            last.update(options.get('options', {}))
+
+        with self._lock:
+            self._stats['requests'] += 1
+            self._stats['cold_loads'] += int(last['cold'])
+            self._stats['load_ms_total'] += load_ms
+            self._stats['prompt_eval_ms_total'] += prompt_eval_ms
+            self._stats['eval_ms_total'] += eval_ms
+            self._stats['prompt_tokens_total'] += last['prompt_tokens']
+            self._stats['eval_tokens_total'] += eval_count
+            self._stats['last_request'] = last
+
+        print(f"Ollama timings: load {last['load_ms']}ms, prompt eval {last['prompt_eval_ms']}ms, "
+              f"generation {last['eval_ms']}ms ({last['tokens_per_s']} tok/s)")
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+        for key in ('load_ms_total', 'prompt_eval_ms_total', 'eval_ms_total'):
+            stats[key] = round(stats[key], 1)
+        stats['model'] = self.model
+        stats['keep_alive'] = self.keep_alive
+        stats['num_ctx'] = OLLAMA_NUM_CTX
+        stats['keepwarm_active'] = self._thread is not None
+        return stats
+
+
+# Singleton instance
+_ollama_runtime = None
+
+def get_ollama_runtime(base_url: str, model: str) -> OllamaRuntime:
+    """Get or create the shared Ollama runtime manager"""
+    global _ollama_runtime
+    if _ollama_runtime is None:
+        _ollama_runtime = OllamaRuntime(base_url, model)
+    return _ollama_runtime
@@ -0,0 +1,316 @@
+"""
+Cache-Friendly Prompt Layout
+Prompts are laid out as fixed instructions first, then the session's
+document context, then the per-request question, and chat APIs receive
+the instructions as a system message. Requests that share instructions
+and documents then share a token prefix the provider can serve from its
+prompt cache (automatic for OpenAI, Grok and DeepSeek, KV reuse for
+Ollama). For Gemini the prefix is stored once as an explicit
+cachedContents entry and referenced by name.
+
+Cached vs uncached input tokens are parsed from every provider response
+and reported per call.
+"""
+
+import contextvars
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional
+
+from services.tokens import estimate_tokens
+
+
+GEMINI_CACHE_ENABLED = os.getenv('GEMINI_CONTEXT_CACHE', 'true').lower() == 'true'
+# Gemini rejects explicit caches below a model-specific minimum size
+GEMINI_CACHE_MIN_TOKENS = int(os.getenv('GEMINI_CACHE_MIN_TOKENS', '4096'))
+GEMINI_CACHE_TTL = int(os.getenv('GEMINI_CACHE_TTL', '900'))
+GEMINI_CACHE_MAX_ENTRIES = int(os.getenv('GEMINI_CACHE_MAX_ENTRIES', '128'))
+GEMINI_CACHE_RETRY_AFTER = 300
+
+
+class LayeredPrompt(str):
+    """
+    A prompt split into stable and variable parts. It is still the
+    flattened string everywhere a plain prompt is expected (cache keys,
+    token estimates, providers without chat roles); provider calls that
+    understand roles send the parts separately, stable parts first.
+
+    `cacheable` is False when the context was picked for this question
+    (retrieved excerpts), so no other request will repeat it.
+    """
+
+    def __new__(cls, system: str, question: str, context: str = '', cacheable: bool = True):
+        self = super().__new__(cls, "\n\n".join(part for part in (system, context, question) if part))
+        self.system = system
+        self.context = context
+        self.question = question
+        self.cacheable = cacheable
+        return self
+
+    def __reduce__(self):
+        return (LayeredPrompt, (self.system, self.question, self.context, self.cacheable))
+
+    @property
+    def user_text(self) -> str:
+        """The user turn: document context, then the question."""
+        return "\n\n".join(part for part in (self.context, self.question) if part)
+
+
+def chat_messages(prompt: str) -> List[Dict]:
+    """OpenAI-style messages: system instructions first for a LayeredPrompt."""
+    if isinstance(prompt, LayeredPrompt) and prompt.system:
+        return [
+            {"role": "system", "content": prompt.system},
+            {"role": "user", "content": prompt.user_text}
+        ]
+    return [{"role": "user", "content": prompt}]
+
+
+def gemini_payload(prompt: str, cached_content: Optional[str] = None) -> Dict:
+    """
+    generateContent body. With cached_content (a cachedContents name holding
+    the instructions and documents) only the question is sent.
+    """
+    if not isinstance(prompt, LayeredPrompt):
+        return {"contents": [{"parts": [{"text": prompt}]}]}
+    if cached_content:
+        return {
+            "cachedContent": cached_content,
+            "contents": [{"role": "user", "parts": [{"text": prompt.question}]}]
+        }
+    payload = {"contents": [{"role": "user", "parts": [{"text": prompt.user_text}]}]}
+    if prompt.system:
+        payload["systemInstruction"] = {"parts": [{"text": prompt.system}]}
+    return payload
+
+
+def prompt_usage(provider: str, body: Dict) -> Optional[Dict]:
+    """
+    Input/cached/output token counts from a provider response body (or the
+    final event of a stream), or None if it carries no usage.
+    """
+    if provider == "gemini":
+        usage = body.get("usageMetadata")
+        if not usage:
+            return None
+        return {
+            "input_tokens": usage.get("promptTokenCount", 0),
+            "cached_tokens": usage.get("cachedContentTokenCount", 0),
+            "output_tokens": usage.get("candidatesTokenCount", 0)
+        }
+    if provider == "ollama":
+        # Ollama counts only the prompt tokens it evaluated; a reused KV prefix is not reported
+        if "prompt_eval_count" not in body:
+            return None
+        return {"input_tokens": body["prompt_eval_count"], "cached_tokens": 0,
+                "output_tokens": body.get("eval_count", 0)}
+
+    usage = body.get("usage")
+    if not usage:
+        return None
+    details = usage.get("prompt_tokens_details") or {}
+    return {
+        "input_tokens": usage.get("prompt_tokens", 0),
+        # OpenAI/Grok report prompt_tokens_details.cached_tokens, DeepSeek prompt_cache_hit_tokens
+        "cached_tokens": details.get("cached_tokens") or usage.get("prompt_cache_hit_tokens") or 0,
+        "output_tokens": usage.get("completion_tokens", 0)
+    }
+
+
+# Usage lists of the enclosing scopes (outermost first); provider pool tasks inherit them
+_usage_scopes: contextvars.ContextVar = contextvars.ContextVar('prompt_usage_scopes', default=())
+
+
+@contextmanager
+def usage_scope(calls: Optional[List[Dict]] = None):
+    """
+    Collect the usage of every provider call made inside the block into
+    `calls` (a new list by default). Enclosing scopes see the calls too.
+    """
+    calls = [] if calls is None else calls
+    token = _usage_scopes.set(_usage_scopes.get() + (calls,))
+    try:
+        yield calls
+    finally:
+        _usage_scopes.reset(token)
+
+
+def usage_summary(calls: List[Dict]) -> Dict:
+    """Totals for a usage_scope(), as reported in response meta."""
+    summary = {"calls": len(calls), "input_tokens": 0, "cached_tokens": 0, "output_tokens": 0}
+    for call in calls:
+        for key in ("input_tokens", "cached_tokens", "output_tokens"):
+            summary[key] += call.get(key, 0)
+    summary["uncached_tokens"] = summary["input_tokens"] - summary["cached_tokens"]
+    return summary
+
+
+class PromptCacheStats:
+    """Per-provider totals of input tokens and how many were served from a prompt cache."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._providers: Dict[str, Dict[str, int]] = {}
+
+    def record(self, provider: str, usage: Optional[Dict]):
+        if not usage:
+            return
+        for calls in _usage_scopes.get():
+            calls.append({"provider": provider, **usage})
+        with self._lock:
+            totals = self._providers.setdefault(
+                provider, {'calls': 0, 'input_tokens': 0, 'cached_tokens': 0, 'output_tokens': 0}
+            )
+            totals['calls'] += 1
+            for key in ('input_tokens', 'cached_tokens', 'output_tokens'):
+                totals[key] += usage.get(key, 0)
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            stats = {}
+            for provider, totals in self._providers.items():
+                stats[provider] = dict(totals)
+                stats[provider]['cached_ratio'] = (
+                    round(totals['cached_tokens'] / totals['input_tokens'], 3) if totals['input_tokens'] else 0.0
+                )
+            return stats
+
+
+class GeminiContextCache:
+    """
+    Explicit Gemini context caches (cachedContents) keyed by the exact
+    instructions + documents prefix, reused until shortly before they expire.
+
+    `create(body)` issues the cachedContents request and returns the entry's
+    name; it is supplied by the caller so HTTP stays with the provider code.
+    """
+
+    def __init__(self, model: str, create: Callable[[Dict], str], enabled: bool = GEMINI_CACHE_ENABLED,
+                 min_tokens: int = GEMINI_CACHE_MIN_TOKENS, ttl: int = GEMINI_CACHE_TTL,
+                 max_entries: int = GEMINI_CACHE_MAX_ENTRIES):
+        self.model = model
+        self.enabled = enabled
+        self.min_tokens = min_tokens
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._create = create
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._creating: Dict[str, threading.Event] = {}
+        self._paused_until = 0.0
+        self._unsupported = False
+        self._stats = {'hits': 0, 'created': 0, 'failures': 0, 'skipped_small': 0, 'skipped_volatile': 0}
+
+    def _key(self, prompt: LayeredPrompt) -> str:
+        return hashlib.sha256(f"{self.model}\0{prompt.system}\0{prompt.context}".encode('utf-8')).hexdigest()
+
+    def lookup(self, prompt: str) -> Optional[str]:
+        """cachedContents name covering the prompt's prefix, creating it if worthwhile; None = send inline."""
+        if not self.enabled or self._unsupported or not isinstance(prompt, LayeredPrompt):
+            return None
+        if not prompt.cacheable:
+            # A per-question context would create an entry that is never reused
+            with self._lock:
+                self._stats['skipped_volatile'] += 1
+            return None
+        if estimate_tokens(prompt.system) + estimate_tokens(prompt.context) < self.min_tokens:
+            with self._lock:
+                self._stats['skipped_small'] += 1
+            return None
+
+        key = self._key(prompt)
+        while True:
+            with self._lock:
+                now = time.time()
+                entry = self._entries.get(key)
+                # Leave a margin so the entry does not expire mid-request
+                if entry is not None and entry[1] - now > 30:
+                    self._entries.move_to_end(key)
+                    self._stats['hits'] += 1
+                    return entry[0]
+                if self._unsupported or now < self._paused_until:
+                    return None
+                pending = self._creating.get(key)
+                if pending is None:
+                    pending = self._creating[key] = threading.Event()
+                    break
+            # Another request is creating this cache: wait for it rather than creating a duplicate
+            if not pending.wait(timeout=15):
+                return None
+
+        try:
+            name = self._create(self._cache_body(prompt))
+        except Exception as e:
+            self._record_failure(e)
+            name = None
+
+        with self._lock:
+            self._creating.pop(key, None)
+            if name:
+                self._entries[key] = (name, time.time() + self.ttl)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    # Evicted entries expire server-side after their TTL
+                    self._entries.popitem(last=False)
+                self._stats['created'] += 1
+        pending.set()
+
+        if name:
+            print(f"Created Gemini context cache {name} (~{estimate_tokens(prompt.system + prompt.context)} tokens)")
+        return name
+
+    def _cache_body(self, prompt: LayeredPrompt) -> Dict:
+        body = {"model": f"models/{self.model}", "ttl": f"{self.ttl}s"}
+        if prompt.system:
+            body["systemInstruction"] = {"parts": [{"text": prompt.system}]}
+        if prompt.context:
+            body["contents"] = [{"role": "user", "parts": [{"text": prompt.context}]}]
+        return body
+
+    def _record_failure(self, error: Exception):
+        status = getattr(error, 'status_code', None)
+        with self._lock:
+            self._stats['failures'] += 1
+            if status in (400, 404):
+                # The model (or key) does not support explicit caching: stop trying
+                self._unsupported = True
+            else:
+                self._paused_until = time.time() + GEMINI_CACHE_RETRY_AFTER
+        print(f"Gemini context cache unavailable, sending prompts inline: {error}")
+
+    def invalidate(self, prompt: str):
+        """Forget the entry for this prompt (e.g. Gemini reports it expired)."""
+        if isinstance(prompt, LayeredPrompt):
+            with self._lock:
+                self._entries.pop(self._key(prompt), None)
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+            stats['enabled'] = self.enabled and not self._unsupported
+        return stats
+
+
+# Singleton instance
+_prompt_cache_stats = None
+
+def get_prompt_cache_stats() -> PromptCacheStats:
+    """Get or create the shared prompt-cache usage counters"""
+    global _prompt_cache_stats
+    if _prompt_cache_stats is None:
+        _prompt_cache_stats = PromptCacheStats()
+    return _prompt_cache_stats
+
+_gemini_context_cache = None
+
+def get_gemini_context_cache(model: str, create: Callable[[Dict], str]) -> GeminiContextCache:
+    """Get or create the shared Gemini context cache registry"""
+    global _gemini_context_cache
+    if _gemini_context_cache is None:
+        _gemini_context_cache = GeminiContextCache(model, create)
+    return _gemini_context_cache
@@ -0,0 +1,261 @@
+"""
+Shared Worker Pool for Provider I/O
+One long-lived, bounded executor for all outbound provider calls, with a
+concurrency cap and a bounded wait queue per provider. Work that cannot be
+admitted is rejected immediately with a retry hint, so overload turns into
+fast 503s instead of request threads piling up behind slow upstreams.
+"""
+
+import contextvars
+import os
+import threading
+import time
+import concurrent.futures
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Deque, Dict
+
+
+POOL_MAX_WORKERS = int(os.getenv('PROVIDER_POOL_WORKERS', '32'))
+POOL_MAX_QUEUE = int(os.getenv('PROVIDER_POOL_MAX_QUEUE', '64'))
+DEFAULT_PROVIDER_CONCURRENCY = int(os.getenv('PROVIDER_CONCURRENCY', '8'))
+DEFAULT_PROVIDER_QUEUE = int(os.getenv('PROVIDER_QUEUE', '16'))
+MAX_QUEUE_WAIT = float(os.getenv('PROVIDER_MAX_QUEUE_WAIT', '20'))
+
+# Local Ollama serves one generation at a time well; hosted APIs take more
+PROVIDER_CONCURRENCY_DEFAULTS = {
+    'ollama': 2,
+}
+
+
+class PoolSaturated(Exception):
+    """Raised when a provider call cannot be admitted; carries a retry hint."""
+
+    def __init__(self, provider: str, retry_after: float, reason: str):
+        self.provider = provider
+        self.retry_after = retry_after
+        super().__init__(f"Server busy: {provider} {reason}, retry in {retry_after:.0f}s")
+
+
+class _Waiter:
+    """A queued in-thread caller (e.g. a stream) waiting for a provider slot."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.enqueued_at = time.monotonic()
+        self.admitted = False
+        self.abandoned = False
+
+
+class _Task:
+    """A queued function call waiting for a provider slot."""
+
+    def __init__(self, fn: Callable, args, kwargs):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.future = concurrent.futures.Future()
+        self.enqueued_at = time.monotonic()
+        # Run with the submitter's context (e.g. its per-request usage scope)
+        self.context = contextvars.copy_context()
+
+
+class _ProviderLane:
+    def __init__(self, provider: str):
+        self.provider = provider
+        self.concurrency = int(os.getenv(
+            f'PROVIDER_CONCURRENCY_{provider.upper()}',
+            PROVIDER_CONCURRENCY_DEFAULTS.get(provider, DEFAULT_PROVIDER_CONCURRENCY)
+        ))
+        self.max_queue = int(os.getenv(f'PROVIDER_QUEUE_{provider.upper()}', DEFAULT_PROVIDER_QUEUE))
+        self.running = 0
+        self.queue: Deque = deque()
+
+        self.admitted = 0
+        self.rejected = 0
+        self.expired = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_service = 0.0
+        self.completed = 0
+
+    def avg_service(self) -> float:
+        return self.total_service / self.completed if self.completed else 5.0
+
+
+class ProviderExecutor:
+    def __init__(self, max_workers: int = POOL_MAX_WORKERS, max_queue: int = POOL_MAX_QUEUE,
+                 max_queue_wait: float = MAX_QUEUE_WAIT):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.max_queue_wait = max_queue_wait
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='provider-io'
+        )
+        self._lanes: Dict[str, _ProviderLane] = {}
+        self._lock = threading.Lock()
+
+    def _lane(self, provider: str) -> _ProviderLane:
+        if provider not in self._lanes:
+            self._lanes[provider] = _ProviderLane(provider)
+        return self._lanes[provider]
+
+    def _queued_total(self) -> int:
+        return sum(len(lane.queue) for lane in self._lanes.values())
+
+    def _retry_hint(self, lane: _ProviderLane) -> float:
+        # Time for everything ahead of a new arrival to drain through the lane
+        backlog = len(lane.queue) + 1
+        return max(1.0, backlog * lane.avg_service() / max(1, lane.concurrency))
+
+    def _admit_or_queue(self, lane: _ProviderLane, item) -> bool:
+        """Called with the lock held. True = run now, False = queued. Raises if rejected."""
+        if lane.running < lane.concurrency and not lane.queue:
+            lane.running += 1
+            lane.admitted += 1
+            return True
+        if len(lane.queue) >= lane.max_queue:
+            lane.rejected += 1
+            raise PoolSaturated(lane.provider, self._retry_hint(lane), "queue is full")
+        if self._queued_total() >= self.max_queue:
+            lane.rejected += 1
+            raise PoolSaturated(lane.provider, self._retry_hint(lane), "server queue is full")
+        lane.queue.append(item)
+        return False
+
+    def submit(self, provider: str, fn: Callable, *args, **kwargs) -> concurrent.futures.Future:
+        """
+        Run fn(*args, **kwargs) on the shared pool under provider's concurrency cap.
+
+        Raises:
+            PoolSaturated: if neither a slot nor a queue position is available
+        """
+        task = _Task(fn, args, kwargs)
+        with self._lock:
+            lane = self._lane(provider)
+            run_now = self._admit_or_queue(lane, task)
+        if run_now:
+            self._start(lane, task)
+        return task.future
+
+    def call(self, provider: str, fn: Callable, *args, **kwargs):
+        """submit() and wait for the result."""
+        return self.submit(provider, fn, *args, **kwargs).result()
+
+    @contextmanager
+    def slot(self, provider: str):
+        """
+        Hold one of provider's concurrency slots in the current thread
+        (for streams, which must be consumed by the request thread).
+        """
+        waiter = _Waiter()
+        with self._lock:
+            lane = self._lane(provider)
+            run_now = self._admit_or_queue(lane, waiter)
+
+        if not run_now:
+            if not waiter.event.wait(self.max_queue_wait):
+                with self._lock:
+                    if not waiter.admitted:
+                        waiter.abandoned = True
+                        lane.expired += 1
+                        raise PoolSaturated(provider, self._retry_hint(lane), "queue wait timed out")
+            self._record_wait(lane, waiter.enqueued_at)
+
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self._release(lane, started)
+
+    def _record_wait(self, lane: _ProviderLane, enqueued_at: float):
+        wait = time.monotonic() - enqueued_at
+        with self._lock:
+            lane.total_wait += wait
+            lane.max_wait = max(lane.max_wait, wait)
+
+    def _start(self, lane: _ProviderLane, task: _Task):
+        self._executor.submit(self._run_task, lane, task)
+
+    def _run_task(self, lane: _ProviderLane, task: _Task):
+        self._record_wait(lane, task.enqueued_at)
+        started = time.monotonic()
+        try:
+            if task.future.set_running_or_notify_cancel():
+                try:
+                    task.future.set_result(task.context.run(task.fn, *task.args, **task.kwargs))
+                except BaseException as e:
+                    task.future.set_exception(e)
+        finally:
+            self._release(lane, started)
+
+    def _release(self, lane: _ProviderLane, started: float):
+        """Free a slot and hand it straight to the next queued item, if any."""
+        to_start = None
+        with self._lock:
+            lane.running -= 1
+            lane.completed += 1
+            lane.total_service += time.monotonic() - started
+
+            while lane.queue:
+                item = lane.queue.popleft()
+                if isinstance(item, _Waiter) and item.abandoned:
+                    continue
+                if isinstance(item, _Task) and item.future.cancelled():
+                    # Its caller gave up while it was queued: don't spend a slot on it
+                    continue
+                if time.monotonic() - item.enqueued_at > self.max_queue_wait:
+                    lane.expired += 1
+                    if isinstance(item, _Task):
+                        item.future.set_exception(
+                            PoolSaturated(lane.provider, self._retry_hint(lane), "queue wait timed out")
+                        )
+                    continue
+                lane.running += 1
+                lane.admitted += 1
+                if isinstance(item, _Waiter):
+                    item.admitted = True
+                    item.event.set()
+                else:
+                    to_start = item
+                break
+
+        if to_start is not None:
+            self._start(lane, to_start)
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            providers = {}
+            for name, lane in self._lanes.items():
+                waited = lane.admitted or 1
+                providers[name] = {
+                    'concurrency': lane.concurrency,
+                    'running': lane.running,
+                    'queued': len(lane.queue),
+                    'max_queue': lane.max_queue,
+                    'admitted': lane.admitted,
+                    'rejected': lane.rejected,
+                    'expired': lane.expired,
+                    'avg_wait_ms': round(lane.total_wait / waited * 1000, 1),
+                    'max_wait_ms': round(lane.max_wait * 1000, 1),
+                    'avg_service_ms': round(lane.avg_service() * 1000, 1) if lane.completed else None
+                }
+            return {
+                'max_workers': self.max_workers,
+                'max_queue': self.max_queue,
+                'queue_depth': self._queued_total(),
+                'providers': providers
+            }
+
+
+# Singleton instance
+_provider_pool = None
+_provider_pool_lock = threading.Lock()
+
+def get_provider_pool() -> ProviderExecutor:
+    """Get or create the shared provider I/O pool"""
+    global _provider_pool
+    with _provider_pool_lock:
+        if _provider_pool is None:
+            _provider_pool = ProviderExecutor()
+    return _provider_pool
@@ -0,0 +1,246 @@
+"""
+Client-Side Rate Limiting for AI Providers
+Keeps a request budget and a token budget per provider (token buckets),
+tuned from the provider's own `x-ratelimit-*` / `Retry-After` headers when
+they are sent. Callers wait in line for budget, or are shed straight away
+when the wait would be too long, so bursts never reach the provider as 429s.
+"""
+
+import os
+import re
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional
+
+
+MAX_QUEUE_WAIT = float(os.getenv('RATE_LIMIT_MAX_WAIT', '10'))
+DEFAULT_429_BACKOFF = float(os.getenv('RATE_LIMIT_429_BACKOFF', '2'))
+MAX_429_BACKOFF = float(os.getenv('RATE_LIMIT_429_MAX_BACKOFF', '60'))
+
+_DURATION_PART_RE = re.compile(r'(\d+(?:\.\d+)?)(ms|h|m|s)')
+_RETRY_DELAY_RE = re.compile(r'"retryDelay"\s*:\s*"(\d+(?:\.\d+)?)s"')
+
+
+class RateLimitExceeded(Exception):
+    """Raised when a request is shed because the provider budget is exhausted."""
+
+    def __init__(self, provider: str, retry_after: float):
+        self.provider = provider
+        self.retry_after = retry_after
+        super().__init__(f"Rate limit (429): {provider} budget exhausted, retry in {retry_after:.1f}s")
+
+
+def parse_duration(value: str) -> Optional[float]:
+    """Parse '1s', '6m0s', '20ms', '1h2m3.5s' or a bare number of seconds."""
+    if value is None:
+        return None
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION_PART_RE.findall(value)
+    if not parts:
+        return None
+    scale = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+    return sum(float(number) * scale[unit] for number, unit in parts)
+
+
+def parse_retry_after(value: str) -> Optional[float]:
+    """Retry-After is either delay-seconds or an HTTP date."""
+    if not value:
+        return None
+    seconds = parse_duration(value)
+    if seconds is not None:
+        return max(0.0, seconds)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """
+    Classic token bucket. `reserve` lets the level go negative so that
+    waiting callers queue up in arrival order.
+    """
+
+    def __init__(self, capacity: Optional[float] = None, refill_rate: Optional[float] = None):
+        self.capacity = capacity        # None = unlimited
+        self.refill_rate = refill_rate  # units per second
+        self.level = capacity or 0.0
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        if self.capacity is None:
+            return
+        if self.refill_rate:
+            self.level = min(self.capacity, self.level + (now - self.updated) * self.refill_rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        self._refill(now)
+        if self.capacity is None:
+            return 0.0
+        # A single request larger than the whole bucket only needs a full bucket
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        if not self.refill_rate:
+            return float('inf')
+        return (amount - self.level) / self.refill_rate
+
+    def reserve(self, amount: float):
+        if self.capacity is not None:
+            self.level -= amount
+
+    def set_limits(self, limit: float, remaining: float, reset_in: Optional[float], now: float):
+        """Sync the bucket with what the provider reports."""
+        self.capacity = limit
+        self.level = min(remaining, limit)
+        if reset_in and reset_in > 0:
+            # Refill so the bucket is full again exactly when the window resets
+            self.refill_rate = max(limit - remaining, 1.0) / reset_in
+        elif not self.refill_rate:
+            self.refill_rate = limit / 60.0
+        self.updated = now
+
+
+class ProviderBudget:
+    def __init__(self, provider: str):
+        self.provider = provider
+        rpm = os.getenv(f'RATE_LIMIT_{provider.upper()}_RPM')
+        tpm = os.getenv(f'RATE_LIMIT_{provider.upper()}_TPM')
+        self.requests = TokenBucket(float(rpm), float(rpm) / 60.0) if rpm else TokenBucket()
+        self.tokens = TokenBucket(float(tpm), float(tpm) / 60.0) if tpm else TokenBucket()
+        self.blocked_until = 0.0
+        self.consecutive_429s = 0
+
+        self.queued = 0
+        self.admitted = 0
+        self.shed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.rate_limited_responses = 0
+
+
+class ProviderRateLimiter:
+    def __init__(self, max_queue_wait: float = MAX_QUEUE_WAIT):
+        self.max_queue_wait = max_queue_wait
+        self._budgets: Dict[str, ProviderBudget] = {}
+        self._lock = threading.Lock()
+
+    def _budget(self, provider: str) -> ProviderBudget:
+        if provider not in self._budgets:
+            self._budgets[provider] = ProviderBudget(provider)
+        return self._budgets[provider]
+
+    def acquire(self, provider: str, tokens: int = 0, max_wait: Optional[float] = None) -> float:
+        """
+        Block until `provider` has budget for one request of `tokens` tokens.
+
+        Returns:
+            Seconds spent waiting
+
+        Raises:
+            RateLimitExceeded: if the wait would exceed max_wait (request shed)
+        """
+        if max_wait is None:
+            max_wait = self.max_queue_wait
+
+        with self._lock:
+            budget = self._budget(provider)
+            now = time.monotonic()
+            wait = max(
+                budget.blocked_until - now,
+                budget.requests.wait_time(1, now),
+                budget.tokens.wait_time(tokens, now),
+                0.0
+            )
+            if wait > max_wait:
+                budget.shed += 1
+                raise RateLimitExceeded(provider, wait)
+
+            # Reserve now so later callers queue behind this one
+            budget.requests.reserve(1)
+            budget.tokens.reserve(tokens)
+            budget.admitted += 1
+            budget.total_wait += wait
+            budget.max_wait = max(budget.max_wait, wait)
+            if wait > 0:
+                budget.queued += 1
+
+        if wait > 0:
+            print(f"Rate limiter: waiting {wait:.2f}s for {provider} budget")
+            time.sleep(wait)
+            with self._lock:
+                budget.queued -= 1
+        return wait
+
+    def observe_response(self, provider: str, response):
+        """Update budgets from rate-limit headers (and 429s) on a provider response."""
+        headers = response.headers
+        now = time.monotonic()
+
+        with self._lock:
+            budget = self._budget(provider)
+
+            for kind, bucket in (('requests', budget.requests), ('tokens', budget.tokens)):
+                limit = headers.get(f'x-ratelimit-limit-{kind}')
+                remaining = headers.get(f'x-ratelimit-remaining-{kind}')
+                if limit is None or remaining is None:
+                    continue
+                try:
+                    bucket.set_limits(float(limit), float(remaining),
+                                      parse_duration(headers.get(f'x-ratelimit-reset-{kind}')), now)
+                except ValueError:
+                    continue
+
+            if response.status_code == 429:
+                budget.rate_limited_responses += 1
+                budget.consecutive_429s += 1
+                retry_after = parse_retry_after(headers.get('Retry-After'))
+                if retry_after is None:
+                    # Gemini puts the hint in the error body (RetryInfo.retryDelay)
+                    match = _RETRY_DELAY_RE.search(response.text or '')
+                    retry_after = float(match.group(1)) if match else None
+                if retry_after is None:
+                    retry_after = min(MAX_429_BACKOFF, DEFAULT_429_BACKOFF * 2 ** (budget.consecutive_429s - 1))
+                budget.blocked_until = max(budget.blocked_until, now + retry_after)
+                print(f"Rate limiter: {provider} returned 429, pausing for {retry_after:.1f}s")
+            elif response.status_code < 400:
+                budget.consecutive_429s = 0
+
+    def get_stats(self) -> Dict[str, Dict]:
+        with self._lock:
+            now = time.monotonic()
+            stats = {}
+            for provider, budget in self._budgets.items():
+                budget.requests._refill(now)
+                budget.tokens._refill(now)
+                stats[provider] = {
+                    'requests_available': None if budget.requests.capacity is None else round(budget.requests.level, 1),
+                    'requests_limit': budget.requests.capacity,
+                    'tokens_available': None if budget.tokens.capacity is None else round(budget.tokens.level),
+                    'tokens_limit': budget.tokens.capacity,
+                    'blocked_for_s': round(max(0.0, budget.blocked_until - now), 1),
+                    'queued': budget.queued,
+                    'admitted': budget.admitted,
+                    'shed': budget.shed,
+                    'rate_limited_responses': budget.rate_limited_responses,
+                    'avg_wait_ms': round(budget.total_wait / budget.admitted * 1000, 1) if budget.admitted else 0.0,
+                    'max_wait_ms': round(budget.max_wait * 1000, 1)
+                }
+            return stats
+
+
+# Singleton instance
+_rate_limiter = None
+
+def get_rate_limiter() -> ProviderRateLimiter:
+    """Get or create the shared provider rate limiter"""
+    global _rate_limiter
+    if _rate_limiter is None:
+        _rate_limiter = ProviderRateLimiter()
+    return _rate_limiter
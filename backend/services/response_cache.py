@@ -0,0 +1,198 @@
+"""
+LLM Response Cache
+Two tiers keyed by (provider, model, prompt hash): an in-memory LRU with
+TTL and a byte-size cap, backed by an on-disk SQLite store that survives
+restarts. Identical refine/summarize requests are answered without a
+provider round-trip.
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+
+CACHE_TTL = float(os.getenv('AI_CACHE_TTL', str(24 * 3600)))
+CACHE_MAX_ENTRIES = int(os.getenv('AI_CACHE_MAX_ENTRIES', '512'))
+CACHE_MAX_BYTES = int(os.getenv('AI_CACHE_MAX_BYTES', str(32 * 1024 * 1024)))
+CACHE_DISK_MAX_ROWS = int(os.getenv('AI_CACHE_DISK_MAX_ROWS', '20000'))
+CACHE_DIR = os.getenv('AI_CACHE_DIR', 'llm_cache')
+
+
+def make_cache_key(provider: str, model: str, prompt: str) -> str:
+    digest = hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+    return f"{provider}:{model}:{digest}"
+
+
+class ResponseCache:
+    def __init__(self, ttl: float = CACHE_TTL, max_entries: int = CACHE_MAX_ENTRIES,
+                 max_bytes: int = CACHE_MAX_BYTES, cache_dir: Optional[str] = CACHE_DIR,
+                 disk_max_rows: int = CACHE_DISK_MAX_ROWS):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.disk_max_rows = disk_max_rows
+
+        # key -> (value, expires_at, size_bytes)
+        self._memory: "OrderedDict[str, Tuple[str, float, int]]" = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+
+        self._db = None
+        self._db_lock = threading.Lock()
+        if cache_dir:
+            try:
+                directory = Path(cache_dir)
+                directory.mkdir(exist_ok=True)
+                self._db = sqlite3.connect(str(directory / 'responses.db'), check_same_thread=False)
+                self._db.execute("PRAGMA journal_mode=WAL")
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS responses ("
+                    " key TEXT PRIMARY KEY, value TEXT NOT NULL,"
+                    " created_at REAL NOT NULL, expires_at REAL NOT NULL)"
+                )
+                self._db.execute("CREATE INDEX IF NOT EXISTS idx_responses_expires ON responses(expires_at)")
+                self._db.commit()
+            except sqlite3.Error as e:
+                print(f"Response cache: disk tier disabled ({e})")
+                self._db = None
+
+        self._stats = {
+            'memory_hits': 0,
+            'disk_hits': 0,
+            'misses': 0,
+            'stores': 0,
+            'evictions': 0,
+            'expirations': 0,
+            'disk_evictions': 0
+        }
+
+    # ---- memory tier -------------------------------------------------
+
+    def _memory_get(self, key: str, now: float) -> Optional[str]:
+        entry = self._memory.get(key)
+        if entry is None:
+            return None
+        value, expires_at, size = entry
+        if expires_at <= now:
+            del self._memory[key]
+            self._memory_bytes -= size
+            self._stats['expirations'] += 1
+            return None
+        self._memory.move_to_end(key)
+        return value
+
+    def _memory_put(self, key: str, value: str, expires_at: float):
+        size = len(value.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_bytes -= old[2]
+        self._memory[key] = (value, expires_at, size)
+        self._memory_bytes += size
+
+        while len(self._memory) > self.max_entries or self._memory_bytes > self.max_bytes:
+            _, (_, _, evicted_size) = self._memory.popitem(last=False)
+            self._memory_bytes -= evicted_size
+            self._stats['evictions'] += 1
+
+    # ---- disk tier ---------------------------------------------------
+
+    def _disk_get(self, key: str, now: float) -> Optional[Tuple[str, float]]:
+        if self._db is None:
+            return None
+        with self._db_lock:
+            try:
+                row = self._db.execute(
+                    "SELECT value, expires_at FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+                if row and row[1] <= now:
+                    self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self._db.commit()
+                    self._stats['expirations'] += 1
+                    return None
+                return row
+            except sqlite3.Error as e:
+                print(f"Response cache read error: {e}")
+                return None
+
+    def _disk_put(self, key: str, value: str, now: float, expires_at: float):
+        if self._db is None:
+            return
+        with self._db_lock:
+            try:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO responses (key, value, created_at, expires_at) VALUES (?, ?, ?, ?)",
+                    (key, value, now, expires_at)
+                )
+                if self._stats['stores'] % 100 == 0:
+                    self._prune_disk(now)
+                self._db.commit()
+            except sqlite3.Error as e:
+                print(f"Response cache write error: {e}")
+
+    def _prune_disk(self, now: float):
+        """Drop expired rows, then the oldest rows beyond disk_max_rows."""
+        cursor = self._db.execute("DELETE FROM responses WHERE expires_at <= ?", (now,))
+        self._stats['expirations'] += cursor.rowcount
+        cursor = self._db.execute(
+            "DELETE FROM responses WHERE key IN ("
+            " SELECT key FROM responses ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+            (self.disk_max_rows,)
+        )
+        self._stats['disk_evictions'] += cursor.rowcount
+
+    # ---- public API --------------------------------------------------
+
+    def get(self, key: str) -> Tuple[Optional[str], Optional[str]]:
+        """Return (value, tier) where tier is 'memory', 'disk' or None on a miss."""
+        now = time.time()
+        with self._lock:
+            value = self._memory_get(key, now)
+            if value is not None:
+                self._stats['memory_hits'] += 1
+                return value, 'memory'
+
+        row = self._disk_get(key, now)
+        with self._lock:
+            if row is None:
+                self._stats['misses'] += 1
+                return None, None
+            # Promote to the memory tier
+            self._memory_put(key, row[0], row[1])
+            self._stats['disk_hits'] += 1
+            return row[0], 'disk'
+
+    def set(self, key: str, value: str, ttl: Optional[float] = None):
+        now = time.time()
+        expires_at = now + (ttl if ttl is not None else self.ttl)
+        with self._lock:
+            self._memory_put(key, value, expires_at)
+            self._stats['stores'] += 1
+        self._disk_put(key, value, now, expires_at)
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['memory_entries'] = len(self._memory)
+            stats['memory_bytes'] = self._memory_bytes
+        lookups = stats['memory_hits'] + stats['disk_hits'] + stats['misses']
+        stats['hit_rate'] = round((stats['memory_hits'] + stats['disk_hits']) / lookups, 3) if lookups else 0.0
+        stats['disk_enabled'] = self._db is not None
+        return stats
+
+
+# Singleton instance
+_response_cache = None
+
+def get_response_cache() -> ResponseCache:
+    """Get or create the shared response cache"""
+    global _response_cache
+    if _response_cache is None:
+        _response_cache = ResponseCache()
+    return _response_cache
@@ -0,0 +1,243 @@
+"""
+BM25 Retrieval over Uploaded Documents
+Documents are split into overlapping chunks at upload time; each session
+gets an in-memory inverted index over those chunks, and a prompt receives
+only the best-scoring chunks for the question within a token budget
+instead of every uploaded document. Scoring is vectorized with NumPy when
+it is installed, with a pure-Python fallback.
+"""
+
+import math
+import os
+import re
+import threading
+from collections import Counter, OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import numpy as np
+    HAS_NUMPY = True
+except ImportError:
+    HAS_NUMPY = False
+
+from services.tokens import estimate_tokens, CHARS_PER_TOKEN
+
+
+CHUNK_TOKENS = int(os.getenv('RETRIEVAL_CHUNK_TOKENS', '300'))
+CHUNK_OVERLAP_TOKENS = int(os.getenv('RETRIEVAL_CHUNK_OVERLAP_TOKENS', '50'))
+INDEX_CACHE_SIZE = int(os.getenv('RETRIEVAL_INDEX_CACHE', '64'))
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+_BREAK_RE = re.compile(r'\n\s*\n|(?<=[.!?])\s+')
+_STOPWORDS = frozenset(
+    "a an and are as at be but by for from has have how i in into is it its of on or that the "
+    "their them there these they this to was were what when where which who why will with you your "
+    "about can do does please tell me".split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+    return [t for t in _TOKEN_RE.findall(text.lower()) if len(t) > 1 and t not in _STOPWORDS]
+
+
+def chunk_document(text: str, page_offsets: Optional[List[int]] = None,
+                   chunk_tokens: int = CHUNK_TOKENS, overlap_tokens: int = CHUNK_OVERLAP_TOKENS) -> List[Dict]:
+    """
+    Split text into ~chunk_tokens pieces, ending at paragraph or sentence
+    breaks where possible, with overlap_tokens of overlap.
+
+    Returns:
+        [{"start": int, "end": int, "page": int}] character offsets into text
+        (page is 1-based, from page_offsets)
+    """
+    size = chunk_tokens * CHARS_PER_TOKEN
+    overlap = overlap_tokens * CHARS_PER_TOKEN
+    page_offsets = page_offsets or [0]
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = min(len(text), start + size)
+        if end < len(text):
+            # Prefer the last break in the second half of the window
+            breaks = [m.end() for m in _BREAK_RE.finditer(text, start + size // 2, end)]
+            if breaks:
+                end = breaks[-1]
+        page = sum(1 for offset in page_offsets if offset <= start) or 1
+        chunks.append({"start": start, "end": end, "page": page})
+        if end >= len(text):
+            break
+        start = max(end - overlap, start + 1)
+    return chunks
+
+
+class BM25Index:
+    """Inverted index over a fixed list of chunk texts."""
+
+    def __init__(self, texts: List[str], k1: float = BM25_K1, b: float = BM25_B):
+        self.k1 = k1
+        self.b = b
+        self.size = len(texts)
+
+        postings: Dict[str, List[Tuple[int, int]]] = {}
+        lengths = []
+        for chunk_id, text in enumerate(texts):
+            terms = Counter(tokenize(text))
+            lengths.append(sum(terms.values()))
+            for term, tf in terms.items():
+                postings.setdefault(term, []).append((chunk_id, tf))
+
+        avg_length = (sum(lengths) / len(lengths)) if lengths and sum(lengths) else 1.0
+        self.idf = {
+            term: math.log(1 + (self.size - len(plist) + 0.5) / (len(plist) + 0.5))
+            for term, plist in postings.items()
+        }
+        if HAS_NUMPY:
+            self.norm = k1 * (1 - b + b * np.asarray(lengths, dtype=np.float64) / avg_length)
+            self.postings = {
+                term: (np.fromiter((c for c, _ in plist), dtype=np.int64, count=len(plist)),
+                       np.fromiter((tf for _, tf in plist), dtype=np.float64, count=len(plist)))
+                for term, plist in postings.items()
+            }
+        else:
+            self.norm = [k1 * (1 - b + b * length / avg_length) for length in lengths]
+            self.postings = postings
+
+    def scores(self, query: str):
+        """BM25 score of every chunk for the query (array or list, indexed by chunk id)."""
+        terms = set(tokenize(query))
+        if HAS_NUMPY:
+            scores = np.zeros(self.size)
+            for term in terms:
+                if term not in self.postings:
+                    continue
+                ids, tfs = self.postings[term]
+                # Chunk ids within one posting list are unique, so += is safe
+                scores[ids] += self.idf[term] * tfs * (self.k1 + 1) / (tfs + self.norm[ids])
+            return scores
+
+        scores = [0.0] * self.size
+        for term in terms:
+            for chunk_id, tf in self.postings.get(term, ()):
+                scores[chunk_id] += self.idf[term] * tf * (self.k1 + 1) / (tf + self.norm[chunk_id])
+        return scores
+
+    def top(self, query: str, k: int) -> List[Tuple[int, float]]:
+        """Best k (chunk_id, score) pairs with a positive score, best first."""
+        scores = self.scores(query)
+        if HAS_NUMPY:
+            k = min(k, self.size)
+            if k <= 0:
+                return []
+            candidates = np.argpartition(-scores, k - 1)[:k]
+            ranked = candidates[np.argsort(-scores[candidates])]
+            return [(int(i), float(scores[i])) for i in ranked if scores[i] > 0]
+        ranked = sorted(range(self.size), key=lambda i: -scores[i])[:k]
+        return [(i, scores[i]) for i in ranked if scores[i] > 0]
+
+
+class SessionIndexes:
+    """Per-session BM25 indexes, rebuilt when the session's documents change (LRU)."""
+
+    def __init__(self, capacity: int = INDEX_CACHE_SIZE):
+        self.capacity = capacity
+        self._indexes: "OrderedDict[str, Tuple[tuple, BM25Index, List[Tuple[Dict, Dict]]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'builds': 0, 'hits': 0, 'queries': 0}
+
+    def _get(self, session_id: str, documents: List[Dict]):
+        signature = tuple(sorted(doc["id"] for doc in documents))
+        with self._lock:
+            cached = self._indexes.get(session_id)
+            if cached is not None and cached[0] == signature:
+                self._indexes.move_to_end(session_id)
+                self._stats['hits'] += 1
+                return cached[1], cached[2]
+
+        entries = []
+        for doc in documents:
+            # Documents uploaded before chunking was added are chunked here
+            chunks = doc.get("chunks") or chunk_document(doc["text"], doc.get("page_offsets"))
+            entries.extend((doc, chunk) for chunk in chunks)
+        index = BM25Index([doc["text"][chunk["start"]:chunk["end"]] for doc, chunk in entries])
+
+        with self._lock:
+            self._indexes[session_id] = (signature, index, entries)
+            self._indexes.move_to_end(session_id)
+            while len(self._indexes) > self.capacity:
+                self._indexes.popitem(last=False)
+            self._stats['builds'] += 1
+        return index, entries
+
+    def retrieve(self, session_id: str, documents: List[Dict], query: str,
+                 budget_tokens: int, top_k: int) -> Tuple[str, Dict]:
+        """
+        Context made of the best chunks for `query` that fit in budget_tokens,
+        grouped by document in reading order.
+
+        Returns:
+            (context, report); context is '' when nothing matched.
+        """
+        report = {"mode": "retrieval", "budget_tokens": budget_tokens, "used_tokens": 0, "chunks": []}
+        if not documents or not query.strip():
+            return "", report
+
+        index, entries = self._get(session_id, documents)
+        with self._lock:
+            self._stats['queries'] += 1
+
+        picked = []
+        used = 0
+        for chunk_id, score in index.top(query, top_k):
+            doc, chunk = entries[chunk_id]
+            cost = estimate_tokens(doc["text"][chunk["start"]:chunk["end"]]) + 16
+            if used + cost > budget_tokens:
+                continue
+            picked.append((chunk_id, score))
+            used += cost
+
+        if not picked:
+            return "", report
+
+        # Keep document order and reading order within each document
+        picked.sort(key=lambda item: item[0])
+        blocks = []
+        current_doc = None
+        for chunk_id, score in picked:
+            doc, chunk = entries[chunk_id]
+            if doc is not current_doc:
+                if current_doc is not None:
+                    blocks.append("--- End of Document ---\n")
+                blocks.append(
+                    f"\n--- Start of Document (relevant excerpts) ---\n"
+                    f"Metadata: Filename='{doc['name']}', Title='{doc.get('title', doc['name'])}', "
+                    f"Author='{doc.get('author', 'Unknown Author')}'\n"
+                )
+                current_doc = doc
+            blocks.append(f"[Excerpt, page {chunk['page']}]\n{doc['text'][chunk['start']:chunk['end']].strip()}\n")
+            report["chunks"].append({
+                "doc_id": doc["id"], "name": doc["name"], "page": chunk["page"], "score": round(score, 3)
+            })
+        blocks.append("--- End of Document ---\n")
+
+        report["used_tokens"] = used
+        return "".join(blocks), report
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['cached_sessions'] = len(self._indexes)
+        stats['numpy'] = HAS_NUMPY
+        return stats
+
+
+# Singleton instance
+_session_indexes = None
+
+def get_session_indexes() -> SessionIndexes:
+    """Get or create the shared per-session retrieval indexes"""
+    global _session_indexes
+    if _session_indexes is None:
+        _session_indexes = SessionIndexes()
+    return _session_indexes
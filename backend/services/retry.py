@@ -0,0 +1,136 @@
+"""
+Unified Retry Policy for AI Provider Calls
+Exponential backoff with full jitter, Retry-After support, per-provider
+retryable-error classification and a total time budget, so a request never
+spends longer than its deadline retrying.
+"""
+
+import os
+import random
+import time
+from typing import Callable, Dict, Optional, Set, Tuple
+
+import requests
+
+
+DEFAULT_RETRYABLE_STATUSES = {408, 409, 425, 429, 500, 502, 503, 504}
+MIN_ATTEMPT_TIME = 1.0  # Don't start an attempt with less than this left
+
+
+class ProviderError(Exception):
+    """
+    An error returned by (or while reaching) a provider.
+
+    Args:
+        provider: Provider name (e.g. 'openai')
+        status_code: HTTP status, or None for network errors
+        message: Human-readable message (kept in the existing "X Error 429: ..." form)
+        retry_after: Seconds the provider asked us to wait, if any
+        retryable: Force the classification (e.g. quota exhaustion is a 429
+            that must not be retried)
+    """
+
+    def __init__(self, provider: str, status_code: Optional[int], message: str,
+                 retry_after: Optional[float] = None, retryable: Optional[bool] = None):
+        self.provider = provider
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.retryable = retryable
+        super().__init__(message)
+
+
+class DeadlineExceeded(Exception):
+    """Raised when the total retry budget runs out before a call can be attempted."""
+
+
+class RetryPolicy:
+    def __init__(self, max_attempts: int = 3, base_delay: float = 0.5, max_delay: float = 8.0,
+                 total_budget: float = 60.0, retryable_statuses: Optional[Set[int]] = None):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.total_budget = total_budget
+        self.retryable_statuses = retryable_statuses if retryable_statuses is not None else DEFAULT_RETRYABLE_STATUSES
+
+    def classify(self, error: Exception) -> Tuple[bool, Optional[float]]:
+        """Return (retryable, retry_after_seconds) for an error."""
+        if isinstance(error, ProviderError):
+            if error.retryable is not None:
+                return error.retryable, error.retry_after
+            if error.status_code is None:
+                return True, error.retry_after
+            return error.status_code in self.retryable_statuses, error.retry_after
+        if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+            return True, None
+        return False, None
+
+    def backoff(self, attempt: int) -> float:
+        """Full jitter: uniform(0, min(max_delay, base * 2^(attempt-1)))."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def run(self, fn: Callable[[float], object], provider: str,
+            attempt_timeout: float = 30.0, budget: Optional[float] = None):
+        """
+        Call fn(timeout) until it succeeds, fails permanently, or the budget is spent.
+
+        Args:
+            fn: The attempt; receives the timeout (seconds) it may use
+            provider: Provider name, for logging
+            attempt_timeout: Upper bound for a single attempt
+            budget: Total seconds for all attempts and waits (default: policy's total_budget)
+        """
+        deadline = time.monotonic() + (budget if budget is not None else self.total_budget)
+        last_error = None
+
+        for attempt in range(1, self.max_attempts + 1):
+            remaining = deadline - time.monotonic()
+            if remaining < MIN_ATTEMPT_TIME:
+                break
+            try:
+                return fn(min(attempt_timeout, remaining))
+            except Exception as e:
+                last_error = e
+                retryable, retry_after = self.classify(e)
+                if not retryable or attempt == self.max_attempts:
+                    raise
+
+                delay = self.backoff(attempt)
+                if retry_after is not None:
+                    delay = max(delay, retry_after)
+                if time.monotonic() + delay > deadline - MIN_ATTEMPT_TIME:
+                    print(f"{provider}: no time left in retry budget, giving up after attempt {attempt}")
+                    raise
+                print(f"{provider} attempt {attempt} failed ({e}); retrying in {delay:.2f}s")
+                time.sleep(delay)
+
+        if last_error is not None:
+            raise last_error
+        raise DeadlineExceeded(f"{provider}: retry budget exhausted before the request could be sent")
+
+
+# Per-provider overrides. Manus creates a task per call, which is not safe to repeat.
+PROVIDER_POLICIES = {
+    'manus': {'max_attempts': 1},
+    'ollama': {'total_budget': 180.0, 'retryable_statuses': {500, 502, 503, 504}},
+}
+
+
+def _build_policy(provider: str) -> RetryPolicy:
+    settings = dict(PROVIDER_POLICIES.get(provider, {}))
+    prefix = f'RETRY_{provider.upper()}_'
+    for key, cast in (('max_attempts', int), ('base_delay', float), ('max_delay', float), ('total_budget', float)):
+        value = os.getenv(prefix + key.upper())
+        if value is None and key not in settings:
+            value = os.getenv('RETRY_' + key.upper())
+        if value:
+            settings[key] = cast(value)
+    return RetryPolicy(**settings)
+
+
+_policies: Dict[str, RetryPolicy] = {}
+
+def get_retry_policy(provider: str) -> RetryPolicy:
+    """Get the retry policy for a provider (env overrides: RETRY_<PROVIDER>_MAX_ATTEMPTS etc.)"""
+    if provider not in _policies:
+        _policies[provider] = _build_policy(provider)
+    return _policies[provider]
@@ -0,0 +1,498 @@
+"""
+Session Store
+Keeps per-session state (uploaded document records, images, document
+metadata) behind a small interface with two backends: in-process memory,
+and SQLite in WAL mode, which survives restarts and can be shared by
+several worker processes. The SQLite backend compresses large sessions and
+keeps recently used ones in memory.
+
+Resident sessions are bounded: idle sessions expire after SESSION_TTL, and
+the least recently used ones are evicted beyond SESSION_MAX_SESSIONS or
+SESSION_MAX_BYTES. Writers take a per-session lock from a striped set, so
+requests for different sessions rarely share a lock. Across SQLite worker
+processes, updates are optimistic: a write only lands if the session is
+unchanged since it was read, otherwise the update is re-run.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+
+SESSION_STORE = os.getenv('SESSION_STORE', 'sqlite')
+SESSION_DB = os.getenv('SESSION_DB', 'session_store/sessions.db')
+SESSION_HOT_CACHE = int(os.getenv('SESSION_HOT_CACHE', '128'))
+COMPRESS_MIN_BYTES = int(os.getenv('SESSION_COMPRESS_MIN_BYTES', '4096'))
+
+SESSION_TTL = float(os.getenv('SESSION_TTL', str(24 * 3600)))  # idle seconds
+SESSION_MAX_AGE = float(os.getenv('SESSION_MAX_AGE', '0'))  # seconds since created_at, 0 = no limit
+SESSION_MAX_SESSIONS = int(os.getenv('SESSION_MAX_SESSIONS', '1000'))
+SESSION_MAX_BYTES = int(os.getenv('SESSION_MAX_BYTES', str(256 * 1024 * 1024)))
+SESSION_LOCK_STRIPES = int(os.getenv('SESSION_LOCK_STRIPES', '64'))
+SESSION_UPDATE_RETRIES = int(os.getenv('SESSION_UPDATE_RETRIES', '5'))
+SWEEP_INTERVAL = 60.0
+TOUCH_INTERVAL = 300.0  # how often a read refreshes a stored session's accessed_at
+
+
+class SessionConflict(Exception):
+    """An update kept losing to concurrent writers from other workers."""
+
+
+def new_session() -> Dict:
+    return {
+        "documents": {},
+        "doc_index": {},
+        "images": [],
+        "docs": [],
+        "created_at": time.time()
+    }
+
+
+def session_size(session: Dict) -> int:
+    """Approximate resident bytes of a session (dominated by its documents' text)."""
+    size = len(session.get("context", ""))
+    for doc in session.get("documents", {}).values():
+        size += len(doc.get("text", "")) + 256
+    for item in session.get("images", []) + session.get("docs", []):
+        size += sum(len(str(value)) for value in item.values()) if isinstance(item, dict) else len(str(item))
+    return size
+
+
+class ResidentSessions:
+    """LRU of deserialized sessions with idle TTL, a count cap and a byte ceiling."""
+
+    def __init__(self, max_sessions: int, max_bytes: int, ttl: float, max_age: float = SESSION_MAX_AGE):
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_age = max_age
+
+        # session_id -> [session, version, size_bytes, last_access]
+        self._entries: "OrderedDict[str, list]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.evictions = {'ttl': 0, 'lru': 0, 'memory': 0}
+
+    def _expired(self, entry: list, now: float) -> bool:
+        if self.ttl and now - entry[3] > self.ttl:
+            return True
+        return bool(self.max_age) and now - entry[0].get('created_at', now) > self.max_age
+
+    def _drop(self, session_id: str, reason: str):
+        entry = self._entries.pop(session_id)
+        self._bytes -= entry[2]
+        self.evictions[reason] += 1
+
+    def get(self, session_id: str) -> Optional[Tuple[Dict, object]]:
+        """Return (session, version) or None if not resident (or expired)."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None:
+                return None
+            if self._expired(entry, now):
+                self._drop(session_id, 'ttl')
+                return None
+            entry[3] = now
+            self._entries.move_to_end(session_id)
+            return entry[0], entry[1]
+
+    def put(self, session_id: str, session: Dict, version=None) -> List[str]:
+        """Insert or refresh a session; returns the ids evicted to make room."""
+        size = session_size(session)
+        evicted = []
+        with self._lock:
+            old = self._entries.pop(session_id, None)
+            if old is not None:
+                self._bytes -= old[2]
+            self._entries[session_id] = [session, version, size, time.time()]
+            self._bytes += size
+
+            while len(self._entries) > 1 and (len(self._entries) > self.max_sessions or self._bytes > self.max_bytes):
+                victim = next(iter(self._entries))
+                self._drop(victim, 'lru' if len(self._entries) > self.max_sessions else 'memory')
+                evicted.append(victim)
+        return evicted
+
+    def pop(self, session_id: str):
+        with self._lock:
+            entry = self._entries.pop(session_id, None)
+            if entry is not None:
+                self._bytes -= entry[2]
+
+    def expire(self) -> List[str]:
+        """Drop every idle/over-age session; returns their ids."""
+        now = time.time()
+        with self._lock:
+            expired = [sid for sid, entry in self._entries.items() if self._expired(entry, now)]
+            for sid in expired:
+                self._drop(sid, 'ttl')
+        return expired
+
+    def items(self) -> List[Tuple[str, Dict]]:
+        """Snapshot of resident (session_id, session) pairs."""
+        with self._lock:
+            return [(sid, entry[0]) for sid, entry in self._entries.items()]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'resident_sessions': len(self._entries),
+                'resident_bytes': self._bytes,
+                'max_sessions': self.max_sessions,
+                'max_bytes': self.max_bytes,
+                'ttl_s': self.ttl,
+                'evictions': dict(self.evictions)
+            }
+
+
+class SessionStore:
+    """
+    Interface for session backends. get() returns a session dict (creating
+    it if needed). To modify a session, use update(session_id, mutate).
+    """
+
+    def __init__(self, stripes: int = SESSION_LOCK_STRIPES):
+        self._stripes = [threading.RLock() for _ in range(stripes)]
+        self._last_sweep = time.monotonic()
+        self._sweep_lock = threading.Lock()
+
+    @contextmanager
+    def lock(self, session_id: str):
+        """Per-session lock (striped: unrelated sessions rarely share one; re-entrant)."""
+        stripe = self._stripes[hash(session_id) % len(self._stripes)]
+        with stripe:
+            yield
+
+    def _maybe_sweep(self):
+        """Expire idle sessions at most once per SWEEP_INTERVAL, from whichever request comes first."""
+        if time.monotonic() - self._last_sweep < SWEEP_INTERVAL:
+            return
+        if not self._sweep_lock.acquire(blocking=False):
+            return
+        try:
+            self._last_sweep = time.monotonic()
+            self.sweep()
+        finally:
+            self._sweep_lock.release()
+
+    def sweep(self):
+        raise NotImplementedError
+
+    def get(self, session_id: str) -> Dict:
+        raise NotImplementedError
+
+    def save(self, session_id: str, session: Dict):
+        raise NotImplementedError
+
+    def update(self, session_id: str, mutate: Callable[[Dict], Any]) -> Any:
+        """
+        Read-modify-write: call mutate(session) to change the session in
+        place, then save it. Returns mutate's result. mutate may run more
+        than once (when another writer got in first), so it must only
+        depend on the session it is given.
+        """
+        with self.lock(session_id):
+            session = self.get(session_id)
+            result = mutate(session)
+            self.save(session_id, session)
+            return result
+
+    def delete(self, session_id: str):
+        raise NotImplementedError
+
+    def scan(self) -> Iterator[Tuple[str, Dict]]:
+        """Every stored (session_id, session), read-only; does not count as access."""
+        raise NotImplementedError
+
+    def count(self) -> int:
+        raise NotImplementedError
+
+    def get_stats(self) -> Dict:
+        return {'backend': type(self).__name__, 'sessions': self.count(), 'lock_stripes': len(self._stripes)}
+
+
+class MemorySessionStore(SessionStore):
+    """Process-local sessions; lost on restart. Evicted sessions are gone."""
+
+    def __init__(self, max_sessions: int = SESSION_MAX_SESSIONS, max_bytes: int = SESSION_MAX_BYTES,
+                 ttl: float = SESSION_TTL):
+        super().__init__()
+        self._sessions = ResidentSessions(max_sessions, max_bytes, ttl)
+
+    def get(self, session_id: str) -> Dict:
+        self._maybe_sweep()
+        hit = self._sessions.get(session_id)
+        if hit is not None:
+            return hit[0]
+        with self.lock(session_id):
+            # Another request may have created it while we waited
+            hit = self._sessions.get(session_id)
+            if hit is not None:
+                return hit[0]
+            session = new_session()
+            self._sessions.put(session_id, session)
+            return session
+
+    def save(self, session_id: str, session: Dict):
+        # Re-insert to refresh its byte accounting
+        self._sessions.put(session_id, session)
+
+    def delete(self, session_id: str):
+        self._sessions.pop(session_id)
+
+    def scan(self) -> Iterator[Tuple[str, Dict]]:
+        return iter(self._sessions.items())
+
+    def sweep(self):
+        self._sessions.expire()
+
+    def count(self) -> int:
+        return len(self._sessions)
+
+    def get_stats(self) -> Dict:
+        stats = super().get_stats()
+        stats.update(self._sessions.stats())
+        return stats
+
+
+class SQLiteSessionStore(SessionStore):
+    def __init__(self, path: str = SESSION_DB, hot_size: int = SESSION_HOT_CACHE,
+                 compress_min_bytes: int = COMPRESS_MIN_BYTES, max_bytes: int = SESSION_MAX_BYTES,
+                 ttl: float = SESSION_TTL):
+        """
+        Args:
+            path: Database file (created with its directory if missing)
+            hot_size: Sessions kept deserialized in memory (LRU)
+            compress_min_bytes: Serialized sessions at least this big are zlib-compressed
+            max_bytes: Byte ceiling for the in-memory hot set
+            ttl: Idle seconds after which a session is deleted from memory and disk
+        """
+        super().__init__()
+        self.path = path
+        self.compress_min_bytes = compress_min_bytes
+        self.ttl = ttl
+
+        # Versions are the row's updated_at, so writes from other workers invalidate
+        self._hot = ResidentSessions(hot_size, max_bytes, ttl)
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._touched: Dict[str, float] = {}
+        # One connection per thread: WAL lets readers run alongside the writer
+        self._local = threading.local()
+
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        db = self._conn()
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            " id TEXT PRIMARY KEY, data BLOB NOT NULL, compressed INTEGER NOT NULL,"
+            " created_at REAL NOT NULL, updated_at REAL NOT NULL, accessed_at REAL NOT NULL DEFAULT 0)"
+        )
+        columns = [row[1] for row in db.execute("PRAGMA table_info(sessions)")]
+        if 'accessed_at' not in columns:
+            db.execute("ALTER TABLE sessions ADD COLUMN accessed_at REAL NOT NULL DEFAULT 0")
+        db.execute("CREATE INDEX IF NOT EXISTS idx_sessions_accessed ON sessions(accessed_at)")
+        db.commit()
+
+        self._stats = {
+            'hot_hits': 0, 'db_reads': 0, 'writes': 0, 'conflicts': 0, 'bytes_raw': 0, 'bytes_stored': 0,
+            'expired_on_disk': 0
+        }
+
+    def _write(self, sql: str, params: tuple = ()) -> sqlite3.Cursor:
+        with self._write_lock:
+            db = self._conn()
+            cursor = db.execute(sql, params)
+            db.commit()
+        return cursor
+
+    def _conn(self) -> sqlite3.Connection:
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=10)
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def _encode(self, session: Dict) -> Tuple[bytes, bool]:
+        raw = json.dumps(session, ensure_ascii=False).encode('utf-8')
+        if len(raw) >= self.compress_min_bytes:
+            packed = zlib.compress(raw, 6)
+            with self._lock:
+                self._stats['bytes_raw'] += len(raw)
+                self._stats['bytes_stored'] += len(packed)
+            return packed, True
+        return raw, False
+
+    @staticmethod
+    def _decode(data: bytes, compressed: bool) -> Dict:
+        if compressed:
+            data = zlib.decompress(data)
+        return json.loads(data)
+
+    def _touch(self, session_id: str, now: float):
+        """Record a read so idle expiry sees it (throttled to one write per TOUCH_INTERVAL)."""
+        with self._lock:
+            if now - self._touched.get(session_id, 0) < TOUCH_INTERVAL:
+                return
+            self._touched[session_id] = now
+        self._write("UPDATE sessions SET accessed_at = ? WHERE id = ?", (now, session_id))
+
+    def get(self, session_id: str) -> Dict:
+        self._maybe_sweep()
+        return self._load(session_id)[0]
+
+    def _load(self, session_id: str) -> Tuple[Dict, float]:
+        """(session, version), creating the session if it does not exist yet."""
+        now = time.time()
+        db = self._conn()
+        row = db.execute("SELECT updated_at FROM sessions WHERE id = ?", (session_id,)).fetchone()
+
+        if row is not None:
+            # Another worker may have written since we cached it: compare versions
+            hot = self._hot.get(session_id)
+            if hot is not None and hot[1] == row[0]:
+                with self._lock:
+                    self._stats['hot_hits'] += 1
+                self._touch(session_id, now)
+                return hot[0], hot[1]
+
+            full = db.execute(
+                "SELECT data, compressed, updated_at FROM sessions WHERE id = ?", (session_id,)
+            ).fetchone()
+            if full is not None:
+                session = self._decode(full[0], bool(full[1]))
+                with self._lock:
+                    self._stats['db_reads'] += 1
+                self._hot.put(session_id, session, full[2])
+                self._touch(session_id, now)
+                return session, full[2]
+
+        session = new_session()
+        data, compressed = self._encode(session)
+        cursor = self._write(
+            "INSERT INTO sessions (id, data, compressed, created_at, updated_at, accessed_at)"
+            " VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(id) DO NOTHING",
+            (session_id, data, int(compressed), session['created_at'], now, now)
+        )
+        if cursor.rowcount == 0:
+            # Another request or worker created it first
+            return self._load(session_id)
+        self._stored(session_id, session, now)
+        return session, now
+
+    def _stored(self, session_id: str, session: Dict, version: float):
+        with self._lock:
+            self._stats['writes'] += 1
+            self._touched[session_id] = version
+        self._hot.put(session_id, session, version)
+
+    def save(self, session_id: str, session: Dict):
+        """Unconditional write; use update() for read-modify-write."""
+        data, compressed = self._encode(session)
+        now = time.time()
+        self._write(
+            "INSERT INTO sessions (id, data, compressed, created_at, updated_at, accessed_at)"
+            " VALUES (?, ?, ?, ?, ?, ?)"
+            " ON CONFLICT(id) DO UPDATE SET data = excluded.data, compressed = excluded.compressed,"
+            " updated_at = excluded.updated_at, accessed_at = excluded.accessed_at",
+            (session_id, data, int(compressed), session.get('created_at', now), now, now)
+        )
+        self._stored(session_id, session, now)
+
+    def update(self, session_id: str, mutate: Callable[[Dict], Any]) -> Any:
+        """
+        Optimistic read-modify-write. The write only lands if the row's
+        updated_at is still the version that was read; if another worker
+        wrote in between, the session is re-read and mutate runs again.
+        No database lock is held while mutate runs.
+        """
+        with self.lock(session_id):
+            for _ in range(SESSION_UPDATE_RETRIES):
+                session, version = self._load(session_id)
+                result = mutate(session)
+                data, compressed = self._encode(session)
+                # Strictly newer, even if two writes share a clock tick
+                now = max(time.time(), version + 1e-6)
+                cursor = self._write(
+                    "UPDATE sessions SET data = ?, compressed = ?, updated_at = ?, accessed_at = ?"
+                    " WHERE id = ? AND updated_at = ?",
+                    (data, int(compressed), now, now, session_id, version)
+                )
+                if cursor.rowcount:
+                    self._stored(session_id, session, now)
+                    return result
+                # Lost the race: the hot copy holds our discarded changes
+                self._hot.pop(session_id)
+                with self._lock:
+                    self._stats['conflicts'] += 1
+        raise SessionConflict(f"Session {session_id} changed concurrently {SESSION_UPDATE_RETRIES} times")
+
+    def delete(self, session_id: str):
+        self._write("DELETE FROM sessions WHERE id = ?", (session_id,))
+        self._hot.pop(session_id)
+        with self._lock:
+            self._touched.pop(session_id, None)
+
+    def scan(self) -> Iterator[Tuple[str, Dict]]:
+        # A separate connection: the cursor stays open while callers write
+        db = sqlite3.connect(self.path, timeout=10)
+        try:
+            for session_id, data, compressed in db.execute("SELECT id, data, compressed FROM sessions"):
+                yield session_id, self._decode(data, bool(compressed))
+        finally:
+            db.close()
+
+    def sweep(self):
+        """Drop idle sessions from the hot set and delete them from disk."""
+        self._hot.expire()
+        if not self.ttl:
+            return
+        cutoff = time.time() - self.ttl
+        cursor = self._write("DELETE FROM sessions WHERE accessed_at < ? AND updated_at < ?", (cutoff, cutoff))
+        with self._lock:
+            self._stats['expired_on_disk'] += cursor.rowcount
+            self._touched = {sid: t for sid, t in self._touched.items() if t >= cutoff}
+
+    def count(self) -> int:
+        return self._conn().execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    def get_stats(self) -> Dict:
+        stats = super().get_stats()
+        stats.update(self._hot.stats())
+        with self._lock:
+            stats.update(self._stats)
+        stats['compression_ratio'] = (
+            round(stats['bytes_stored'] / stats['bytes_raw'], 3) if stats['bytes_raw'] else None
+        )
+        stats['path'] = self.path
+        return stats
+
+
+# Singleton instance
+_session_store = None
+
+def get_session_store() -> SessionStore:
+    """Get or create the session store selected by SESSION_STORE ('sqlite' or 'memory')"""
+    global _session_store
+    if _session_store is None:
+        if SESSION_STORE == 'memory':
+            _session_store = MemorySessionStore()
+        else:
+            try:
+                _session_store = SQLiteSessionStore()
+            except sqlite3.Error as e:
+                print(f"Session store: SQLite unavailable ({e}), using memory")
+                _session_store = MemorySessionStore()
+    return _session_store
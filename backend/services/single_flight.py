@@ -0,0 +1,197 @@
+"""
+Single-Flight Request Coalescing
+Concurrent identical requests (same provider, model and prompt) share one
+upstream call. Blocking callers wait for the leader's result; streaming
+callers get a replay of the chunks received so far, then the live tail.
+"""
+
+import threading
+import concurrent.futures
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+
+class _Call:
+    """An in-flight blocking call."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error: Optional[BaseException] = None
+        # One entry per caller: its cancel event, or None if it cannot be cancelled
+        self.cancels: List[Optional[threading.Event]] = []
+
+
+class _Flight:
+    """
+    An in-flight stream. There is no pump thread: whichever subscriber
+    runs out of buffered chunks first pulls the next one from upstream.
+    """
+
+    def __init__(self, upstream: Iterator[str]):
+        self.upstream = upstream
+        self.chunks: List[str] = []
+        self.finished = False
+        self.error: Optional[BaseException] = None
+        self.pumping = False
+        self.subscribers = 0
+        self.cond = threading.Condition()
+
+
+class SingleFlight:
+    def __init__(self):
+        self._calls: Dict[str, _Call] = {}
+        self._flights: Dict[str, _Flight] = {}
+        self._lock = threading.Lock()
+        self._stats = {
+            'calls': 0,
+            'coalesced_calls': 0,
+            'cancelled_calls': 0,
+            'streams': 0,
+            'coalesced_streams': 0,
+            'replayed_chunks': 0
+        }
+
+    def do(self, key: str, fn: Callable[[Callable[[], bool]], object],
+           cancel: Optional[threading.Event] = None) -> Tuple[object, bool]:
+        """
+        Run fn(aborted) once per key at a time. aborted() turns True once
+        every caller waiting on the call has been cancelled, so fn can stop
+        the upstream request; while anyone still wants the result it stays False.
+
+        Args:
+            cancel: Set to withdraw this caller; a joined caller then raises
+                concurrent.futures.CancelledError right away
+
+        Returns:
+            (result, shared): shared is True if this caller joined another
+            caller's in-flight call instead of running fn itself.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+                self._stats['calls'] += 1
+            else:
+                self._stats['coalesced_calls'] += 1
+            call.cancels.append(cancel)
+
+        if not leader:
+            while not call.done.wait(0.1 if cancel is not None else None):
+                if cancel.is_set():
+                    with self._lock:
+                        self._stats['cancelled_calls'] += 1
+                    raise concurrent.futures.CancelledError()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        def aborted() -> bool:
+            with self._lock:
+                return all(c is not None and c.is_set() for c in call.cancels)
+
+        try:
+            call.result = fn(aborted)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+        return call.result, False
+
+    def stream(self, key: str, open_stream: Callable[[], Iterator[str]]) -> Iterator[str]:
+        """
+        Generator over a shared stream. The first subscriber opens it with
+        open_stream(); the upstream is closed once every subscriber has left.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = _Flight(open_stream())
+                self._flights[key] = flight
+                self._stats['streams'] += 1
+            else:
+                self._stats['coalesced_streams'] += 1
+                self._stats['replayed_chunks'] += len(flight.chunks)
+            flight.subscribers += 1
+
+        index = 0
+        try:
+            while True:
+                pump = False
+                with flight.cond:
+                    while index >= len(flight.chunks) and not flight.finished and flight.pumping:
+                        flight.cond.wait()
+                    if index < len(flight.chunks):
+                        chunk = flight.chunks[index]
+                        index += 1
+                    elif flight.finished:
+                        if flight.error is not None:
+                            raise flight.error
+                        return
+                    else:
+                        flight.pumping = True
+                        pump = True
+
+                if pump:
+                    self._pump(key, flight)
+                    continue
+                yield chunk
+        finally:
+            self._unsubscribe(key, flight)
+
+    def _pump(self, key: str, flight: _Flight):
+        """Pull one chunk from upstream (outside the condition lock) and publish it."""
+        chunk, finished, error = None, False, None
+        try:
+            chunk = next(flight.upstream)
+        except StopIteration:
+            finished = True
+        except Exception as e:
+            finished, error = True, e
+
+        with flight.cond:
+            if finished:
+                flight.finished = True
+                flight.error = error
+            else:
+                flight.chunks.append(chunk)
+            flight.pumping = False
+            flight.cond.notify_all()
+
+        if finished:
+            # Late arrivals from now on start a fresh call
+            with self._lock:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+
+    def _unsubscribe(self, key: str, flight: _Flight):
+        with self._lock:
+            flight.subscribers -= 1
+            abandoned = flight.subscribers == 0 and not flight.finished
+            if abandoned and self._flights.get(key) is flight:
+                del self._flights[key]
+        if abandoned:
+            # Last listener went away mid-stream: stop the upstream request
+            flight.upstream.close()
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['in_flight_calls'] = len(self._calls)
+            stats['in_flight_streams'] = len(self._flights)
+            return stats
+
+
+# Singleton instance
+_single_flight = None
+
+def get_single_flight() -> SingleFlight:
+    """Get or create the shared request coalescer"""
+    global _single_flight
+    if _single_flight is None:
+        _single_flight = SingleFlight()
+    return _single_flight
@@ -0,0 +1,485 @@
+"""
+Streaming Helpers for AI Provider Responses
+Parses Server-Sent Events (SSE) bodies returned by streaming chat APIs
+into plain text deltas, and batches deltas into NDJSON frames for clients.
+"""
+
+import contextvars
+import json
+import os
+import queue
+import re
+import threading
+import time
+from typing import Callable, Dict, Iterable, Iterator, Optional
+
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+
+
+# Outgoing frame batching: flush after this many ms or bytes (0 ms = one frame per chunk)
+FRAME_WINDOW_MS = float(os.getenv('STREAM_FRAME_WINDOW_MS', '40'))
+FRAME_MAX_BYTES = int(os.getenv('STREAM_FRAME_MAX_BYTES', '4096'))
+
+
+def iter_sse_data(response) -> Iterator[str]:
+    """
+    Yield the payload of each `data:` field in an SSE response body.
+
+    Multi-line data fields are joined with newlines as per the SSE spec.
+    Comments (`:` lines) and other fields (event, id, retry) are ignored.
+    """
+    data_lines = []
+    for raw_line in response.iter_lines(decode_unicode=False):
+        line = raw_line.decode('utf-8') if isinstance(raw_line, bytes) else raw_line
+        if not line:
+            # Blank line terminates an event
+            if data_lines:
+                yield "\n".join(data_lines)
+                data_lines = []
+            continue
+        if line.startswith(':'):
+            continue
+        if line.startswith('data:'):
+            value = line[5:]
+            if value.startswith(' '):
+                value = value[1:]
+            data_lines.append(value)
+
+    if data_lines:
+        yield "\n".join(data_lines)
+
+
+def iter_chat_completion_deltas(response, on_usage: Optional[Callable[[Dict], None]] = None) -> Iterator[str]:
+    """
+    Yield content deltas from an OpenAI-compatible `stream: true` response.
+
+    Works for OpenAI, Grok (xAI), DeepSeek, Groq and Zhipu, which all emit
+    `data: {"choices": [{"delta": {"content": "..."}}]}` events followed
+    by a final `data: [DONE]`. An event carrying `usage` is passed to on_usage.
+    """
+    for data in iter_sse_data(response):
+        if data.strip() == '[DONE]':
+            break
+        try:
+            event = json.loads(data)
+        except json.JSONDecodeError:
+            continue
+
+        if 'error' in event:
+            error = event['error']
+            message = error.get('message') if isinstance(error, dict) else error
+            raise Exception(f"Stream Error: {message}")
+
+        if on_usage is not None and event.get('usage'):
+            on_usage(event)
+
+        for choice in event.get('choices') or []:
+            delta = choice.get('delta') or {}
+            content = delta.get('content')
+            if content:
+                yield content
+
+
+def iter_gemini_text(response, on_usage: Optional[Callable[[Dict], None]] = None) -> Iterator[str]:
+    """
+    Yield text parts from a Gemini `streamGenerateContent?alt=sse` response.
+    The last event's usageMetadata (final token counts) is passed to on_usage.
+    """
+    last_usage = None
+    for data in iter_sse_data(response):
+        try:
+            event = json.loads(data)
+        except json.JSONDecodeError:
+            continue
+
+        if 'error' in event:
+            raise Exception(f"Gemini Stream Error: {event['error'].get('message', event['error'])}")
+
+        block_reason = (event.get('promptFeedback') or {}).get('blockReason')
+        if block_reason:
+            raise Exception(f"Gemini blocked the prompt: {block_reason}")
+
+        if event.get('usageMetadata'):
+            last_usage = event
+
+        for candidate in event.get('candidates') or []:
+            for part in (candidate.get('content') or {}).get('parts') or []:
+                text = part.get('text')
+                if text:
+                    yield text
+
+    if on_usage is not None and last_usage is not None:
+        on_usage(last_usage)
+
+
+# Output cleanup (compiled once, shared by blocking and streaming paths)
+_FENCE_OPEN_RE = re.compile(r'^```[a-zA-Z]*\n')
+_FENCE_CLOSE_RE = re.compile(r'\n```$')
+# Trailing whitespace and a possible closing fence must be held back until
+# we know whether more content follows.
+_TAIL_HOLD_RE = re.compile(r'(?:\s*\n`{1,3})?\s*$')
+_WRAPPER_TOKENS = ('<!DOCTYPE html>', '<html>', '</html>')
+_HOLD_TOKENS = _WRAPPER_TOKENS + ('<body>', '</body>')
+_PREAMBLE_STARTS = ('<!doctype', '<html', '<head')
+_MAX_FENCE_HEADER = 32
+
+
+def clean_model_output(content: str) -> str:
+    """Strip Markdown code fences and HTML document wrappers from a full response."""
+    content = _FENCE_OPEN_RE.sub('', content.strip())
+    content = _FENCE_CLOSE_RE.sub('', content.strip())
+
+    if "<body>" in content:
+        content = content.split("<body>")[1]
+        if "</body>" in content:
+            content = content.split("</body>")[0]
+
+    for token in _WRAPPER_TOKENS:
+        content = content.replace(token, "")
+
+    return content.strip()
+
+
+class StreamCleaner:
+    """
+    Incremental version of clean_model_output for chunked responses.
+
+    Feed chunks as they arrive and forward whatever feed() returns; call
+    flush() once the stream ends. Only the few characters that could still
+    turn into a fence or wrapper tag are held back, so text reaches the
+    client as soon as it is unambiguous.
+
+    Unlike the blocking cleanup, content already emitted before a `<body>`
+    tag cannot be retracted, so only documents that *start* with an HTML
+    preamble (doctype/html/head) have that preamble dropped.
+    """
+
+    def __init__(self):
+        self._pending = ""
+        self._state = 'start'  # start -> (preamble ->) body -> done
+        self._at_body_start = True
+
+    def feed(self, chunk: str) -> str:
+        if self._state == 'done' or not chunk:
+            return ""
+        self._pending += chunk
+
+        if self._state == 'start' and not self._resolve_start():
+            return ""
+        if self._state == 'preamble' and not self._resolve_preamble():
+            return ""
+        return self._emit_body(final=False)
+
+    def flush(self) -> str:
+        if self._state == 'done':
+            return ""
+        if self._state in ('start', 'preamble'):
+            text = clean_model_output(self._pending)
+            self._pending = ""
+            self._state = 'done'
+            return text
+        text = self._emit_body(final=True)
+        self._state = 'done'
+        return text
+
+    def _resolve_start(self) -> bool:
+        """Drop leading whitespace/opening fence; return False while undecided."""
+        text = self._pending.lstrip()
+        if not text:
+            return False
+
+        if text.startswith('```'):
+            newline = text.find('\n')
+            if newline == -1:
+                if len(text) < _MAX_FENCE_HEADER:
+                    return False
+            else:
+                match = _FENCE_OPEN_RE.match(text)
+                if match:
+                    text = text[match.end():].lstrip()
+                    if not text:
+                        self._pending = ""
+                        return False
+        elif '```'.startswith(text):
+            return False
+
+        lowered = text.lower()
+        if len(lowered) < len('<!doctype') and any(p.startswith(lowered) for p in _PREAMBLE_STARTS):
+            self._pending = text
+            return False
+
+        self._pending = text
+        self._state = 'preamble' if lowered.startswith(_PREAMBLE_STARTS) else 'body'
+        return True
+
+    def _resolve_preamble(self) -> bool:
+        index = self._pending.find('<body>')
+        if index == -1:
+            return False
+        self._pending = self._pending[index + len('<body>'):]
+        self._state = 'body'
+        return True
+
+    def _hold_index(self) -> int:
+        """Index from which the pending buffer must be held back."""
+        pending = self._pending
+        longest = max(len(token) for token in _HOLD_TOKENS)
+        for i in range(max(0, len(pending) - longest + 1), len(pending)):
+            tail = pending[i:]
+            if any(token.startswith(tail) for token in _HOLD_TOKENS):
+                pending = pending[:i]
+                break
+        return _TAIL_HOLD_RE.search(pending).start()
+
+    def _emit_body(self, final: bool) -> str:
+        end = self._pending.find('</body>')
+        if end != -1:
+            self._pending = self._pending[:end]
+            final = True
+
+        for token in _HOLD_TOKENS:
+            self._pending = self._pending.replace(token, "")
+
+        if self._at_body_start:
+            self._pending = self._pending.lstrip()
+            if not self._pending and not final:
+                return ""
+            self._at_body_start = False
+
+        if final:
+            text = _FENCE_CLOSE_RE.sub('', self._pending.rstrip()).rstrip()
+            self._pending = ""
+            self._state = 'done'
+            return text
+
+        hold = self._hold_index()
+        text, self._pending = self._pending[:hold], self._pending[hold:]
+        return text
+
+
+def close_iterator(iterator):
+    """Close a generator (and, through it, any upstream HTTP response) if it supports it."""
+    close = getattr(iterator, 'close', None)
+    if close is not None:
+        close()
+
+
+# How often a stop event is checked while upstream is silent
+STOP_CHECK_INTERVAL = 0.1
+
+_STREAM_END = object()
+_STOPPED = object()
+
+
+def coalesce_chunks(chunks: Iterable[str], window_ms: float = FRAME_WINDOW_MS,
+                    max_bytes: int = FRAME_MAX_BYTES, stop: Optional[threading.Event] = None) -> Iterator[str]:
+    """
+    Join small text chunks into larger ones. The first chunk is passed
+    through at once (time to first token matters); after that a batch is
+    flushed when it is window_ms old or reaches max_bytes, even if upstream
+    has stalled. Upstream is read on a helper thread (in a copy of the
+    caller's context) so the window runs on a timer.
+
+    Once `stop` is set the generator ends, dropping any pending batch,
+    without waiting for upstream. Stopping or closing it closes `chunks`
+    once the pending read returns.
+    """
+    received = queue.Queue()
+    closed = threading.Event()
+
+    def read():
+        iterator = iter(chunks)
+        try:
+            for chunk in iterator:
+                if closed.is_set():
+                    break
+                received.put(chunk)
+            received.put(_STREAM_END)
+        except Exception as e:
+            received.put(e)
+        finally:
+            close_iterator(iterator)
+
+    def take(timeout=None):
+        """Next upstream item (_STOPPED once stop is set); raises queue.Empty if timeout passes first."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if stop is not None and stop.is_set():
+                return _STOPPED
+            wait = None if deadline is None else max(0.0, deadline - time.monotonic())
+            if stop is not None:
+                wait = STOP_CHECK_INTERVAL if wait is None else min(wait, STOP_CHECK_INTERVAL)
+            try:
+                item = received.get(timeout=wait)
+                break
+            except queue.Empty:
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    context = contextvars.copy_context()
+    threading.Thread(target=context.run, args=(read,), daemon=True, name='stream-reader').start()
+    try:
+        first = take()
+        if first is _STREAM_END or first is _STOPPED:
+            return
+        yield first
+
+        window = window_ms / 1000.0
+        batch = []
+        batch_bytes = 0
+        flush_at = None
+        while True:
+            try:
+                chunk = take(None if flush_at is None else max(0.0, flush_at - time.monotonic()))
+            except queue.Empty:
+                chunk = None
+            if chunk is _STOPPED:
+                return
+            if chunk is _STREAM_END:
+                break
+            if chunk:
+                if not batch:
+                    flush_at = time.monotonic() + window
+                batch.append(chunk)
+                batch_bytes += len(chunk)
+            if batch and (batch_bytes >= max_bytes or time.monotonic() >= flush_at):
+                yield "".join(batch)
+                batch = []
+                batch_bytes = 0
+                flush_at = None
+        if batch:
+            yield "".join(batch)
+    finally:
+        closed.set()
+
+
+_json_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+
+def encode_ndjson(event: Dict) -> bytes:
+    """Serialize one NDJSON line (orjson when installed, else a shared json encoder)."""
+    if HAS_ORJSON:
+        return orjson.dumps(event) + b"\n"
+    return (_json_encoder.encode(event) + "\n").encode('utf-8')
+
+
+class NDJSONWriter:
+    """
+    Encodes the events of one response stream and counts what is sent:
+    frames are content ("chunk") lines, control lines (start, progress,
+    done, error, ...) are counted separately.
+    """
+
+    def __init__(self):
+        self.frames = 0
+        self.control_lines = 0
+        self.bytes = 0
+        self.chunks = 0
+        self.content_chars = 0
+        self.started = time.monotonic()
+
+    def count(self, chunks: Iterable[str]) -> Iterator[str]:
+        """Pass chunks through, counting those received from upstream."""
+        iterator = iter(chunks)
+        try:
+            for chunk in iterator:
+                self.chunks += 1
+                self.content_chars += len(chunk)
+                yield chunk
+        finally:
+            close_iterator(iterator)
+
+    def write(self, event: Dict) -> bytes:
+        line = encode_ndjson(event)
+        if event.get("type") == "chunk":
+            self.frames += 1
+        else:
+            self.control_lines += 1
+        self.bytes += len(line)
+        return line
+
+    def stats(self) -> Dict:
+        return {
+            'frames': self.frames,
+            'control_lines': self.control_lines,
+            'bytes': self.bytes,
+            'chunks': self.chunks,
+            'duration_ms': round((time.monotonic() - self.started) * 1000, 1)
+        }
+
+
+class StreamStats:
+    """
+    Totals across all NDJSON streams served by this process, including
+    streams cut short because the client disconnected. Tokens are estimated
+    at ~4 characters each; the tokens a cancelled stream saved are estimated
+    from the average length of completed streams for the same provider.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {
+            'streams': 0,
+            'completed': 0,
+            'cancelled': 0,
+            'superseded': 0,
+            'errors': 0,
+            'frames': 0,
+            'control_lines': 0,
+            'bytes': 0,
+            'chunks': 0,
+            'cancelled_tokens_streamed': 0,
+            'cancelled_tokens_saved_est': 0
+        }
+        # provider -> [completed streams, total tokens]
+        self._completed_tokens: Dict[str, list] = {}
+
+    def record(self, writer: NDJSONWriter, provider: str = None, outcome: str = 'completed'):
+        """outcome: 'completed', 'cancelled' (client went away), 'superseded' or 'error'."""
+        tokens = writer.content_chars // 4
+        with self._lock:
+            self._stats['streams'] += 1
+            self._stats['frames'] += writer.frames
+            self._stats['control_lines'] += writer.control_lines
+            self._stats['bytes'] += writer.bytes
+            self._stats['chunks'] += writer.chunks
+
+            history = self._completed_tokens.setdefault(provider, [0, 0])
+            if outcome == 'completed':
+                self._stats['completed'] += 1
+                history[0] += 1
+                history[1] += tokens
+            elif outcome in ('cancelled', 'superseded'):
+                self._stats[outcome] += 1
+                self._stats['cancelled_tokens_streamed'] += tokens
+                if history[0]:
+                    self._stats['cancelled_tokens_saved_est'] += max(0, history[1] // history[0] - tokens)
+            else:
+                self._stats['errors'] += 1
+        return tokens
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+        stats['chunks_per_frame'] = round(stats['chunks'] / stats['frames'], 2) if stats['frames'] else 0.0
+        stats['encoder'] = 'orjson' if HAS_ORJSON else 'json'
+        stats['frame_window_ms'] = FRAME_WINDOW_MS
+        stats['frame_max_bytes'] = FRAME_MAX_BYTES
+        return stats
+
+
+# Singleton instance
+_stream_stats = None
+
+def get_stream_stats() -> StreamStats:
+    """Get or create the process-wide stream statistics"""
+    global _stream_stats
+    if _stream_stats is None:
+        _stream_stats = StreamStats()
+    return _stream_stats
@@ -0,0 +1,142 @@
+"""
+Map-Reduce Document Summarization
+Long documents are split into token-sized sections that are summarized in
+parallel (each call still goes through the provider pool and its caps),
+then the section summaries are combined, in rounds if there are many,
+and handed to the final summary prompt. Short documents take one call.
+"""
+
+import contextvars
+import os
+import threading
+import concurrent.futures
+from typing import Callable, Dict, List, Optional
+
+from services.retrieval import chunk_document
+from services.tokens import estimate_tokens
+
+
+SUMMARY_DIRECT_TOKENS = int(os.getenv('SUMMARY_DIRECT_TOKENS', '7500'))
+SUMMARY_CHUNK_TOKENS = int(os.getenv('SUMMARY_CHUNK_TOKENS', '6000'))
+SUMMARY_MAP_WORKERS = int(os.getenv('SUMMARY_MAP_WORKERS', '4'))
+SUMMARY_REDUCE_FANIN = int(os.getenv('SUMMARY_REDUCE_FANIN', '8'))
+
+MAP_PROMPT = """
+    Task: Summarize section {index} of {total} of a longer academic/technical document.
+
+    Instructions:
+    - Capture the objective, methods, results and conclusions this section mentions.
+    - Keep concrete numbers, names and findings; skip references and boilerplate.
+    - Write at most ~250 words of plain prose. No preamble.
+
+    Section Content:
+    {text}
+    """
+
+COMBINE_PROMPT = """
+    Task: Merge these consecutive section summaries of one document into a single summary.
+
+    Instructions:
+    - Keep every distinct objective, method and finding; drop repetition.
+    - Write at most ~400 words of plain prose. No preamble.
+
+    Section Summaries:
+    {text}
+    """
+
+
+class MapReduceSummarizer:
+    def __init__(self, max_workers: int = SUMMARY_MAP_WORKERS):
+        # These threads only wait on provider calls; concurrency toward each
+        # provider is capped by the provider pool, not here
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='summarize'
+        )
+        self._lock = threading.Lock()
+        self._stats = {'direct': 0, 'map_reduce': 0, 'sections': 0, 'combine_calls': 0}
+
+    def _parallel(self, prompts: List[str], generate: Callable[[str], str],
+                  on_done: Callable[[int], None]) -> List[str]:
+        # Each task runs in a copy of the caller's context (request labels, usage scope)
+        futures = [self._executor.submit(contextvars.copy_context().run, generate, prompt) for prompt in prompts]
+        done = 0
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                future.result()  # surface the first failure right away
+                done += 1
+                on_done(done)
+        except BaseException:
+            # The summary is lost anyway: don't start the remaining paid calls
+            for future in futures:
+                future.cancel()
+            raise
+        return [future.result() for future in futures]
+
+    def summarize(self, text: str, generate: Callable[[str], str], final_prompt: Callable[[str], str],
+                  progress: Optional[Callable[[Dict], None]] = None) -> Dict:
+        """
+        Summarize `text`.
+
+        Args:
+            generate: Callable(prompt) -> response text (one provider call)
+            final_prompt: Callable(content) -> the prompt producing the final summary
+            progress: Optional callback receiving {"phase", "done", "total"} events
+
+        Returns:
+            {"summary": str, "mode": "direct"|"map_reduce", "sections": int, "rounds": int}
+        """
+        report = progress or (lambda event: None)
+
+        if estimate_tokens(text) <= SUMMARY_DIRECT_TOKENS:
+            with self._lock:
+                self._stats['direct'] += 1
+            report({"phase": "final", "done": 0, "total": 1})
+            return {"summary": generate(final_prompt(text)), "mode": "direct", "sections": 1, "rounds": 0}
+
+        chunks = chunk_document(text, chunk_tokens=SUMMARY_CHUNK_TOKENS, overlap_tokens=0)
+        sections = [text[c["start"]:c["end"]] for c in chunks]
+        total = len(sections)
+        report({"phase": "map", "done": 0, "total": total})
+        partials = self._parallel(
+            [MAP_PROMPT.format(index=i + 1, total=total, text=section) for i, section in enumerate(sections)],
+            generate,
+            lambda done: report({"phase": "map", "done": done, "total": total})
+        )
+
+        # Combine in rounds until the summaries fit comfortably in one final prompt
+        rounds = 0
+        while len(partials) > 1 and estimate_tokens("\n\n".join(partials)) > SUMMARY_DIRECT_TOKENS:
+            rounds += 1
+            groups = [partials[i:i + SUMMARY_REDUCE_FANIN] for i in range(0, len(partials), SUMMARY_REDUCE_FANIN)]
+            report({"phase": "reduce", "round": rounds, "done": 0, "total": len(groups)})
+            partials = self._parallel(
+                [COMBINE_PROMPT.format(text="\n\n".join(group)) for group in groups],
+                generate,
+                lambda done, n=len(groups), r=rounds: report({"phase": "reduce", "round": r, "done": done, "total": n})
+            )
+            with self._lock:
+                self._stats['combine_calls'] += len(groups)
+
+        report({"phase": "final", "done": 0, "total": 1})
+        combined = "\n\n".join(f"Section summary {i + 1}:\n{p}" for i, p in enumerate(partials))
+        summary = generate(final_prompt(combined))
+
+        with self._lock:
+            self._stats['map_reduce'] += 1
+            self._stats['sections'] += total
+        return {"summary": summary, "mode": "map_reduce", "sections": total, "rounds": rounds}
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            return dict(self._stats)
+
+
+# Singleton instance
+_summarizer = None
+
+def get_summarizer() -> MapReduceSummarizer:
+    """Get or create the shared document summarizer"""
+    global _summarizer
+    if _summarizer is None:
+        _summarizer = MapReduceSummarizer()
+    return _summarizer
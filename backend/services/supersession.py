@@ -0,0 +1,99 @@
+"""
+Latest-Wins Request Supersession
+Tracks the in-flight generation per (session, endpoint). Starting a new one
+cancels the previous ticket, so a user who hits Generate again does not
+keep the old request running on a provider to completion.
+"""
+
+import os
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+
+SUPERSEDE_ENDPOINTS = set(
+    p.strip() for p in os.getenv('SUPERSEDE_ENDPOINTS', 'generate,stream_chat').split(',') if p.strip()
+)
+
+
+class Superseded(Exception):
+    """Raised when a request was cancelled by a newer one for the same session and endpoint."""
+
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        super().__init__(f"Superseded by a newer {endpoint} request from this session")
+
+
+class RequestTicket:
+    """Handle for one in-flight request; `cancelled` is set when it is superseded."""
+
+    def __init__(self, key: Optional[Tuple[str, str]], endpoint: str):
+        self.key = key
+        self.endpoint = endpoint
+        self.cancelled = threading.Event()
+        self.started = time.monotonic()
+
+    @property
+    def superseded(self) -> bool:
+        return self.cancelled.is_set()
+
+    def check(self):
+        """Raise Superseded if a newer request has replaced this one."""
+        if self.cancelled.is_set():
+            raise Superseded(self.endpoint)
+
+
+class SupersessionRegistry:
+    def __init__(self, endpoints=SUPERSEDE_ENDPOINTS):
+        self.endpoints = endpoints
+        self._current: Dict[Tuple[str, str], RequestTicket] = {}
+        self._lock = threading.Lock()
+        self._stats = {'tracked': 0, 'superseded': 0}
+
+    def begin(self, session_id: Optional[str], endpoint: str) -> RequestTicket:
+        """
+        Register a new request and cancel the one it replaces. Requests
+        without a session, or for endpoints not in SUPERSEDE_ENDPOINTS, get
+        a ticket that is never cancelled.
+        """
+        if not session_id or endpoint not in self.endpoints:
+            return RequestTicket(None, endpoint)
+
+        key = (session_id, endpoint)
+        ticket = RequestTicket(key, endpoint)
+        with self._lock:
+            previous = self._current.get(key)
+            self._current[key] = ticket
+            self._stats['tracked'] += 1
+            if previous is not None:
+                self._stats['superseded'] += 1
+        if previous is not None:
+            print(f"Superseding in-flight {endpoint} request for session {session_id}")
+            previous.cancelled.set()
+        return ticket
+
+    def finish(self, ticket: RequestTicket):
+        """Forget a ticket once its request is over (unless it was already replaced)."""
+        if ticket.key is None:
+            return
+        with self._lock:
+            if self._current.get(ticket.key) is ticket:
+                del self._current[ticket.key]
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['in_flight'] = len(self._current)
+        stats['endpoints'] = sorted(self.endpoints)
+        return stats
+
+
+# Singleton instance
+_supersession = None
+
+def get_supersession() -> SupersessionRegistry:
+    """Get or create the shared supersession registry"""
+    global _supersession
+    if _supersession is None:
+        _supersession = SupersessionRegistry()
+    return _supersession
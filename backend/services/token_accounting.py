@@ -0,0 +1,197 @@
+"""
+Token and Cost Accounting
+Every provider call is counted twice: a local tokenizer estimate of the
+prompt before it is sent (which also drives prompt-size alerts), and the
+usage the provider reports afterwards (falling back to the estimate when
+it reports none). Totals and an approximate USD cost are kept per
+provider, per endpoint and per session, and every call is logged.
+"""
+
+import contextvars
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Dict, List, Optional
+
+from services.tokens import CHARS_PER_TOKEN
+
+
+PROMPT_ALERT_TOKENS = int(os.getenv('PROMPT_ALERT_TOKENS', '30000'))
+# Alert when a prompt uses this share of the provider's context window
+PROMPT_ALERT_WINDOW_SHARE = float(os.getenv('PROMPT_ALERT_WINDOW_SHARE', '0.8'))
+ACCOUNTING_MAX_SESSIONS = int(os.getenv('ACCOUNTING_MAX_SESSIONS', '1000'))
+ACCOUNTING_MAX_ALERTS = 50
+
+# USD per million tokens: (input, cached input, output). Override per provider with
+# TOKEN_PRICE_<PROVIDER>="input,cached,output".
+DEFAULT_PRICES = {
+    'gemini': (0.075, 0.01875, 0.30),
+    'openai': (0.15, 0.075, 0.60),
+    'grok': (5.0, 5.0, 15.0),
+    'deepseek': (0.27, 0.07, 1.10),
+    'llama': (0.59, 0.59, 0.79),
+    'zhipu': (0.0, 0.0, 0.0),
+    'ollama': (0.0, 0.0, 0.0),
+    'manus': (0.0, 0.0, 0.0),
+}
+
+
+def _load_prices() -> Dict[str, tuple]:
+    prices = dict(DEFAULT_PRICES)
+    for provider in DEFAULT_PRICES:
+        override = os.getenv(f'TOKEN_PRICE_{provider.upper()}')
+        if override:
+            try:
+                prices[provider] = tuple(float(v) for v in override.split(','))[:3]
+            except ValueError:
+                print(f"Ignoring malformed TOKEN_PRICE_{provider.upper()}: {override}")
+    return prices
+
+
+# Session and endpoint of the request being served; provider pool tasks inherit them
+_request_labels: contextvars.ContextVar = contextvars.ContextVar('usage_labels', default=(None, None))
+
+
+def set_usage_labels(session_id: Optional[str], endpoint: Optional[str]):
+    """Attribute provider calls made from here on (in this context) to a session and endpoint."""
+    _request_labels.set((session_id, endpoint))
+
+
+def _new_totals() -> Dict:
+    return {'calls': 0, 'estimated_calls': 0, 'estimated_input_tokens': 0, 'input_tokens': 0,
+            'cached_tokens': 0, 'output_tokens': 0, 'cost_usd': 0.0}
+
+
+class TokenLedger:
+    def __init__(self, max_sessions: int = ACCOUNTING_MAX_SESSIONS, alert_tokens: int = PROMPT_ALERT_TOKENS,
+                 alert_window_share: float = PROMPT_ALERT_WINDOW_SHARE):
+        self.prices = _load_prices()
+        self.max_sessions = max_sessions
+        self.alert_tokens = alert_tokens
+        self.alert_window_share = alert_window_share
+        self._lock = threading.Lock()
+        self._total = _new_totals()
+        self._providers: Dict[str, Dict] = {}
+        self._endpoints: Dict[str, Dict] = {}
+        self._sessions: "OrderedDict[str, Dict]" = OrderedDict()
+        self._alerts = deque(maxlen=ACCOUNTING_MAX_ALERTS)
+        self._alert_count = 0
+
+    def cost(self, provider: str, usage: Dict) -> float:
+        """Approximate USD cost of one call's usage."""
+        price_in, price_cached, price_out = self.prices.get(provider, (0.0, 0.0, 0.0))
+        cached = usage.get('cached_tokens', 0)
+        uncached = max(0, usage.get('input_tokens', 0) - cached)
+        return (uncached * price_in + cached * price_cached + usage.get('output_tokens', 0) * price_out) / 1_000_000
+
+    def check_prompt(self, provider: str, tokens: int, context_window: Optional[int] = None) -> bool:
+        """
+        Raise a prompt-size alert (logged and kept for /api/usage) if the
+        estimate exceeds PROMPT_ALERT_TOKENS or most of the context window.
+        Returns True if an alert was raised; the call still goes ahead.
+        """
+        limit = self.alert_tokens
+        if context_window:
+            limit = min(limit, int(context_window * self.alert_window_share))
+        if tokens <= limit:
+            return False
+
+        session_id, endpoint = _request_labels.get()
+        alert = {'time': time.time(), 'provider': provider, 'endpoint': endpoint,
+                 'session': session_id[:8] if session_id else None, 'prompt_tokens': tokens, 'limit': limit}
+        with self._lock:
+            self._alerts.append(alert)
+            self._alert_count += 1
+        print(f"WARNING: Prompt size alert [{provider}] {endpoint or '-'}: ~{tokens} tokens (limit {limit})")
+        return True
+
+    def _buckets(self, provider: str, endpoint: Optional[str], session_id: Optional[str]) -> List[Dict]:
+        """Totals a call counts towards (called with the lock held)."""
+        buckets = [self._total, self._providers.setdefault(provider, _new_totals()),
+                   self._endpoints.setdefault(endpoint or 'other', _new_totals())]
+        if session_id:
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = self._sessions[session_id] = _new_totals()
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+            buckets.append(session)
+        return buckets
+
+    def record(self, provider: str, estimated_input: int, usage: Optional[Dict] = None,
+               output_chars: int = 0) -> Dict:
+        """
+        Account for one provider call. `usage` is what the provider reported
+        (see prompt_layout.prompt_usage); without it the input estimate and
+        the output length stand in.
+
+        Returns:
+            The call's entry (tokens and cost_usd).
+        """
+        session_id, endpoint = _request_labels.get()
+        if usage:
+            entry = {'input_tokens': usage.get('input_tokens', 0), 'cached_tokens': usage.get('cached_tokens', 0),
+                     'output_tokens': usage.get('output_tokens', 0), 'estimated': False}
+        else:
+            entry = {'input_tokens': estimated_input, 'cached_tokens': 0,
+                     'output_tokens': output_chars // CHARS_PER_TOKEN, 'estimated': True}
+        entry['estimated_input_tokens'] = estimated_input
+        entry['cost_usd'] = self.cost(provider, entry)
+
+        with self._lock:
+            for totals in self._buckets(provider, endpoint, session_id):
+                totals['calls'] += 1
+                totals['estimated_calls'] += int(entry['estimated'])
+                for key in ('estimated_input_tokens', 'input_tokens', 'cached_tokens', 'output_tokens', 'cost_usd'):
+                    totals[key] += entry[key]
+
+        print(f"Tokens [{provider}] {endpoint or '-'} session={session_id[:8] if session_id else '-'}: "
+              f"~{estimated_input} est, {entry['input_tokens']} in ({entry['cached_tokens']} cached), "
+              f"{entry['output_tokens']} out{' (estimated)' if entry['estimated'] else ''}, ${entry['cost_usd']:.5f}")
+        return entry
+
+    def record_spend(self, provider: str, cost_usd: float):
+        """Account for a non-token charge (e.g. one generated image)."""
+        session_id, endpoint = _request_labels.get()
+        with self._lock:
+            for totals in self._buckets(provider, endpoint, session_id):
+                totals['calls'] += 1
+                totals['cost_usd'] += cost_usd
+
+    @staticmethod
+    def _rounded(totals: Dict) -> Dict:
+        return {**totals, 'cost_usd': round(totals['cost_usd'], 6)}
+
+    def session_usage(self, session_id: str) -> Optional[Dict]:
+        with self._lock:
+            totals = self._sessions.get(session_id)
+            return self._rounded(totals) if totals else None
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            return {
+                'total': self._rounded(self._total),
+                'providers': {name: self._rounded(t) for name, t in self._providers.items()},
+                'endpoints': {name: self._rounded(t) for name, t in self._endpoints.items()},
+                'tracked_sessions': len(self._sessions),
+                'alerts': {'count': self._alert_count, 'recent': list(self._alerts)}
+            }
+
+    def top_sessions(self, limit: int = 10) -> List[Dict]:
+        """Costliest tracked sessions (ids shortened)."""
+        with self._lock:
+            ranked = sorted(self._sessions.items(), key=lambda item: -item[1]['cost_usd'])[:limit]
+            return [{'session': sid[:8], **self._rounded(t)} for sid, t in ranked]
+
+
+# Singleton instance
+_token_ledger = None
+
+def get_token_ledger() -> TokenLedger:
+    """Get or create the shared token ledger"""
+    global _token_ledger
+    if _token_ledger is None:
+        _token_ledger = TokenLedger()
+    return _token_ledger
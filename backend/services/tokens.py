@@ -0,0 +1,50 @@
+"""
+Token Estimation
+A cheap, provider-agnostic token estimate (~4 characters per token) used
+wherever the backend budgets prompts before sending them, and a tokenizer
+count (tiktoken, when installed) used to account for each provider call.
+"""
+
+import os
+import threading
+
+try:
+    import tiktoken
+    HAS_TIKTOKEN = True
+except ImportError:
+    HAS_TIKTOKEN = False
+
+CHARS_PER_TOKEN = 4
+# A modern BPE vocabulary is a close proxy for every provider we call
+TOKENIZER_ENCODING = os.getenv('TOKENIZER_ENCODING', 'o200k_base')
+
+_encoding = None
+_encoding_failed = False
+_encoding_lock = threading.Lock()
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (~4 characters per token) used for budgeting."""
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def _get_encoding():
+    global _encoding, _encoding_failed
+    if _encoding is None and not _encoding_failed:
+        with _encoding_lock:
+            if _encoding is None and not _encoding_failed:
+                try:
+                    _encoding = tiktoken.get_encoding(TOKENIZER_ENCODING)
+                except Exception as e:
+                    # The vocabulary is downloaded on first use; offline we keep estimating
+                    print(f"Tokenizer unavailable, using character estimate: {e}")
+                    _encoding_failed = True
+    return _encoding
+
+
+def count_tokens(text: str) -> int:
+    """Tokenizer count of text (falls back to estimate_tokens without tiktoken)."""
+    encoding = _get_encoding() if HAS_TIKTOKEN else None
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(text, disallowed_special=()))
@@ -2,7 +2,7 @@ import React, { useState, useEffect } from 'react';
 import { Upload, FileText, Image as ImageIcon, Send, Loader, ChevronDown, ChevronRight, X, Gift, BookOpen, GraduationCap, Search, UserPlus, Bot, User, Save, Trash2, LayoutTemplate, Library, Newspaper, MessageSquare } from 'lucide-react';
 import './AgentSidebar.css';
 import { generateContent, getModelStatus } from '@/features/ai/api/aiService';
-import { uploadFiles } from '@/features/document/api/documentService';
+import { uploadFiles, getUploadJob } from '@/features/document/api/documentService';
 
 const PRESET_AGENTS = [
     {
@@ -184,7 +184,8 @@ const AgentSidebar = ({ onInsertContent, onAddReference, sessionId, modelProvide
 
         if (!expandedDocs[index]) {
             const doc = documents[index];
-            if (!doc.detailedSummary) {
+            // Text is still being extracted; the summary can be generated once it is ready
+            if (!doc.detailedSummary && doc.status !== 'processing') {
                 try {
                     setDocuments(prev => {
                         const newDocs = [...prev];
@@ -193,7 +194,14 @@ const AgentSidebar = ({ onInsertContent, onAddReference, sessionId, modelProvide
                     });
 
                     const { generateSummary } = await import('@/features/document/api/documentService');
-                    const summary = await generateSummary(doc.name, modelProvider);
+                    // Long documents are summarized in sections; show how far along it is
+                    const summary = await generateSummary(doc.name, modelProvider, doc.id, (progress) => {
+                        setDocuments(prev => {
+                            const newDocs = [...prev];
+                            newDocs[index] = { ...newDocs[index], summaryProgress: progress };
+                            return newDocs;
+                        });
+                    });
 
                     setDocuments(prev => {
                         const newDocs = [...prev];
@@ -201,7 +209,8 @@ const AgentSidebar = ({ onInsertContent, onAddReference, sessionId, modelProvide
                             ...newDocs[index],
                             summary: summary,
                             detailedSummary: true,
-                            isLoadingSummary: false
+                            isLoadingSummary: false,
+                            summaryProgress: null
                         };
                         return newDocs;
                     });
@@ -211,6 +220,7 @@ const AgentSidebar = ({ onInsertContent, onAddReference, sessionId, modelProvide
                         newDocs[index] = {
                             ...newDocs[index],
                             isLoadingSummary: false,
+                            summaryProgress: null,
                             summary: "Failed to load summary. " + err.message
                         };
                         return newDocs;
@@ -270,6 +280,7 @@ const AgentSidebar = ({ onInsertContent, onAddReference, sessionId, modelProvide
                 } else {
                     if (data.documents) {
                         setDocuments(prev => [...prev, ...data.documents]);
+                        data.documents.filter(doc => doc.jobId).forEach(doc => watchUploadJob(doc.jobId));
                     } else {
                         const newDocs = files.map(f => ({ name: f.name, size: f.size }));
                         setDocuments(prev => [...prev, ...newDocs]);
@@ -288,6 +299,40 @@ const AgentSidebar = ({ onInsertContent, onAddReference, sessionId, modelProvide
         }
     };
 
+    // Text extraction runs in the background after upload: poll each job
+    // until it finishes, merging its progress and final metadata into the list.
+    // The backend answers from the stored document once the job itself is gone,
+    // so a 404 means the upload is lost; other errors are retried with backoff.
+    const watchUploadJob = async (jobId) => {
+        let delay = 1000;
+        while (true) {
+            await new Promise(resolve => setTimeout(resolve, delay));
+            let job;
+            try {
+                job = await getUploadJob(jobId);
+                delay = 1000;
+            } catch (err) {
+                if (err.response?.status === 404) {
+                    setDocuments(prev => prev.map(doc => doc.jobId === jobId
+                        ? { ...doc, status: 'failed', summary: 'Text extraction was lost. Please re-upload this file.' }
+                        : doc));
+                    return;
+                }
+                delay = Math.min(delay * 2, 30000);
+                continue;
+            }
+            const finished = job.status === 'ready' || job.status === 'failed';
+            setDocuments(prev => prev.map(doc => {
+                if (doc.jobId !== jobId) return doc;
+                if (job.status === 'failed') {
+                    return { ...doc, status: 'failed', summary: `Text extraction failed: ${job.error}` };
+                }
+                return { ...doc, ...(job.document || {}), status: finished ? 'ready' : 'processing', ingestProgress: job };
+            }));
+            if (finished) return;
+        }
+    };
+
     const extractReferences = (text) => {
         const patterns = [
             /\[(\d+)\]\s+([^\n]+)/g,
@@ -340,13 +385,17 @@ const AgentSidebar = ({ onInsertContent, onAddReference, sessionId, modelProvide
             const reader = response.body.getReader();
             const decoder = new TextDecoder();
             let accumulatedText = "";
+            let pending = "";
+            let superseded = false;
 
             while (true) {
                 const { done, value } = await reader.read();
                 if (done) break;
 
-                const chunk = decoder.decode(value);
-                const lines = chunk.split('\n');
+                // A frame may be split across reads: keep the partial last line
+                pending += decoder.decode(value, { stream: true });
+                const lines = pending.split('\n');
+                pending = lines.pop();
 
                 for (const line of lines) {
                     if (!line.trim()) continue;
@@ -358,6 +407,9 @@ const AgentSidebar = ({ onInsertContent, onAddReference, sessionId, modelProvide
                         } else if (json.type === 'replace') {
                             accumulatedText = json.content;
                             setStreamingContent(json.content);
+                        } else if (json.type === 'superseded') {
+                            // A newer request from this session replaced this one
+                            superseded = true;
                         } else if (json.type === 'error') {
                             throw new Error(json.error);
                         }
@@ -365,7 +417,7 @@ const AgentSidebar = ({ onInsertContent, onAddReference, sessionId, modelProvide
                 }
             }
 
-            if (onInsertContent && accumulatedText.trim()) {
+            if (onInsertContent && accumulatedText.trim() && !superseded) {
                 onInsertContent(accumulatedText);
             }
 
@@ -633,9 +685,17 @@ const AgentSidebar = ({ onInsertContent, onAddReference, sessionId, modelProvide
                                     {expandedDocs[idx] && (
                                         <div className="reference-abstract">
                                             <h4>AI Summary</h4>
-                                            {doc.isLoadingSummary ? (
+                                            {doc.status === 'processing' ? (
+                                                <div style={{ display: 'flex', gap: '8px', alignItems: 'center', color: '#64748b', fontSize: '0.85rem' }}>
+                                                    <Loader className="spin" size={14} /> Extracting text...
+                                                    {doc.ingestProgress?.pagesTotal && ` (${doc.ingestProgress.pagesDone}/${doc.ingestProgress.pagesTotal} pages`}
+                                                    {doc.ingestProgress?.pagesTotal && (doc.ingestProgress.etaSeconds != null ? `, ~${Math.ceil(doc.ingestProgress.etaSeconds)}s left)` : ')')}
+                                                </div>
+                                            ) : doc.isLoadingSummary ? (
                                                 <div style={{ display: 'flex', gap: '8px', alignItems: 'center', color: '#64748b', fontSize: '0.85rem' }}>
                                                     <Loader className="spin" size={14} /> Generating comprehensive summary...
+                                                    {doc.summaryProgress?.phase === 'map' && ` (section ${doc.summaryProgress.done}/${doc.summaryProgress.total})`}
+                                                    {doc.summaryProgress?.phase === 'reduce' && ' (combining sections)'}
                                                 </div>
                                             ) : (
                                                 <p>{doc.summary || "No abstract available for this document."}</p>
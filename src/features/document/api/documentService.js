@@ -16,11 +16,24 @@ export const uploadFiles = async (files) => {
     return response.data;
 };
 
-// Generate detailed summary for a specific document
-export const generateSummary = async (filename, modelProvider = 'gemini') => {
+// Status of a background text-extraction job started by an upload:
+// { status: 'queued'|'extracting'|'ready'|'failed', pagesDone, pagesTotal, etaSeconds, document }
+export const getUploadJob = async (jobId) => {
+    const response = await apiClient.get(`/upload/jobs/${jobId}`);
+    return response.data;
+};
+
+// Generate detailed summary for a specific document.
+// With onProgress, the backend streams NDJSON progress events while a long
+// document is summarized section by section: onProgress({ phase, done, total }).
+export const generateSummary = async (filename, modelProvider = 'gemini', docId = undefined, onProgress = undefined) => {
+    if (onProgress) {
+        return streamSummary(filename, modelProvider, docId, onProgress);
+    }
     try {
         // Use apiClient which automatically handles X-Session-ID via interceptor
-        const response = await apiClient.post('/summarize', { filename, modelProvider });
+        // docId identifies the exact upload when several files share a name
+        const response = await apiClient.post('/summarize', { filename, docId, modelProvider });
         return response.data.summary;
     } catch (error) {
         console.error('Summary API Error:', error);
@@ -29,3 +42,47 @@ export const generateSummary = async (filename, modelProvider = 'gemini') => {
         throw new Error(errMsg);
     }
 };
+
+const streamSummary = async (filename, modelProvider, docId, onProgress) => {
+    // axios cannot read a response body incrementally, so this uses fetch
+    const response = await fetch(`${apiClient.defaults.baseURL}/summarize`, {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+            'X-Session-ID': localStorage.getItem('word_ai_session_id') || ''
+        },
+        body: JSON.stringify({ filename, docId, modelProvider, stream: true })
+    });
+
+    if (!response.ok) {
+        const body = await response.json().catch(() => ({}));
+        throw new Error(body.error || `Summary generation failed: ${response.statusText}`);
+    }
+
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let pending = '';
+
+    while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+
+        // A frame may be split across reads: keep the partial last line
+        pending += decoder.decode(value, { stream: true });
+        const lines = pending.split('\n');
+        pending = lines.pop();
+
+        for (const line of lines) {
+            if (!line.trim()) continue;
+            const event = JSON.parse(line);
+            if (event.type === 'progress') {
+                onProgress(event);
+            } else if (event.type === 'summary') {
+                return event.summary;
+            } else if (event.type === 'error') {
+                throw new Error(event.error);
+            }
+        }
+    }
+    throw new Error('Summary stream ended unexpectedly');
+};